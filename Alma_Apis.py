@@ -1,4 +1,5 @@
 import os
+import itertools
 # external imports
 import requests
 import json
@@ -6,6 +7,10 @@ import logging
 # internal import
 from mail import mail
 from logs import logs
+try:
+    from . import Alma_Apis_Transport, Alma_Apis_Jobs, Alma_Apis_Tracing
+except ImportError:
+    import Alma_Apis_Transport, Alma_Apis_Jobs, Alma_Apis_Tracing
 
 
 __version__ = '0.1.0'
@@ -28,29 +33,51 @@ RESOURCES = {
     'job' : 'conf/jobs/{job_id}?op={operation}',
     'job_instance' : 'conf/jobs/{job_id}/instances/{instance_id}',
     'search_set_id' : 'conf/sets?q=name~{set_name}',
+    'sets' : 'conf/sets',
     'get_set' : 'conf/sets/{set_id}',
+    'set_members_operation' : 'conf/sets/{set_id}?op={operation}&fail_on_invalid_id=false',
+    'get_set_members' : 'conf/sets/{set_id}/members?limit={limit}&offset={offset}',
     'get_locations' : 'conf/libraries/{library_id}/locations'
 }
 
+#Nombre maximum de membres ajoutés à un jeu de résultats en un appel
+SET_MEMBERS_BATCH_SIZE = 1000
+
 
 class Alma(object):
 
-    def __init__(self, apikey=__apikey__, region=__region__,service='AlmaPy'):
+    def __init__(self, apikey=__apikey__, region=__region__,service='AlmaPy', transport=None, endpoint=None):
+        """
+        Keyword Arguments:
+            apikey {str} -- Alma API key (default: {__apikey__})
+            region {str} -- Alma region: US, EU or APAC (default: {__region__})
+            service {str} -- logger name (default: {'AlmaPy'})
+            transport {AlmaTransport} -- HTTP transport, the shared one by default (default: {None})
+            endpoint {str} -- other server than the one of the region, e.g. a proxy or
+                Alma_Apis_Bench.FakeAlmaServer. region is then ignored (default: {None})
+        """
         if apikey is None:
             raise Exception("Please supply an API key")
-        if region not in ENDPOINTS:
+        if endpoint is None and region not in ENDPOINTS:
             msg = 'Invalid Region. Must be one of {}'.format(list(ENDPOINTS))
             raise Exception(msg)
         self.apikey = apikey
-        self.endpoint = ENDPOINTS[region]
+        self.endpoint = endpoint if endpoint is not None else ENDPOINTS[region]
         self.service = service
         self.logger = logging.getLogger(service)
+        self.transport = transport if transport is not None else Alma_Apis_Transport.get_transport()
+
+    @property
+    def metrics(self):
+        """Counters of the calls of the transport (Alma_Apis_Metrics.Metrics): snapshot(), dump(), add_hook()"""
+        return self.transport.metrics
 
     @property
     #Construit la requête et met en forme les réponses
     def baseurl(self):
         return '{}/almaws/{}/'.format(self.endpoint, __api_version__)
 
+    @Alma_Apis_Tracing.traced('build_url')
     def fullurl(self, resource, ids={}):
         return self.baseurl + RESOURCES[resource].format(**ids)
 
@@ -66,18 +93,21 @@ class Alma(object):
 
     def request(self, httpmethod, resource, ids, params={}, data=None,
                 accept='json', content_type=None):
-        response = requests.request(
-            method=httpmethod,
+        response = self.transport.request(
+            httpmethod,
             headers=self.headers(accept=accept, content_type=content_type),
             url=self.fullurl(resource, ids),
             params=params,
-            data=data)
+            data=data,
+            apikey=self.apikey,
+            resource=resource)
         try:
             response.raise_for_status()  
         except requests.exceptions.HTTPError:
             raise HTTPError(response,self.service)
         return response
 
+    @Alma_Apis_Tracing.traced('extract_content')
     def extract_content(self, response):
         ctype = response.headers['Content-Type']
         if 'json' in ctype:
@@ -107,6 +137,28 @@ class Alma(object):
                                 accept=accept)
         return self.extract_content(response)
     
+    def wait_for_job(self, job_id, instance_id, timeout=6 * 3600, min_interval=2, max_interval=60):
+        """Wait for the end of a job instance. Reads are frequent at first, then spaced out
+        according to the progress reported by the job.
+
+        Arguments:
+            job_id {str} -- job id
+            instance_id {str} -- instance id, Alma_Apis_Jobs.job_instance_id(answer of post_job)
+
+        Keyword Arguments:
+            timeout {float} -- maximum wait in seconds, None to wait forever (default: {6 hours})
+            min_interval {float} -- shortest delay between two reads (default: {2})
+            max_interval {float} -- longest delay between two reads (default: {60})
+
+        Raises:
+            TimeoutError: the job is still running after timeout
+
+        Returns:
+            dict -- finished job instance
+        """
+        return Alma_Apis_Jobs.wait_for_job(self, job_id, instance_id, timeout=timeout,
+                                           min_interval=min_interval, max_interval=max_interval)
+
     #Retourne l'identifiant d'un jeu de résultat à partir du nom de ce dernier
     def get_set_id(self, set_name, accept='json'):
         query = set_name.replace(" ", "_")
@@ -132,6 +184,69 @@ class Alma(object):
             raise HTTPError(response,self.service)
         return members_num
 
+    def create_set(self, name, content_type, description='', private='true'):
+        """Create an itemized set
+
+        Arguments:
+            name {str} -- set name
+            content_type {str} -- set content: ITEM, BIB_MMS, PORTFOLIO, USER...
+
+        Keyword Arguments:
+            description {str} -- set description (default: {''})
+            private {str} -- 'true' or 'false' (default: {'true'})
+
+        Returns:
+            dict -- created set
+        """
+        data = {'name': name,
+                'description': description,
+                'type': {'value': 'ITEMIZED'},
+                'content': {'value': content_type},
+                'private': {'value': private}}
+        response = self.request('POST', 'sets', {},
+                                data=json.dumps(data), content_type='json', accept='json')
+        return self.extract_content(response)
+
+    def add_set_members(self, set_id, member_ids):
+        """Add members to an itemized set, SET_MEMBERS_BATCH_SIZE ids per call. Invalid ids are ignored.
+
+        Arguments:
+            set_id {str} -- set id
+            member_ids {iterable} -- ids of the records to add
+
+        Returns:
+            int -- number of members of the set
+        """
+        #L'opération attend l'objet set complet avec la liste des membres à ajouter
+        set_data = self.extract_content(self.request('GET', 'get_set', {'set_id': set_id}, accept='json'))
+        members_num = set_data.get('number_of_members', {}).get('value')
+        member_ids = iter(member_ids)
+        batch = list(itertools.islice(member_ids, SET_MEMBERS_BATCH_SIZE))
+        while batch:
+            data = dict(set_data, members={'member': [{'id': str(member_id)} for member_id in batch]})
+            response = self.request('POST', 'set_members_operation',
+                                    {'set_id': set_id, 'operation': 'add_members'},
+                                    data=json.dumps(data), content_type='json', accept='json')
+            members_num = self.extract_content(response)['number_of_members']['value']
+            batch = list(itertools.islice(member_ids, SET_MEMBERS_BATCH_SIZE))
+        return members_num
+
+    def get_set_member_ids(self, set_id, limit=100):
+        """Return the ids of the members of a set"""
+        member_ids, offset = [], 0
+        while True:
+            response = self.request('GET', 'get_set_members',
+                                    {'set_id': set_id, 'limit': limit, 'offset': offset},
+                                    accept='json')
+            content = self.extract_content(response)
+            member_ids.extend(member['id'] for member in content.get('member', []))
+            offset += limit
+            if offset >= content.get('total_record_count', 0):
+                return member_ids
+
+    def delete_set(self, set_id):
+        self.request('DELETE', 'get_set', {'set_id': set_id})
+
     def get_locations(self, library_id, accept='json'):
         """List all the libary's location in a dictionnary. Name and External name are used as dic key.
         
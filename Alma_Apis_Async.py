@@ -0,0 +1,183 @@
+import asyncio
+import functools
+from collections import deque
+import logging
+from concurrent.futures import ThreadPoolExecutor
+# internal import
+try:
+    from . import Alma_Apis, Alma_Apis_Records, Alma_Apis_Users, Alma_Apis_Ecollections, Alma_Apis_Concurrent, Alma_Apis_Transport
+except ImportError:
+    import Alma_Apis, Alma_Apis_Records, Alma_Apis_Users, Alma_Apis_Ecollections, Alma_Apis_Concurrent, Alma_Apis_Transport
+
+
+def _coroutine(name):
+    """Build the coroutine version of the synchronous client method name"""
+    async def method(self, *args, **kwargs):
+        return await self.run(getattr(self.client, name), *args, **kwargs)
+    method.__name__ = name
+    method.__qualname__ = name
+    method.__doc__ = "Coroutine version of {}. Same arguments and same return values.".format(name)
+    return method
+
+
+class ThreadOffloadClient(object):
+    """Base class of the asyncio clients: a thread-offload adapter of a synchronous client.
+
+    The I/O is not non-blocking: each coroutine runs the matching synchronous method in a
+    pool of concurrency threads, so that asyncio code can call Alma without blocking its
+    event loop. Every call in flight holds a thread and a connection of the pool of the
+    transport: concurrency calls in flight cost concurrency threads, and the throughput is
+    the one of the synchronous helpers with as many workers (e.g.
+    AlmaRecords.get_items_by_barcodes(max_workers=concurrency)).
+
+    The cap and the pool are sized together: without transport, a client given a
+    concurrency gets its own transport with one pooled connection by call in flight. A
+    given transport must have at least concurrency pooled connections.
+    """
+    CLIENT = None
+
+    def __init__(self, *args, concurrency=None, **kwargs):
+        """Same arguments as the synchronous client
+
+        Keyword Arguments:
+            concurrency {int} -- maximum number of calls in flight, the pool size of the
+                transport by default (default: {None})
+
+        Raises:
+            ValueError: concurrency is larger than the pool of the given transport
+        """
+        self._own_transport = None
+        if kwargs.get('transport') is None and concurrency is not None:
+            self._own_transport = kwargs['transport'] = Alma_Apis_Transport.AlmaTransport(
+                pool_maxsize=concurrency, service=kwargs.get('service', 'AlmaPy'))
+        self.client = self.CLIENT(*args, **kwargs)
+        pool_maxsize = self.client.transport.pool_maxsize
+        self.concurrency = concurrency or pool_maxsize
+        if self.concurrency > pool_maxsize:
+            raise ValueError("{} :: {} appels simultanés pour {} connexions réutilisables, donner un transport "
+                             "AlmaTransport(pool_maxsize={})".format(type(self).__name__, self.concurrency,
+                                                                     pool_maxsize, self.concurrency))
+        self.logger = logging.getLogger(self.client.service)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                           thread_name_prefix=self.client.service)
+
+    @property
+    def transport(self):
+        return self.client.transport
+
+    @property
+    def metrics(self):
+        return self.client.transport.metrics
+
+    async def run(self, func, *args, **kwargs):
+        """Run a synchronous client call without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self._own_transport is not None:
+            self._own_transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class AsyncAlma(ThreadOffloadClient):
+    """Asyncio version of Alma_Apis.Alma, run in threads
+    """
+    CLIENT = Alma_Apis.Alma
+
+    post_job = _coroutine('post_job')
+    post_job_without_data = _coroutine('post_job_without_data')
+    get_job_instances = _coroutine('get_job_instances')
+    wait_for_job = _coroutine('wait_for_job')
+    get_set_id = _coroutine('get_set_id')
+    get_set_member_number = _coroutine('get_set_member_number')
+    get_locations = _coroutine('get_locations')
+
+
+class AsyncAlmaRecords(ThreadOffloadClient):
+    """Asyncio version of Alma_Apis_Records.AlmaRecords, run in threads
+    """
+    CLIENT = Alma_Apis_Records.AlmaRecords
+
+    get_holding = _coroutine('get_holding')
+    get_holdings_list = _coroutine('get_holdings_list')
+    set_holding = _coroutine('set_holding')
+    get_item_with_barcode = _coroutine('get_item_with_barcode')
+    get_item = _coroutine('get_item')
+    get_item_with_url = _coroutine('get_item_with_url')
+    set_item = _coroutine('set_item')
+    get_set_members_list = _coroutine('get_set_members_list')
+    get_set_member_number = _coroutine('get_set_member_number')
+    get_set_members = _coroutine('get_set_members')
+    get_record = _coroutine('get_record')
+    get_records = _coroutine('get_records')
+
+    async def get_items_by_barcodes(self, barcodes, ordered=True, accept='xml'):
+        """Async version of AlmaRecords.get_items_by_barcodes: at most concurrency calls in flight, each in
+        a thread of the client, barcodes read lazily and de-duplicated.
+
+        Yields:
+            tuple: barcode, status (Success or Error), item or error message
+        """
+        window = 2 * self.concurrency
+        pending = deque() if ordered else set()
+
+        async def get_item(barcode):
+            status, item = await self.run(self.client._get_item_by_barcode, barcode, accept)
+            return barcode, status, item
+
+        try:
+            for barcode in Alma_Apis_Concurrent.unique(str(barcode).strip() for barcode in barcodes):
+                task = asyncio.ensure_future(get_item(barcode))
+                if ordered:
+                    pending.append(task)
+                else:
+                    pending.add(task)
+                while len(pending) >= window:
+                    for result in await self._next_done(pending, ordered):
+                        yield result
+            while pending:
+                for result in await self._next_done(pending, ordered):
+                    yield result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    async def _next_done(pending, ordered):
+        if ordered:
+            return [await pending.popleft()]
+        done, not_done = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        pending.difference_update(done)
+        return [task.result() for task in done]
+
+
+class AsyncAlmaUsers(ThreadOffloadClient):
+    """Asyncio version of Alma_Apis_Users.AlmaUsers, run in threads
+    """
+    CLIENT = Alma_Apis_Users.AlmaUsers
+
+    retrieve_user_by_id = _coroutine('retrieve_user_by_id')
+    get_user = _coroutine('get_user')
+    delete_user = _coroutine('delete_user')
+    update_user = _coroutine('update_user')
+    get_user_requests = _coroutine('get_user_requests')
+    delete_user_request = _coroutine('delete_user_request')
+    update_user_request = _coroutine('update_user_request')
+
+
+class AsyncAlmaERecords(ThreadOffloadClient):
+    """Asyncio version of Alma_Apis_Ecollections.AlmaERecords, run in threads
+    """
+    CLIENT = Alma_Apis_Ecollections.AlmaERecords
+
+    get_eservice = _coroutine('get_eservice')
+    get_number_of_portfolios_for_eservice = _coroutine('get_number_of_portfolios_for_eservice')
+    get_portfolios_list = _coroutine('get_portfolios_list')
+    get_eservices_list = _coroutine('get_eservices_list')
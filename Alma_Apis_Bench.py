@@ -0,0 +1,765 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+# internal import
+try:
+    from . import Alma_Apis_Transport, Alma_Apis_Concurrent
+except ImportError:
+    import Alma_Apis_Transport, Alma_Apis_Concurrent
+
+
+XML_ERROR = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+             '<web_service_result xmlns="http://com/exlibris/urm/general/xmlbeans">'
+             '<errorsExist>true</errorsExist><errorList><error><errorCode>{code}</errorCode>'
+             '<errorMessage>{message}</errorMessage><trackingId>E01-BENCH</trackingId></error></errorList>'
+             '</web_service_result>')
+
+#Page d'erreur d'un proxy ou d'une passerelle devant les API, sans corps d'erreur Alma
+GATEWAY_ERROR = '<html><head><title>{status}</title></head><body><h1>{status}</h1><p>Service unavailable</p></body></html>'
+
+SRU_NS = 'http://www.loc.gov/zing/srw/'
+MARC_NS = 'http://www.loc.gov/MARC21/slim'
+
+#Bibliothèque des holdings des notices générées
+LIBRARY_ID = '1100000000'
+
+
+def error_body(code, message, fmt):
+    """Alma error answer in xml or json"""
+    if fmt == 'json':
+        return {'errorsExist': True,
+                'errorList': {'error': [{'errorCode': code, 'errorMessage': message, 'trackingId': 'E01-BENCH'}]},
+                'result': None}
+    return XML_ERROR.format(code=code, message=message)
+
+
+def barcode_path(barcode):
+    """Path (bib id, holding id, item id) of a generated barcode"""
+    number = re.sub(r'\D', '', barcode) or '0'
+    return '99{}'.format(number), '22{}'.format(number), '23{}'.format(number)
+
+
+def item(base, bib_id, holding_id, item_id, fmt):
+    barcode = 'B{}'.format(item_id[2:])
+    link = '{}/almaws/v1/bibs/{}/holdings/{}/items/{}'.format(base, bib_id, holding_id, item_id)
+    if fmt == 'json':
+        return {'link': link,
+                'bib_data': {'mms_id': bib_id, 'title': 'Titre {}'.format(bib_id)},
+                'holding_data': {'holding_id': holding_id},
+                'item_data': {'pid': item_id, 'barcode': barcode, 'description': ''}}
+    return ('<item link="{}"><bib_data><mms_id>{}</mms_id><title>Titre {}</title></bib_data>'
+            '<holding_data><holding_id>{}</holding_id></holding_data>'
+            '<item_data><pid>{}</pid><barcode>{}</barcode><description></description></item_data></item>').format(
+                link, bib_id, bib_id, holding_id, item_id, barcode)
+
+
+def holding(holding_id, fmt):
+    if fmt == 'json':
+        return {'holding_id': holding_id, 'anies': ['<record/>']}
+    return ('<holding><holding_id>{}</holding_id><record><leader>     nx  a22     1n 4500</leader>'
+            '<datafield ind1="0" ind2=" " tag="852"><subfield code="b">{}</subfield>'
+            '<subfield code="c">MAG</subfield></datafield></record></holding>').format(holding_id, LIBRARY_ID)
+
+
+def bib(mms_id, fmt):
+    if fmt == 'json':
+        return {'mms_id': mms_id, 'title': 'Titre {}'.format(mms_id), 'anies': ['<record/>']}
+    return ('<bib><mms_id>{0}</mms_id><title>Titre {0}</title><record><leader>     nam  22     4i 4500</leader>'
+            '<controlfield tag="001">{0}</controlfield><datafield ind1="1" ind2="0" tag="245">'
+            '<subfield code="a">Titre {0}</subfield></datafield></record></bib>').format(mms_id)
+
+
+def sru_record(mms_id, ppns, position):
+    identifiers = ''.join('<datafield ind1=" " ind2=" " tag="035"><subfield code="a">{}</subfield></datafield>'.format(ppn)
+                          for ppn in ppns)
+    return ('<record><recordSchema>marcxml</recordSchema><recordPacking>xml</recordPacking><recordData>'
+            '<record xmlns="{marc}"><controlfield tag="001">{mms_id}</controlfield>{identifiers}'
+            '<datafield ind1=" " ind2=" " tag="AVA"><subfield code="b">{library}</subfield>'
+            '<subfield code="8">22{number}</subfield></datafield></record></recordData>'
+            '<recordIdentifier>{mms_id}</recordIdentifier><recordPosition>{position}</recordPosition></record>').format(
+                marc=MARC_NS, mms_id=mms_id, identifiers=identifiers, library=LIBRARY_ID, number=mms_id[2:], position=position)
+
+
+class FakeAlmaHandler(BaseHTTPRequestHandler):
+    """Answers of the Alma APIs used by the clients, built from the ids of the urls"""
+    protocol_version = 'HTTP/1.1'
+    #Headers and body are written separately: without this, delayed ACKs add 40 ms to every call
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        ('GET', r'/view/sru/[^/]+', 'sru'),
+        ('GET', r'/almaws/v1/items', 'item_by_barcode'),
+        ('GET', r'/almaws/v1/bibs', 'bibs'),
+        ('GET|PUT', r'/almaws/v1/bibs/(?P<bib_id>[^/]+)/holdings/(?P<holding_id>[^/]+)/items/(?P<item_id>[^/]+)', 'item'),
+        ('GET|PUT', r'/almaws/v1/bibs/(?P<bib_id>[^/]+)/holdings/(?P<holding_id>[^/]+)', 'holding'),
+        ('GET', r'/almaws/v1/bibs/(?P<bib_id>[^/]+)/holdings', 'holdings'),
+        ('GET', r'/almaws/v1/bibs/(?P<bib_id>[^/]+)', 'bib'),
+        ('GET|POST', r'/almaws/v1/conf/sets', 'sets'),
+        ('GET', r'/almaws/v1/conf/sets/(?P<set_id>[^/]+)/members', 'set_members'),
+        ('GET|POST|DELETE', r'/almaws/v1/conf/sets/(?P<set_id>[^/]+)', 'set'),
+        ('POST', r'/almaws/v1/conf/jobs/(?P<job_id>[^/]+)', 'run_job'),
+        ('GET', r'/almaws/v1/conf/jobs/(?P<job_id>[^/]+)/instances/(?P<instance_id>[^/]+)', 'job_instance'),
+        ('GET', r'/almaws/v1/conf/libraries/(?P<library_id>[^/]+)/locations', 'locations'),
+        ('GET', r'/almaws/v1/users', 'users'),
+        ('GET|PUT|DELETE', r'/almaws/v1/users/(?P<user_id>[^/]+)', 'user'),
+        ('GET', r'/almaws/v1/users/(?P<user_id>[^/]+)/requests', 'user_requests'),
+        ('PUT|DELETE', r'/almaws/v1/users/(?P<user_id>[^/]+)/requests/(?P<request_id>[^/]+)', 'user_request'),
+        ('GET', r'/almaws/v1/electronic/e-collections/(?P<ecollection_id>[^/]+)/e-services', 'eservices'),
+        ('GET', r'/almaws/v1/electronic/e-collections/(?P<ecollection_id>[^/]+)/e-services/(?P<eservice_id>[^/]+)', 'eservice'),
+        ('GET', r'/almaws/v1/electronic/e-collections/(?P<ecollection_id>[^/]+)/e-services/(?P<eservice_id>[^/]+)/portfolios',
+         'portfolios'),
+    ]
+    ROUTES = [(methods.split('|'), re.compile(pattern + '/?$'), name) for methods, pattern, name in ROUTES]
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.fmt = 'json' if 'json' in self.headers.get('Accept', '') else 'xml'
+        self.base = 'http://{}:{}'.format(*self.server.server_address[:2])
+        fake.wait()
+        injected = fake.inject()
+        if injected == 429:
+            return self.answer(429, error_body('PER_SECOND_THRESHOLD', 'Daily/per second threshold exceeded', self.fmt),
+                               {'Retry-After': '0'})
+        if injected == 'error' or any(re.search(failure, self.path) for failure in fake.failures):
+            return self.answer(fake.error_status, error_body('GENERAL_ERROR', 'Injected error', self.fmt))
+        if any(re.search(failure, self.path) for failure in fake.gateway_failures):
+            return self.answer(fake.error_status, GATEWAY_ERROR.format(status=fake.error_status), content_type='text/html')
+        self.users = None
+        if fake.institutions is not None:
+            self.users = fake.institutions.get(self.headers.get('Authorization', '').replace('apikey ', '', 1), ())
+            if isinstance(self.users, int):
+                return self.answer(self.users, error_body('GENERAL_ERROR', 'Institution unavailable', self.fmt))
+        for methods, pattern, name in self.ROUTES:
+            match = pattern.match(url.path)
+            if match is not None and self.command in methods:
+                fake.count(name)
+                return getattr(self, 'route_' + name)(**match.groupdict())
+        fake.count('unknown')
+        self.answer(400, error_body('402204', 'Unknown route {} {}'.format(self.command, url.path), self.fmt))
+
+    do_PUT = do_POST = do_DELETE = do_GET
+
+    def answer(self, status, content=None, headers=None, content_type=None):
+        if isinstance(content, (dict, list)):
+            body, content_type = json.dumps(content).encode('utf-8'), 'application/json'
+        else:
+            body = (content or '').encode('utf-8')
+            if content_type is None:
+                content_type = 'text/xml' if self.path.startswith('/view/sru') else 'application/xml'
+        self.send_response(status)
+        self.send_header('Content-Type', '{};charset=UTF-8'.format(content_type))
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def echo(self):
+        """Answer of a PUT: the document sent"""
+        if self.fmt == 'json':
+            return self.answer(200, json.loads(self.body.decode('utf-8') or '{}'))
+        self.answer(200, self.body.decode('utf-8'))
+
+    def route_item_by_barcode(self):
+        bib_id, holding_id, item_id = barcode_path(self.query.get('item_barcode', ''))
+        #Alma redirects to the item url
+        self.answer(302, '', {'Location': '/almaws/v1/bibs/{}/holdings/{}/items/{}'.format(bib_id, holding_id, item_id)})
+
+    def route_item(self, bib_id, holding_id, item_id):
+        #An item is only found at its own path, the one of its barcode
+        if barcode_path(item_id[2:])[:2] != (bib_id, holding_id):
+            return self.answer(400, error_body('GENERAL_ERROR', 'No item {} in holding {} of record {}'.format(
+                item_id, holding_id, bib_id), self.fmt))
+        if self.command == 'PUT':
+            if self.fmt == 'xml' and not self.body.lstrip().startswith(b'<item'):
+                return self.answer(400, error_body('GENERAL_ERROR', 'Invalid item', self.fmt))
+            return self.echo()
+        self.answer(200, item(self.base, bib_id, holding_id, item_id, self.fmt))
+
+    def route_holding(self, bib_id, holding_id):
+        if self.command == 'PUT':
+            return self.echo()
+        self.answer(200, holding(holding_id, self.fmt))
+
+    def route_holdings(self, bib_id):
+        holding_id = '22{}'.format(bib_id[2:])
+        if self.fmt == 'json':
+            return self.answer(200, {'holding': [{'holding_id': holding_id, 'library': {'value': LIBRARY_ID}}],
+                                     'total_record_count': 1})
+        self.answer(200, '<holdings total_record_count="1"><holding><holding_id>{}</holding_id>'
+                         '<library>{}</library></holding></holdings>'.format(holding_id, LIBRARY_ID))
+
+    def route_bib(self, bib_id):
+        if bib_id in self.server.fake.missing_records:
+            return self.answer(400, error_body('402203', 'Input parameters mmsId {} is not valid.'.format(bib_id), self.fmt))
+        self.answer(200, bib(bib_id, self.fmt))
+
+    def route_bibs(self):
+        #Unknown records are left out of the answer
+        mms_ids = [mms_id for mms_id in self.query.get('mms_id', '').split(',')
+                   if mms_id and mms_id not in self.server.fake.missing_records]
+        if self.fmt == 'json':
+            return self.answer(200, {'bib': [bib(mms_id, 'json') for mms_id in mms_ids], 'total_record_count': len(mms_ids)})
+        self.answer(200, '<bibs total_record_count="{}">{}</bibs>'.format(
+            len(mms_ids), ''.join(bib(mms_id, 'xml') for mms_id in mms_ids)))
+
+    def route_sets(self):
+        if self.command == 'POST':
+            data = json.loads(self.body.decode('utf-8') or '{}')
+            return self.answer(200, dict(data, id=str(self.server.fake.new_id()), number_of_members={'value': 0}))
+        self.answer(200, {'set': [{'id': '9001', 'name': self.query.get('q', '')}], 'total_record_count': 1})
+
+    def route_set(self, set_id):
+        fake = self.server.fake
+        if self.command == 'DELETE':
+            return self.answer(204)
+        if self.command == 'POST':
+            data = json.loads(self.body.decode('utf-8') or '{}')
+            added = len(data.get('members', {}).get('member', []))
+            with fake.lock:
+                fake.set_members[set_id] = fake.set_members.get(set_id, 0) + added
+            data.pop('members', None)
+            return self.answer(200, dict(data, id=set_id, number_of_members={'value': fake.set_members[set_id]}))
+        self.answer(200, {'id': set_id, 'name': 'Jeu {}'.format(set_id), 'type': {'value': 'ITEMIZED'},
+                          'content': {'value': 'ITEM'},
+                          'number_of_members': {'value': fake.set_members.get(set_id, fake.set_size)}})
+
+    def route_set_members(self, set_id):
+        fake = self.server.fake
+        total = fake.set_members.get(set_id, fake.set_size)
+        offset, limit = int(self.query.get('offset', 0)), int(self.query.get('limit', 10))
+        members = [{'id': '23{}'.format(n),
+                    'description': 'Exemplaire {}'.format(n),
+                    'link': '{}/almaws/v1/bibs/99{n}/holdings/22{n}/items/23{n}'.format(self.base, n=n)}
+                   for n in range(offset, min(offset + limit, total))]
+        self.answer(200, {'member': members, 'total_record_count': total})
+
+    def route_run_job(self, job_id):
+        instance_id = str(self.server.fake.new_id())
+        with self.server.fake.lock:
+            self.server.fake.jobs[instance_id] = time.monotonic()
+        self.answer(200, {'id': job_id, 'additional_info': {
+            'value': 'Job no. {} triggered'.format(instance_id),
+            'link': '{}/almaws/v1/conf/jobs/{}/instances/{}'.format(self.base, job_id, instance_id)}})
+
+    def route_job_instance(self, job_id, instance_id):
+        fake = self.server.fake
+        started = fake.jobs.get(instance_id)
+        if started is None:
+            return self.answer(400, error_body('402880', 'Job instance {} not found'.format(instance_id), self.fmt))
+        progress = min(100, int(100 * (time.monotonic() - started) / fake.job_duration)) if fake.job_duration else 100
+        status = 'COMPLETED_SUCCESS' if progress >= 100 else ('QUEUED' if progress < 10 else 'RUNNING')
+        self.answer(200, {'id': instance_id, 'progress': progress, 'status': {'value': status},
+                          'counter': [{'type': {'value': 'label.updated', 'desc': 'Updated'}, 'value': '0'}]})
+
+    def route_locations(self, library_id):
+        self.answer(200, {'location': [{'name': 'Magasin {}'.format(n), 'code': 'MAG{}'.format(n)} for n in range(20)],
+                          'total_record_count': 20})
+
+    def route_users(self):
+        user_id = self.query.get('q', '').split('~')[-1]
+        if self.users is not None and user_id not in self.users:
+            return self.answer(200, {'total_record_count': 0})
+        self.answer(200, {'user': [{'primary_id': user_id}], 'total_record_count': 1})
+
+    def route_user(self, user_id):
+        if self.users is not None and user_id not in self.users:
+            return self.answer(400, error_body('401861', 'User with identifier {} was not found.'.format(user_id), self.fmt))
+        if self.command == 'PUT':
+            return self.echo()
+        if self.command == 'DELETE':
+            return self.answer(204)
+        if self.fmt == 'json':
+            return self.answer(200, {'primary_id': user_id, 'first_name': 'Lecteur', 'last_name': user_id,
+                                     'user_group': {'value': 'ETU'}})
+        self.answer(200, '<user><primary_id>{0}</primary_id><first_name>Lecteur</first_name>'
+                         '<last_name>{0}</last_name><user_group>ETU</user_group></user>'.format(user_id))
+
+    def route_user_requests(self, user_id):
+        request_type = self.query.get('request_type', 'HOLD')
+        total = self.server.fake.user_requests
+        if isinstance(total, dict):
+            total = total.get(request_type, 0)
+        offset, limit = int(self.query.get('offset', 0)), int(self.query.get('limit', 10))
+        requests_list = [{'request_id': '{}-{}'.format(request_type, n), 'request_type': request_type,
+                          'mms_id': '99{}'.format(n), 'request_status': 'NOT_STARTED'}
+                         for n in range(offset, min(offset + limit, total))]
+        #Alma omits the list when there is no request
+        answer = {'user_request': requests_list} if requests_list else {}
+        self.answer(200, dict(answer, total_record_count=total))
+
+    def route_user_request(self, user_id, request_id):
+        if self.command == 'PUT':
+            return self.echo()
+        self.answer(204)
+
+    def route_eservices(self, ecollection_id):
+        portfolios = self.server.fake.portfolios
+        if not isinstance(portfolios, dict):
+            portfolios = {'61{}'.format(n): portfolios for n in range(3)}
+        services = [{'id': eservice_id, 'portfolios': {'value': total}} for eservice_id, total in portfolios.items()]
+        self.answer(200, {'electronic_service': services, 'total_record_count': len(services)})
+
+    def eservice_portfolios(self, eservice_id):
+        portfolios = self.server.fake.portfolios
+        return portfolios.get(eservice_id, 0) if isinstance(portfolios, dict) else portfolios
+
+    def route_eservice(self, ecollection_id, eservice_id):
+        self.answer(200, {'id': eservice_id, 'portfolios': {'value': self.eservice_portfolios(eservice_id)}})
+
+    def route_portfolios(self, ecollection_id, eservice_id):
+        total = self.eservice_portfolios(eservice_id)
+        offset, limit = int(self.query.get('offset', 0)), int(self.query.get('limit', 10))
+        portfolios = [{'id': '{}-{}'.format(eservice_id, n), 'resource_metadata': {'mms_id': {'value': '99{}'.format(n)},
+                                                                      'title': 'Titre {}'.format(n)}}
+                      for n in range(offset, min(offset + limit, total))]
+        self.answer(200, {'portfolio': portfolios, 'total_record_count': total})
+
+    def route_sru(self):
+        query = self.query.get('query', '')
+        ppns = re.findall(r'\(PPN\)\w+', query)
+        start = int(self.query.get('startRecord', 1))
+        maximum = int(self.query.get('maximumRecords', 10))
+        catalog = self.server.fake.catalog
+        if ppns and catalog is not None:
+            found = [(mms_id, identifiers) for mms_id, identifiers in catalog.items() if set(ppns).intersection(identifiers)]
+        elif ppns:
+            #One record by searched ppn
+            found = [('99{}'.format(re.sub(r'\D', '', ppn) or '0'), [ppn]) for ppn in ppns]
+        else:
+            found = None
+        total = len(found) if found is not None else self.server.fake.sru_records
+        positions = range(start, min(start + maximum, total + 1))
+        records = ''.join(sru_record(*(found[position - 1] if found is not None
+                                       else ('99{}'.format(position), ['(PPN){:09d}'.format(position)])), position)
+                          for position in positions)
+        next_position = ('<nextRecordPosition>{}</nextRecordPosition>'.format(start + maximum)
+                         if start + maximum <= total else '')
+        self.answer(200, '<?xml version="1.0" encoding="UTF-8"?><searchRetrieveResponse xmlns="{}">'
+                         '<version>1.2</version><numberOfRecords>{}</numberOfRecords><records>{}</records>{}'
+                         '</searchRetrieveResponse>'.format(SRU_NS, total, records, next_position))
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        #Clients closing their kept-alive connections at the end of a scenario
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(_HTTPServer, self).handle_error(request, client_address)
+
+
+class FakeAlmaServer(object):
+    """Local stand-in of the Alma APIs and SRU, for benchmarks and tests without network.
+
+    It answers every resource of the clients with documents built from the ids of the urls,
+    after latency (+ random jitter) seconds. A share of the calls can be answered by a 429
+    (throttle_rate) or by an Alma error body with error_status (error_rate).
+    Point the clients at it with endpoint=server.url.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 error_status=500, failures=(), gateway_failures=(), missing_records=(), set_size=1000, portfolios=1000, user_requests=250, sru_records=500, catalog=None,
+                 institutions=None, job_duration=1.0, seed=None):
+        """
+        Keyword Arguments:
+            host {str} -- listening address (default: {'127.0.0.1'})
+            port {int} -- listening port, 0 for a free one (default: {0})
+            latency {float} -- seconds before every answer (default: {0.0})
+            jitter {float} -- maximum random seconds added to latency (default: {0.0})
+            error_rate {float} -- share of the calls answered by an error (default: {0.0})
+            throttle_rate {float} -- share of the calls answered by a 429 (default: {0.0})
+            error_status {int} -- HTTP status of the injected errors (default: {500})
+            failures {list} -- regular expressions of the urls always answered by an error (default: {()})
+            gateway_failures {list} -- regular expressions of the urls always answered by the HTML error page of
+                a gateway, with error_status (default: {()})
+            missing_records {list} -- mms ids of the records unknown to the server (default: {()})
+            set_size {int} -- number of members of the sets (default: {1000})
+            portfolios {int or dict} -- number of portfolios of the 3 e-services of the e-collections, or
+                e-service id -> number of portfolios (default: {1000})
+            user_requests {int or dict} -- number of requests of each request type of the users, or request
+                type -> number of requests (default: {250})
+            sru_records {int} -- number of records of the SRU queries without ppn (default: {500})
+            catalog {dict} -- mms_id -> 035 values of the records found by the SRU queries on ppn, by
+                default one record by ppn (default: {None})
+            institutions {dict} -- API key -> user ids of its institution, or HTTP status of the error answered
+                to every call with the key. By default every user exists everywhere (default: {None})
+            job_duration {float} -- seconds before a job instance is completed (default: {1.0})
+            seed {int} -- seed of the random injections (default: {None})
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.error_status = error_status
+        self.failures = list(failures)
+        self.gateway_failures = list(gateway_failures)
+        self.missing_records = set(missing_records)
+        self.set_size = set_size
+        self.portfolios = portfolios
+        self.user_requests = user_requests
+        self.sru_records = sru_records
+        self.catalog = catalog
+        self.institutions = institutions
+        self.job_duration = job_duration
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.set_members = {}
+        self.jobs = {}
+        self._next_id = 1000
+        self.httpd = _HTTPServer((host, port), FakeAlmaHandler)
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.httpd.server_address[:2])
+
+    def config(self):
+        return {'latency': self.latency, 'jitter': self.jitter, 'error_rate': self.error_rate,
+                'throttle_rate': self.throttle_rate, 'error_status': self.error_status}
+
+    def wait(self):
+        with self.lock:
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+    def inject(self):
+        """429, 'error' or None for the current call"""
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 'error'
+        return None
+
+    def count(self, route):
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+    def new_id(self):
+        with self.lock:
+            self._next_id += 1
+            return self._next_id
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='FakeAlmaServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def percentile(values, q):
+    """q percentile of sorted values, by nearest rank"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+
+
+class Bench(object):
+    """Benchmark scenarios of the clients against a FakeAlmaServer.
+
+    Each scenario gets its own transport, with the default retry policy and without
+    rate limiting: the token bucket would cap every scenario at the Alma rate. The latency
+    of every HTTP call is taken from a metrics hook of the transport.
+    """
+    APIKEY = 'l8xxbench'
+
+    def __init__(self, server, calls=200, workers=8):
+        """
+        Arguments:
+            server {FakeAlmaServer} -- started server
+
+        Keyword Arguments:
+            calls {int} -- calls of the single call scenarios, records of the bulk ones (default: {200})
+            workers {int} -- concurrency (default: {8})
+        """
+        self.server = server
+        self.calls = calls
+        self.workers = workers
+        self.logger = logging.getLogger('AlmaBench')
+
+    @staticmethod
+    def scenarios():
+        return sorted(name[len('scenario_'):] for name in dir(Bench) if name.startswith('scenario_'))
+
+    def run(self, names=None):
+        """Run scenarios
+
+        Keyword Arguments:
+            names {list} -- scenarios to run, all of them by default (default: {None})
+
+        Returns:
+            dict -- scenario -> items, calls, errors, duration, throughput and latencies of the calls
+        """
+        results = {}
+        for name in names or self.scenarios():
+            results[name] = self.run_scenario(name)
+            self.logger.info("Bench :: {} :: {}".format(name, results[name]))
+        return results
+
+    def run_scenario(self, name):
+        transport = Alma_Apis_Transport.AlmaTransport(pool_maxsize=max(10, 2 * self.workers), rate_limit=False,
+                                                      service='AlmaBench')
+        latencies, errors = [], [0]
+        lock = threading.Lock()
+
+        def record(httpmethod, resource, url, status, latency, answer):
+            with lock:
+                latencies.append(latency)
+                if not isinstance(status, int) or status >= 400:
+                    errors[0] += 1
+
+        transport.metrics.add_hook(post=record)
+        start, aborted = time.monotonic(), None
+        try:
+            items, failed = getattr(self, 'scenario_' + name)(transport)
+        except Exception as error:
+            #Paginators stop on the first page in error
+            self.logger.error("Bench :: {} :: {}".format(name, error))
+            items, failed, aborted = 0, 0, str(error)
+        finally:
+            duration = time.monotonic() - start
+            transport.close()
+        latencies.sort()
+        retry = transport.retry.stats() if transport.retry is not None else {}
+        return {'items': items,
+                'failed_items': failed,
+                'calls': len(latencies),
+                'http_errors': errors[0],
+                'retries': retry.get('retries', 0),
+                'duration': round(duration, 4),
+                'throughput': round(items / duration, 2) if duration else 0.0,
+                'p50': round(percentile(latencies, 0.5), 5),
+                'p99': round(percentile(latencies, 0.99), 5),
+                'mean': round(sum(latencies) / len(latencies), 5) if latencies else 0.0,
+                'aborted': aborted}
+
+    #Clients, importés à la demande : leurs modules dépendent de mail et logs
+    def records(self, transport):
+        try:
+            from . import Alma_Apis_Records
+        except ImportError:
+            import Alma_Apis_Records
+        return Alma_Apis_Records.AlmaRecords(apikey=self.APIKEY, service='AlmaBench', transport=transport,
+                                             endpoint=self.server.url)
+
+    def users(self, transport):
+        try:
+            from . import Alma_Apis_Users
+        except ImportError:
+            import Alma_Apis_Users
+        return Alma_Apis_Users.AlmaUsers(apikey=self.APIKEY, service='AlmaBench', transport=transport,
+                                         endpoint=self.server.url)
+
+    def erecords(self, transport):
+        try:
+            from . import Alma_Apis_Ecollections
+        except ImportError:
+            import Alma_Apis_Ecollections
+        return Alma_Apis_Ecollections.AlmaERecords(apikey=self.APIKEY, service='AlmaBench', transport=transport,
+                                                   endpoint=self.server.url)
+
+    def alma(self, transport):
+        try:
+            from . import Alma_Apis
+        except ImportError:
+            import Alma_Apis
+        return Alma_Apis.Alma(apikey=self.APIKEY, service='AlmaBench', transport=transport, endpoint=self.server.url)
+
+    def sru(self, transport):
+        try:
+            from . import Alma_Sru
+        except ImportError:
+            import Alma_Sru
+        return Alma_Sru.AlmaSru(service='AlmaBench', transport=transport, endpoint=self.server.url)
+
+    def _single_calls(self, call):
+        """Run call(n) for n in range(calls) with workers threads"""
+        def safe_call(n):
+            try:
+                return call(n)
+            except Exception as error:
+                return 'Error', str(error)
+
+        failed = 0
+        for n, (status, content) in Alma_Apis_Concurrent.imap(safe_call, range(self.calls), max_workers=self.workers,
+                                                              ordered=False):
+            failed += status != 'Success'
+        return self.calls, failed
+
+    def scenario_get_holding(self, transport):
+        api = self.records(transport)
+        return self._single_calls(lambda n: api.get_holding('99{}'.format(n), '22{}'.format(n)))
+
+    def scenario_get_item_with_barcode(self, transport):
+        api = self.records(transport)
+        return self._single_calls(lambda n: api.get_item_with_barcode('B{}'.format(n)))
+
+    def scenario_get_record(self, transport):
+        api = self.records(transport)
+        return self._single_calls(lambda n: api.get_record('99{}'.format(n)))
+
+    def scenario_get_user(self, transport):
+        api = self.users(transport)
+        return self._single_calls(lambda n: api.get_user('U{}'.format(n), accept='json'))
+
+    def scenario_sru_request(self, transport):
+        api = self.sru(transport)
+        return self._single_calls(lambda n: ('Success', api.sru_request('(PPN){:09d}'.format(n),
+                                                                        index='alma.other_system_number')))
+
+    def scenario_iter_set_members(self, transport):
+        api = self.records(transport)
+        return sum(1 for member in api.iter_set_members('9001', prefetch=self.workers)), 0
+
+    def scenario_iter_portfolios(self, transport):
+        api = self.erecords(transport)
+        return sum(1 for portfolio in api.iter_portfolios('600', '610', max_workers=self.workers)), 0
+
+    def scenario_iter_user_requests(self, transport):
+        api = self.users(transport)
+        request_types = ('HOLD', 'DIGITIZATION', 'BOOKING')
+        return sum(1 for user_request in api.iter_user_requests('U1', request_types=request_types,
+                                                                max_workers=self.workers)), 0
+
+    def scenario_sru_search_iter(self, transport):
+        api = self.sru(transport)
+        return sum(1 for record in api.sru_search_iter('alma.all_for_ui=bench', complex_query=True)), 0
+
+    def scenario_get_records(self, transport):
+        api = self.records(transport)
+        results, missing = api.get_records(['99{}'.format(n) for n in range(self.calls)], max_workers=self.workers)
+        return self.calls, len(missing) + sum(status != 'Success' for status, record in results.values())
+
+    def scenario_get_items_by_barcodes(self, transport):
+        api = self.records(transport)
+        failed = sum(status != 'Success' for barcode, status, item in
+                     api.get_items_by_barcodes(('B{}'.format(n) for n in range(self.calls)), max_workers=self.workers))
+        return self.calls, failed
+
+    def scenario_holdings_pipeline(self, transport):
+        try:
+            from . import Alma_Apis_Pipeline
+        except ImportError:
+            import Alma_Apis_Pipeline
+        api = self.records(transport)
+        pipeline = Alma_Apis_Pipeline.holdings_pipeline(api, lambda ids, holding: holding.replace('MAG', 'RES'),
+                                                        read_workers=self.workers, write_workers=self.workers)
+        failed = sum(status != 'Success' for ids, status, content in
+                     pipeline.run(('99{}'.format(n), '22{}'.format(n)) for n in range(self.calls)))
+        return self.calls, failed
+
+    def scenario_cancel_user_requests(self, transport):
+        try:
+            from . import Alma_Apis_Bulk
+        except ImportError:
+            import Alma_Apis_Bulk
+        rows = ({'user_id': 'U{}'.format(n), 'request_id': str(n), 'reason': ''} for n in range(self.calls))
+        counters = Alma_Apis_Bulk.cancel_user_requests(self.users(transport), rows, max_workers=self.workers,
+                                                       report_every=self.calls + 1)
+        return self.calls, counters.get('Error', 0)
+
+    def scenario_bulk_update_job(self, transport):
+        try:
+            from . import Alma_Apis_Bulk
+        except ImportError:
+            import Alma_Apis_Bulk
+        update = Alma_Apis_Bulk.BulkUpdate(self.alma(transport), 'M38', 'ITEM', threshold=None,
+                                           min_interval=0.1, max_interval=1)
+        results, report = update.run('23{}'.format(n) for n in range(self.calls))
+        return self.calls, sum(status != 'Success' for status, message in results.values())
+
+
+def compare(results, previous):
+    """Lines comparing the throughput and p99 of two benchmark results"""
+    lines = []
+    for name, stats in sorted(results['scenarios'].items()):
+        before = previous.get('scenarios', {}).get(name)
+        if before is None or not before['throughput']:
+            continue
+        lines.append('{:<28} throughput x{:.2f}  p99 {:.4f} -> {:.4f}'.format(
+            name, stats['throughput'] / before['throughput'], before['p99'], stats['p99']))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark des clients Alma sur un serveur Alma local simulé")
+    parser.add_argument('--output', help="fichier JSON des résultats")
+    parser.add_argument('--label', default='', help="libellé des résultats, e.g. la version testée")
+    parser.add_argument('--scenario', action='append', choices=Bench.scenarios(), help="scénario à exécuter, tous par défaut")
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compare', help="résultats JSON d'une exécution précédente")
+    parser.add_argument('--serve', type=int, metavar='PORT', help="lancer uniquement le serveur simulé sur PORT")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    server = FakeAlmaServer(port=args.serve or 0, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            throttle_rate=args.throttle_rate, seed=args.seed)
+    if args.serve:
+        print("Serveur Alma simulé sur {}".format(server.url))
+        try:
+            server.httpd.serve_forever()
+        except KeyboardInterrupt:
+            server.httpd.server_close()
+        return 0
+    with server:
+        scenarios = Bench(server, calls=args.calls, workers=args.workers).run(args.scenario)
+    results = {'label': args.label,
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': sys.version.split()[0],
+               'platform': platform.platform(),
+               'server': server.config(),
+               'calls': args.calls,
+               'workers': args.workers,
+               'scenarios': scenarios}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+    for name, stats in sorted(scenarios.items()):
+        print('{:<28} {:>10.1f}/s  p50 {:.4f}  p99 {:.4f}  calls {}  errors {}'.format(
+            name, stats['throughput'], stats['p50'], stats['p99'], stats['calls'], stats['http_errors']))
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as previous_file:
+            print('\n'.join(compare(results, json.load(previous_file))))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+# internal import
+try:
+    from . import Alma_Apis_Concurrent, Alma_Apis_Jobs
+except ImportError:
+    import Alma_Apis_Concurrent, Alma_Apis_Jobs
+
+
+class BulkRunner(object):
+    """Run a function on many rows in a bounded pool of threads.
+
+    Each outcome is appended to a CSV results file as soon as it is known, so that an
+    interrupted run can be resumed: rows already in the results file with a Success status
+    are skipped. The throughput is logged every report_every rows.
+    """
+    RESULT_FIELDS = ['status', 'message', 'duration', 'date']
+
+    def __init__(self, func, fields, key_fields=None, max_workers=8, results_path=None, dry_run=False,
+                 report_every=100, service='AlmaPy'):
+        """
+        Arguments:
+            func {callable} -- called with a row (dict), returns (status, message)
+            fields {list} -- columns of the rows
+
+        Keyword Arguments:
+            key_fields {list} -- columns identifying a row in the results file, all of them by default (default: {None})
+            max_workers {int} -- maximum number of rows processed at once (default: {8})
+            results_path {str} -- CSV results file (default: {None})
+            dry_run {bool} -- do not call func, only report what would be done (default: {False})
+            report_every {int} -- log the throughput every report_every rows (default: {100})
+            service {str} -- logger name (default: {'AlmaPy'})
+        """
+        self.func = func
+        self.fields = list(fields)
+        self.key_fields = list(key_fields or fields)
+        self.max_workers = max_workers
+        self.results_path = results_path
+        self.dry_run = dry_run
+        self.report_every = report_every
+        self.logger = logging.getLogger(service)
+
+    def key(self, row):
+        return tuple(str(row.get(field, '')) for field in self.key_fields)
+
+    def done_keys(self):
+        """Keys of the rows already processed with success by a previous run"""
+        if self.results_path is None or not os.path.exists(self.results_path):
+            return set()
+        with open(self.results_path, newline='', encoding='utf-8') as results_file:
+            return {self.key(row) for row in csv.DictReader(results_file) if row['status'] == 'Success'}
+
+    def _call(self, row):
+        start = time.monotonic()
+        if self.dry_run:
+            status, message = 'DryRun', ''
+        else:
+            try:
+                status, message = self.func(row)
+            except Exception as error:
+                self.logger.error("BulkRunner :: {} :: {}".format(self.key(row), error))
+                status, message = 'Error', str(error)
+        return status, message, time.monotonic() - start
+
+    def run(self, rows):
+        """Process rows
+
+        Arguments:
+            rows {iterable} -- rows (dict)
+
+        Returns:
+            dict -- counters by status, skipped rows, duration and rows per second
+        """
+        done_keys = self.done_keys()
+        counters = {'skipped': 0}
+
+        def todo():
+            for row in rows:
+                if self.key(row) in done_keys:
+                    counters['skipped'] += 1
+                else:
+                    yield row
+
+        count = 0
+        start = time.monotonic()
+        results_file = None
+        if self.results_path is not None:
+            exists = os.path.exists(self.results_path) and os.path.getsize(self.results_path) > 0
+            results_file = open(self.results_path, 'a', newline='', encoding='utf-8')
+            writer = csv.DictWriter(results_file, fieldnames=self.fields + self.RESULT_FIELDS, extrasaction='ignore')
+            if not exists:
+                writer.writeheader()
+        try:
+            for row, (status, message, duration) in Alma_Apis_Concurrent.imap(self._call, todo(), max_workers=self.max_workers,
+                                                                               ordered=False):
+                count += 1
+                counters[status] = counters.get(status, 0) + 1
+                if results_file is not None:
+                    writer.writerow(dict(row, status=status, message=message, duration='{:.3f}'.format(duration),
+                                         date=time.strftime('%Y-%m-%d %H:%M:%S')))
+                    results_file.flush()
+                if count % self.report_every == 0:
+                    self.logger.info("BulkRunner :: {} lignes traitées || {:.1f} lignes/s || {}".format(
+                        count, count / (time.monotonic() - start), counters))
+        finally:
+            if results_file is not None:
+                results_file.close()
+        elapsed = time.monotonic() - start
+        counters.update({'processed': count, 'duration': elapsed, 'rate': count / elapsed if elapsed else 0.0})
+        self.logger.info("BulkRunner :: fin || {}".format(counters))
+        return counters
+
+
+CANCEL_FIELDS = ['user_id', 'request_id', 'reason']
+
+
+def cancel_user_requests(api, rows, results_path=None, max_workers=8, dry_run=False, notify_user='false',
+                         default_reason='CancelledAtPatronRequest', report_every=100):
+    """Cancel many user requests
+
+    Arguments:
+        api {AlmaUsers} -- users client
+        rows {iterable} -- dict with user_id, request_id and optionally reason
+
+    Keyword Arguments:
+        results_path {str} -- CSV results file, used to resume an interrupted run (default: {None})
+        max_workers {int} -- maximum number of cancellations at once (default: {8})
+        dry_run {bool} -- do not cancel anything (default: {False})
+        notify_user {str} -- notify the requester (default: {'false'})
+        default_reason {str} -- reason of the rows without one (default: {'CancelledAtPatronRequest'})
+        report_every {int} -- log the throughput every report_every rows (default: {100})
+
+    Returns:
+        dict -- counters by status, skipped rows, duration and rows per second
+    """
+    def cancel(row):
+        status, response = api.delete_user_request(row['user_id'], row['request_id'],
+                                                   reason=row.get('reason') or default_reason,
+                                                   notify_user=notify_user)
+        return status, response.status_code if status == 'Success' else response
+
+    runner = BulkRunner(cancel, CANCEL_FIELDS, key_fields=['user_id', 'request_id'], max_workers=max_workers,
+                        results_path=results_path, dry_run=dry_run, report_every=report_every, service=api.service)
+    return runner.run(rows)
+
+
+class BulkJobError(Exception):
+    """Error raised when the job of a BulkUpdate was launched but not seen finished: its set is kept
+    """
+
+    def __init__(self, job_id, set_id, instance_id, error):
+        super(BulkJobError, self).__init__("Traitement {} instance {} sur le jeu {} :: {}".format(
+            job_id, instance_id, set_id, error))
+        self.job_id = job_id
+        self.set_id = set_id
+        self.instance_id = instance_id
+
+
+class BulkJobTimeoutError(BulkJobError, TimeoutError):
+    """The job of a BulkUpdate is still running after the timeout"""
+
+
+class BulkUpdate(object):
+    """Update many records, with one Alma job on a set above a threshold, with concurrent PUTs below.
+
+    Above threshold, the ids are put in a new itemized set and job_id is run on it. Job
+    reports only have counters: every member of the set gets the outcome of the job
+    (Success, Warning or Error with the counters and alerts), and the ids rejected by
+    the set get an Error. Below threshold, put is called on every id in a pool of threads.
+    """
+
+    def __init__(self, alma, job_id, content_type, put=None, job_parameters=(), threshold=1000, max_workers=8,
+                 timeout=6 * 3600, min_interval=2, max_interval=60, keep_set=False):
+        """
+        Arguments:
+            alma {Alma} -- client of the sets and jobs APIs
+            job_id {str} -- id of the job applied to the set (e.g. M38 Change Physical items information)
+            content_type {str} -- content of the set: ITEM, BIB_MMS...
+
+        Keyword Arguments:
+            put {callable} -- put(record_id) -> (status, content), the update of one record (default: {None})
+            job_parameters {list} -- (name, value) parameters of the job, set_id is added (default: {()})
+            threshold {int} -- minimum number of records updated by a job, None to always use the job (default: {1000})
+            max_workers {int} -- maximum number of PUTs at once (default: {8})
+            timeout {float} -- maximum duration of the job in seconds (default: {6 hours})
+            min_interval {float} -- shortest delay between two reads of the job instance (default: {2})
+            max_interval {float} -- longest delay between two reads of the job instance (default: {60})
+            keep_set {bool} -- never delete the set. Otherwise the set is deleted once the job is finished, or
+                if the job could not be launched, and kept while the job may still run on it (default: {False})
+        """
+        self.alma = alma
+        self.job_id = job_id
+        self.content_type = content_type
+        self.put = put
+        self.job_parameters = list(job_parameters)
+        self.threshold = threshold
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.keep_set = keep_set
+        self.logger = logging.getLogger(alma.service)
+
+    def run(self, record_ids):
+        """Update records
+
+        Arguments:
+            record_ids {iterable} -- ids of the records
+
+        Raises:
+            BulkJobError: the job was launched but not seen finished, its set is kept
+            BulkJobTimeoutError: the job is still running after timeout, its set is kept
+
+        Returns:
+            dict -- record id -> (status, message)
+            dict -- report: mode (put or job), and for a job set_id, instance_id, status and job instance
+        """
+        record_ids = list(Alma_Apis_Concurrent.unique(str(record_id) for record_id in record_ids))
+        if self.put is not None and self.threshold is not None and len(record_ids) < self.threshold:
+            return self._run_puts(record_ids)
+        return self._run_job(record_ids)
+
+    def _run_puts(self, record_ids):
+        results = {}
+        for record_id, (status, content) in Alma_Apis_Concurrent.imap(self._put, record_ids,
+                                                                     max_workers=self.max_workers, ordered=False):
+            results[record_id] = (status, content)
+        return results, {'mode': 'put', 'records': len(record_ids)}
+
+    def _put(self, record_id):
+        try:
+            return self.put(record_id)
+        except Exception as error:
+            self.logger.error("BulkUpdate :: {} :: {}".format(record_id, error))
+            return 'Error', str(error)
+
+    def _run_job(self, record_ids):
+        name = '{} {} {}'.format(self.alma.service, self.job_id, time.strftime('%Y%m%d%H%M%S'))
+        set_id = self.alma.create_set(name, self.content_type)['id']
+        self.logger.info("BulkUpdate :: jeu {} créé pour {} enregistrements".format(set_id, len(record_ids)))
+        try:
+            members_num = self.alma.add_set_members(set_id, record_ids)
+            rejected = set()
+            if members_num != len(record_ids):
+                rejected = set(record_ids) - set(self.alma.get_set_member_ids(set_id))
+            parameters = [{'name': {'value': 'set_id'}, 'value': set_id}]
+            parameters.extend({'name': {'value': name}, 'value': value} for name, value in self.job_parameters)
+            job = self.alma.post_job(self.job_id, json.dumps({'parameter': parameters}))
+        except Exception:
+            #Le traitement n'a pas été lancé : le jeu ne sert plus
+            if not self.keep_set:
+                self._delete_set(set_id)
+            raise
+        instance_id = None
+        try:
+            instance_id = Alma_Apis_Jobs.job_instance_id(job)
+            self.logger.info("BulkUpdate :: traitement {} lancé, instance {}".format(self.job_id, instance_id))
+            instance = Alma_Apis_Jobs.wait_for_job(self.alma, self.job_id, instance_id, timeout=self.timeout,
+                                                   min_interval=self.min_interval, max_interval=self.max_interval)
+        except Exception as error:
+            #Le traitement tourne peut-être encore sur le jeu : il est conservé
+            self.logger.error("BulkUpdate :: traitement {} instance {} sur le jeu {} :: {}".format(
+                self.job_id, instance_id, set_id, error))
+            error_class = BulkJobTimeoutError if isinstance(error, TimeoutError) else BulkJobError
+            raise error_class(self.job_id, set_id, instance_id, error) from error
+        #Le traitement est terminé
+        if not self.keep_set:
+            self._delete_set(set_id)
+        status, message = Alma_Apis_Jobs.job_outcome(instance)
+        results = {record_id: ('Error', "Identifiant refusé par le jeu de résultats") if record_id in rejected
+                   else (status, message) for record_id in record_ids}
+        return results, {'mode': 'job', 'records': len(record_ids), 'rejected': len(rejected), 'set_id': set_id,
+                         'instance_id': instance_id, 'status': instance['status']['value'], 'instance': instance}
+
+    def _delete_set(self, set_id):
+        try:
+            self.alma.delete_set(set_id)
+        except Exception as error:
+            self.logger.error("BulkUpdate :: suppression du jeu {} :: {}".format(set_id, error))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Annulation en masse de demandes Alma")
+    parser.add_argument('input', help="CSV user_id,request_id[,reason] avec ligne d'en-tête")
+    parser.add_argument('results', help="CSV des résultats, relu pour reprendre un traitement interrompu")
+    parser.add_argument('--apikey-env', default='ALMA_API_KEY', help="variable d'environnement de la clé d'API")
+    parser.add_argument('--region', default=os.getenv('ALMA_API_REGION', 'EU'))
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--notify-user', action='store_true')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        from . import Alma_Apis_Users
+    except ImportError:
+        import Alma_Apis_Users
+    api = Alma_Apis_Users.AlmaUsers(apikey=os.getenv(args.apikey_env), region=args.region, service='AlmaBulk')
+    with open(args.input, newline='', encoding='utf-8') as input_file:
+        counters = cancel_user_requests(api, csv.DictReader(input_file), results_path=args.results,
+                                        max_workers=args.workers, dry_run=args.dry_run,
+                                        notify_user='true' if args.notify_user else 'false')
+    print(counters)
+    return 0 if not counters.get('Error') else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,368 @@
+import threading
+import time
+import json
+import hashlib
+import re
+import sqlite3
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlencode
+# external imports
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+#Time to live in seconds of the cached answers, by resource. Resources not listed are not cached.
+DEFAULT_TTLS = {
+    'get_record' : 3600,
+    'get_holdings_list' : 600,
+    'get_holding' : 600,
+    'get_locations' : 86400,
+    'search_set_id' : 3600,
+    'service' : 3600,
+}
+
+
+def cache_key(url, params=None, headers=None, apikey=None):
+    """Key of a GET call: url with its parameters, Accept header and API key"""
+    if params:
+        url = '{}{}{}'.format(url, '&' if '?' in url else '?', urlencode(sorted(params.items())))
+    accept = (headers or {}).get('Accept')
+    return url, accept, apikey
+
+
+def conditional_headers(response):
+    """If-None-Match / If-Modified-Since headers to revalidate a cached answer"""
+    headers = {}
+    if response.headers.get('ETag'):
+        headers['If-None-Match'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        headers['If-Modified-Since'] = response.headers['Last-Modified']
+    return headers
+
+
+def max_age(response):
+    """max-age of the Cache-Control header of an answer, 0 for no-store or no-cache, or None"""
+    cache_control = response.headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+    match = re.search(r'max-age=(\d+)', cache_control)
+    return int(match.group(1)) if match else None
+
+
+def build_response(status_code, headers, content, url):
+    """Build a requests.Response from stored data
+
+    Arguments:
+        status_code {int} -- HTTP status
+        headers {dict} -- answer headers
+        content {bytes} -- answer body
+        url {str} -- url of the call
+
+    Returns:
+        requests.Response -- answer
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = content
+    response.url = url
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
+
+
+def canonical(document):
+    """Canonical form of a xml or json document, to compare documents whatever their formatting
+
+    Arguments:
+        document {str, bytes or dict} -- xml or json document
+
+    Returns:
+        str -- C14N xml without indentation, or json with sorted keys. None if document cannot be parsed
+    """
+    if isinstance(document, (dict, list)):
+        return json.dumps(document, sort_keys=True, ensure_ascii=False)
+    if isinstance(document, bytes):
+        document = document.decode('utf-8')
+    document = document.strip()
+    try:
+        if document.startswith(('{', '[')):
+            return json.dumps(json.loads(document), sort_keys=True, ensure_ascii=False)
+        root = ET.fromstring(document)
+    except (ValueError, ET.ParseError):
+        return None
+    #Only the indentation between elements is ignored: spaces inside a value are a change
+    for element in root.iter():
+        if element.text is not None and not element.text.strip():
+            element.text = None
+        if element.tail is not None and not element.tail.strip():
+            element.tail = None
+    return ET.canonicalize(ET.tostring(root, encoding='unicode'))
+
+
+def unchanged(original, data):
+    """True if data is the same document as original once canonicalized"""
+    original = canonical(original)
+    return original is not None and original == canonical(data)
+
+
+def url_path(url):
+    return urlsplit(url).path.rstrip('/')
+
+
+def is_related(path, written_path):
+    """True if a write on written_path may change the answer cached for path
+
+    The resource itself, its parents (lists, bib of a holding) and its children are related.
+    """
+    return (path == written_path
+            or path.startswith(written_path + '/')
+            or written_path.startswith(path + '/'))
+
+
+class ResponseCache(object):
+    """Thread-safe in-memory LRU cache of GET answers with a time to live per resource.
+    """
+
+    def __init__(self, maxsize=1024, ttls=DEFAULT_TTLS, default_ttl=None):
+        """
+        Keyword Arguments:
+            maxsize {int} -- maximum number of cached answers (default: {1024})
+            ttls {dict} -- time to live in seconds by resource (default: {DEFAULT_TTLS})
+            default_ttl {float} -- time to live of resources not in ttls, None to not cache them (default: {None})
+        """
+        self.maxsize = maxsize
+        self.ttls = dict(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, resource):
+        return self.ttls.get(resource, self.default_ttl)
+
+    def cacheable(self, resource):
+        return resource is not None and self.ttl(resource) is not None
+
+    def get(self, key, resource):
+        """Return the cached answer of key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                #Expired answers are kept for revalidation if they carry an ETag or a Last-Modified
+                if not conditional_headers(entry[2]):
+                    del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def peek(self, key):
+        """Return the fresh answer of key without counting a hit or a miss, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[2] if entry is not None and entry[0] >= time.monotonic() else None
+
+    def stale(self, key):
+        """Return the expired answer of key kept for revalidation, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[2] if entry is not None else None
+
+    def revalidated(self, key, resource, response):
+        """Mark the expired answer of key as fresh again after a 304 answer"""
+        with self._lock:
+            self.revalidations += 1
+        self.set(key, resource, response)
+        return response
+
+    def set(self, key, resource, response):
+        """Store the answer of key for its max-age or the time to live of resource"""
+        ttl = max_age(response)
+        if ttl == 0:
+            #max-age=0, no-store or no-cache: the answer is not kept, even for revalidation
+            return
+        if ttl is None:
+            ttl = self.ttl(resource)
+        if ttl is None:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, url_path(key[0]), response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, url):
+        """Remove the answers related to a written url
+
+        Arguments:
+            url {str} -- url of a PUT, POST or DELETE call
+
+        Returns:
+            int -- number of removed answers
+        """
+        written_path = url_path(url)
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if is_related(entry[1], written_path)]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Cache counters
+
+        Returns:
+            dict -- hits, misses, hit ratio, entries, evictions, invalidations, revalidations
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self._entries),
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'revalidations': self.revalidations}
+
+
+class SqliteResponseCache(ResponseCache):
+    """Persistent cache of GET answers in a SQLite file, shared by runs of the same script.
+
+    Answers are fresh for the max-age of their Cache-Control header, else for the time to
+    live of their resource. Expired answers with an ETag or a Last-Modified are revalidated
+    with a conditional call, the others are read again. In offline mode expired answers
+    are returned as is, to work on the last snapshot without calling Alma.
+    API keys are stored hashed.
+    """
+
+    def __init__(self, path, ttls=DEFAULT_TTLS, default_ttl=None, offline=False):
+        """
+        Arguments:
+            path {str} -- SQLite file
+
+        Keyword Arguments:
+            ttls {dict} -- time to live in seconds by resource (default: {DEFAULT_TTLS})
+            default_ttl {float} -- time to live of resources not in ttls, None to not cache them (default: {None})
+            offline {bool} -- return expired answers without revalidation (default: {False})
+        """
+        super(SqliteResponseCache, self).__init__(maxsize=None, ttls=ttls, default_ttl=default_ttl)
+        self.path = path
+        self.offline = offline
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.create_function('is_related', 2, is_related)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                    key TEXT PRIMARY KEY,
+                                    path TEXT,
+                                    url TEXT,
+                                    status INTEGER,
+                                    headers TEXT,
+                                    body BLOB,
+                                    expires REAL)""")
+
+    @staticmethod
+    def _key(key):
+        url, accept, apikey = key
+        if apikey is not None:
+            apikey = hashlib.sha256(apikey.encode('utf-8')).hexdigest()
+        return json.dumps([url, accept, apikey])
+
+    def _load(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT url, status, headers, body, expires FROM responses WHERE key = ?',
+                                   (self._key(key),)).fetchone()
+        if row is None:
+            return None, None
+        url, status, headers, body, expires = row
+        return build_response(status, json.loads(headers), body, url), expires
+
+    def get(self, key, resource):
+        """Return the stored answer of key, or None if missing or expired"""
+        response, expires = self._load(key)
+        fresh = response is not None and (self.offline or expires >= time.time())
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return response if fresh else None
+
+    def peek(self, key):
+        """Return the fresh answer of key without counting a hit or a miss, or None"""
+        response, expires = self._load(key)
+        return response if response is not None and (self.offline or expires >= time.time()) else None
+
+    def stale(self, key):
+        """Return the expired answer of key if it can be revalidated, or None"""
+        response, expires = self._load(key)
+        if response is not None and conditional_headers(response):
+            return response
+        return None
+
+    def set(self, key, resource, response):
+        """Store the answer of key for its max-age or the time to live of resource"""
+        ttl = max_age(response)
+        if ttl == 0:
+            #max-age=0, no-store or no-cache: the answer is not kept, even for revalidation
+            return
+        if ttl is None:
+            ttl = self.ttl(resource)
+        if ttl is None:
+            return
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (self._key(key), url_path(key[0]), response.url, response.status_code,
+                              json.dumps(dict(response.headers)), response.content, time.time() + ttl))
+
+    def invalidate(self, url):
+        """Remove the stored answers related to a written url
+
+        Arguments:
+            url {str} -- url of a PUT, POST or DELETE call
+
+        Returns:
+            int -- number of removed answers
+        """
+        with self._lock, self._db:
+            removed = self._db.execute('DELETE FROM responses WHERE is_related(path, ?)', (url_path(url),)).rowcount
+            self.invalidations += removed
+        return removed
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM responses')
+
+    def stats(self):
+        """Cache counters
+
+        Returns:
+            dict -- hits, misses, hit ratio, entries, invalidations, revalidations
+        """
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'entries': entries,
+                    'evictions': 0,
+                    'invalidations': self.invalidations,
+                    'revalidations': self.revalidations}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,78 @@
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def imap(func, iterable, max_workers=8, ordered=True, window=None):
+    """Call func on every item of iterable in a bounded pool of threads.
+
+    Items are read lazily and at most window results are waiting to be consumed,
+    so memory stays flat whatever the size of iterable.
+
+    Arguments:
+        func {callable} -- function called with one item
+        iterable {iterable} -- items
+
+    Keyword Arguments:
+        max_workers {int} -- maximum number of calls in flight (default: {8})
+        ordered {bool} -- yield in input order, else in completion order (default: {True})
+        window {int} -- maximum number of submitted calls, defaults to 2 * max_workers (default: {None})
+
+    Yields:
+        tuple -- item, func(item). An exception raised by func is raised by the generator.
+    """
+    window = window or 2 * max_workers
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque() if ordered else set()
+    try:
+        for item in iterable:
+            future = executor.submit(func, item)
+            future.item = item
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+            while len(pending) >= window:
+                for future in _next_done(pending, ordered):
+                    yield future.item, future.result()
+        while pending:
+            for future in _next_done(pending, ordered):
+                yield future.item, future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _next_done(pending, ordered):
+    if ordered:
+        return [pending.popleft()]
+    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+    pending.difference_update(done)
+    return done
+
+
+def chunks(iterable, size):
+    """Yield lists of at most size items of iterable
+
+    Arguments:
+        iterable {iterable} -- items
+        size {int} -- chunk size
+
+    Yields:
+        list -- next chunk
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def unique(iterable):
+    """Yield the items of iterable once, in input order"""
+    seen = set()
+    for item in iterable:
+        if item not in seen:
+            seen.add(item)
+            yield item
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import logging
+import argparse
+# internal import
+try:
+    from . import Alma_Apis_Transport
+except ImportError:
+    import Alma_Apis_Transport
+
+
+class PortfolioCrawler(object):
+    """Export every portfolio of an e-collection to a JSONL file, one portfolio per line.
+
+    Services are crawled one after the other, the pages of a service concurrently. After
+    each page the lines are flushed and the page is recorded in a JSON checkpoint file,
+    so that an interrupted crawl started again with the same files only reads the pages
+    still missing. A page written just before an interruption may be written twice.
+    """
+
+    def __init__(self, api, output_path, checkpoint_path=None, max_workers=4):
+        """
+        Arguments:
+            api {AlmaERecords} -- electronic resources client
+            output_path {str} -- JSONL output file, appended to
+
+        Keyword Arguments:
+            checkpoint_path {str} -- JSON checkpoint file, defaults to output_path + '.checkpoint' (default: {None})
+            max_workers {int} -- number of pages read concurrently (default: {4})
+        """
+        self.api = api
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path or output_path + '.checkpoint'
+        self.max_workers = max_workers
+        self.logger = logging.getLogger(api.service)
+
+    def load_checkpoint(self, ecollection_id):
+        """Services already crawled: eservice id -> {'done', 'total', 'offsets'}"""
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path, encoding='utf-8') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get('ecollection_id') != str(ecollection_id):
+            raise ValueError("Le point de reprise {} concerne la collection {}".format(
+                self.checkpoint_path, checkpoint.get('ecollection_id')))
+        return checkpoint['services']
+
+    def save_checkpoint(self, ecollection_id, services):
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump({'ecollection_id': str(ecollection_id), 'services': services}, checkpoint_file)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def eservice_ids(self, ecollection_id):
+        status, response = self.api.get_eservices_list(ecollection_id)
+        if status == 'Error':
+            raise Alma_Apis_Transport.AlmaApiError(status, response, 'services_list')
+        return [str(eservice['id']) for eservice in response.get('electronic_service', [])]
+
+    def run(self, ecollection_id, eservice_ids=None):
+        """Crawl an e-collection
+
+        Arguments:
+            ecollection_id {str} -- e-collection id
+
+        Keyword Arguments:
+            eservice_ids {list} -- services to crawl, all the services of the collection by default (default: {None})
+
+        Returns:
+            dict -- numbers of services, services in error, pages, portfolios, duration and portfolios per second
+        """
+        start = time.monotonic()
+        services = self.load_checkpoint(ecollection_id)
+        counters = {'services': 0, 'errors': 0, 'pages': 0, 'portfolios': 0}
+        with open(self.output_path, 'a', encoding='utf-8') as output_file:
+            for eservice_id in eservice_ids or self.eservice_ids(ecollection_id):
+                eservice_id = str(eservice_id)
+                service = services.setdefault(eservice_id, {'done': False, 'total': None, 'offsets': []})
+                counters['services'] += 1
+                if service['done']:
+                    continue
+                try:
+                    for offset, total, portfolios in self.api.iter_portfolio_pages(ecollection_id, eservice_id,
+                                                                                   skip_offsets=service['offsets'],
+                                                                                   max_workers=self.max_workers):
+                        for portfolio in portfolios:
+                            output_file.write(json.dumps({'ecollection_id': str(ecollection_id), 'eservice_id': eservice_id,
+                                                          'portfolio': portfolio}, ensure_ascii=False) + '\n')
+                        output_file.flush()
+                        service['total'] = total
+                        service['offsets'].append(offset)
+                        self.save_checkpoint(ecollection_id, services)
+                        counters['pages'] += 1
+                        counters['portfolios'] += len(portfolios)
+                except Alma_Apis_Transport.AlmaApiError as error:
+                    self.logger.error("PortfolioCrawler :: service {} :: {}".format(eservice_id, error))
+                    counters['errors'] += 1
+                    continue
+                service['done'] = True
+                self.save_checkpoint(ecollection_id, services)
+                self.logger.info("PortfolioCrawler :: service {} terminé :: {} portfolios".format(eservice_id, service['total']))
+        elapsed = time.monotonic() - start
+        counters.update({'duration': elapsed, 'rate': counters['portfolios'] / elapsed if elapsed else 0.0})
+        self.logger.info("PortfolioCrawler :: fin || {}".format(counters))
+        return counters
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export des portfolios d'une collection électronique Alma en JSONL")
+    parser.add_argument('ecollection_id')
+    parser.add_argument('output', help="fichier JSONL, complété si le traitement est repris")
+    parser.add_argument('--checkpoint', help="point de reprise, <output>.checkpoint par défaut")
+    parser.add_argument('--eservice', action='append', help="service à exporter, tous par défaut")
+    parser.add_argument('--apikey-env', default='ALMA_API_KEY', help="variable d'environnement de la clé d'API")
+    parser.add_argument('--region', default=os.getenv('ALMA_API_REGION', 'EU'))
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        from . import Alma_Apis_Ecollections
+    except ImportError:
+        import Alma_Apis_Ecollections
+    api = Alma_Apis_Ecollections.AlmaERecords(apikey=os.getenv(args.apikey_env), region=args.region, service='AlmaCrawler')
+    crawler = PortfolioCrawler(api, args.output, checkpoint_path=args.checkpoint, max_workers=args.workers)
+    counters = crawler.run(args.ecollection_id, eservice_ids=args.eservice)
+    print(counters)
+    return 0 if not counters['errors'] else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,8 +1,6 @@
 import os
 # external imports
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import json
 import logging
 import xml.etree.ElementTree as ET
@@ -13,6 +11,10 @@ from math import *
 # internal import
 from mail import mail
 from logs import logs
+try:
+    from . import Alma_Apis_Transport, Alma_Apis_Concurrent, Alma_Apis_Tracing
+except ImportError:
+    import Alma_Apis_Transport, Alma_Apis_Concurrent, Alma_Apis_Tracing
 
 
 __version__ = '0.1.0'
@@ -32,11 +34,15 @@ FORMATS = {
 }
 
 RESOURCES = {
+    'services_list' : 'electronic/e-collections/{ecollection_id}/e-services',
     'service' : 'electronic/e-collections/{ecollection_id}/e-services/{eservice_id}',
     'portfolios_list' : 'electronic/e-collections/{ecollection_id}/e-services/{eservice_id}/portfolios?limit={limit}&offset={offset}',
     'portfolio' : 'electronic/e-collections/{ecollection_id}/e-services/{eservice_id}/portfolios/{portfolio_id}'
 }
 
+#Nombre maximum de portfolios par page de l'API
+PORTFOLIOS_LIMIT = 100
+
 NS = {'sru': 'http://www.loc.gov/zing/srw/',
         'marc': 'http://www.loc.gov/MARC21/slim',
         'xmlb' : 'http://com/exlibris/urm/general/xmlbeans'
@@ -46,16 +52,31 @@ class AlmaERecords(object):
     """A set of function for interact with Alma Apis in area "Electronic"
     """
 
-    def __init__(self, apikey=__apikey__, region=__region__,service='AlmaPy'):
+    def __init__(self, apikey=__apikey__, region=__region__,service='AlmaPy', transport=None, endpoint=None):
+        """
+        Keyword Arguments:
+            apikey {str} -- Alma API key (default: {__apikey__})
+            region {str} -- Alma region: US, EU or APAC (default: {__region__})
+            service {str} -- logger name (default: {'AlmaPy'})
+            transport {AlmaTransport} -- HTTP transport, the shared one by default (default: {None})
+            endpoint {str} -- other server than the one of the region, e.g. a proxy or
+                Alma_Apis_Bench.FakeAlmaServer. region is then ignored (default: {None})
+        """
         if apikey is None:
             raise Exception("Please supply an API key")
-        if region not in ENDPOINTS:
+        if endpoint is None and region not in ENDPOINTS:
             msg = 'Invalid Region. Must be one of {}'.format(list(ENDPOINTS))
             raise Exception(msg)
         self.apikey = apikey
-        self.endpoint = ENDPOINTS[region]
+        self.endpoint = endpoint if endpoint is not None else ENDPOINTS[region]
         self.service = service
         self.logger = logging.getLogger(service)
+        self.transport = transport if transport is not None else Alma_Apis_Transport.get_transport()
+
+    @property
+    def metrics(self):
+        """Counters of the calls of the transport (Alma_Apis_Metrics.Metrics): snapshot(), dump(), add_hook()"""
+        return self.transport.metrics
 
     @property
     #Construit la requête et met en forme les réponses
@@ -67,6 +88,7 @@ class AlmaERecords(object):
         """
         return '{}/almaws/{}/'.format(self.endpoint, __api_version__)
 
+    @Alma_Apis_Tracing.traced('build_url')
     def fullurl(self, resource, ids={}):
         return self.baseurl + RESOURCES[resource].format(**ids)
 
@@ -79,6 +101,7 @@ class AlmaERecords(object):
         if content_type is not None:
             headers['Content-Type'] = FORMATS[content_type]
         return headers
+    @Alma_Apis_Tracing.traced('get_error_message')
     def get_error_message(self, response, accept):
         """Extract error code & error message of an API response
         
@@ -96,24 +119,20 @@ class AlmaERecords(object):
             error_code = root.find(".//xmlb:errorCode",NS).text if root.find(".//xmlb:errorCode",NS).text else '???'
         else :
             content = response.json()
-            error_message = content['errorList'][0]['errorMessage']
-            errorCode = content['errorList'][0]['errorCode']
+            error_message = content['errorList']['error'][0]['errorMessage']
+            error_code = content['errorList']['error'][0]['errorCode']
         return error_code, error_message
     
     def request(self, httpmethod, resource, ids, params={}, data=None,
                 accept='json', content_type=None, nb_tries=0, in_url=None):
-        #20190905 retry request 3 time s in case of requests.exceptions.ConnectionError
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        response = session.request(
-            method=httpmethod,
+        response = self.transport.request(
+            httpmethod,
             headers=self.headers(accept=accept, content_type=content_type),
             url= self.fullurl(resource, ids) if in_url is None else in_url,
             params=params,
-            data=data)
+            data=data,
+            apikey=self.apikey,
+            resource=resource)
         try:
             response.raise_for_status()  
         except requests.exceptions.HTTPError:
@@ -133,6 +152,7 @@ class AlmaERecords(object):
             
 
     
+    @Alma_Apis_Tracing.traced('extract_content')
     def extract_content(self, response):
         ctype = response.headers['Content-Type']
         if 'json' in ctype:
@@ -205,10 +225,70 @@ class AlmaERecords(object):
         else:
             return status, self.extract_content(response)
 
-    
+    def get_eservices_list(self, ecollection_id, accept='json'):
+        """ Retourne les services d'une collection électronique
 
-        
-        
-        
-    
+        Args:
+            ecollection_id (int): Collection id
+            accept (str, optional): data format . xml or json. Defaults to 'json'.
+
+        Returns:
+            status : Success or Error
+            response : xml string or json object. If status is Error return Error msg.
+        """
+        status,response = self.request('GET', 'services_list',
+                                {'ecollection_id' : ecollection_id},
+                                accept=accept)
+        if status == 'Error':
+            return status, response
+        else:
+            return status, self.extract_content(response)
+
+    def iter_portfolio_pages(self, ecollection_id, eservice_id, skip_offsets=(), max_workers=4, limit=PORTFOLIOS_LIMIT):
+        """Yield the pages of portfolios of a service as they arrive.
+
+        The first page gives the number of portfolios, the other pages are then read concurrently.
+
+        Args:
+            ecollection_id (int): Collection id
+            eservice_id (int): Service ID
+            skip_offsets (iterable, optional): offsets of the pages already read, e.g. by an interrupted crawl. Defaults to ().
+            max_workers (int, optional): number of pages read concurrently. Defaults to 4.
+            limit (int, optional): page size, 0-100. Defaults to 100.
+
+        Raises:
+            AlmaApiError: a page could not be read
 
+        Yields:
+            tuple: offset, total number of portfolios, list of portfolios (json)
+        """
+        skip_offsets = set(skip_offsets)
+        total, portfolios = self._get_portfolios_page(ecollection_id, eservice_id, limit, 0)
+        if 0 not in skip_offsets:
+            yield 0, total, portfolios
+        offsets = (offset for offset in range(limit, total, limit) if offset not in skip_offsets)
+        pages = Alma_Apis_Concurrent.imap(lambda offset: self._get_portfolios_page(ecollection_id, eservice_id, limit, offset),
+                                          offsets, max_workers=max_workers, ordered=False)
+        for offset, (total, portfolios) in pages:
+            yield offset, total, portfolios
+
+    def iter_portfolios(self, ecollection_id, eservice_id, max_workers=4):
+        """Yield the portfolios of a service as they arrive, in no particular order. See iter_portfolio_pages.
+
+        Args:
+            ecollection_id (int): Collection id
+            eservice_id (int): Service ID
+            max_workers (int, optional): number of pages read concurrently. Defaults to 4.
+
+        Yields:
+            dict: portfolio (json)
+        """
+        for offset, total, portfolios in self.iter_portfolio_pages(ecollection_id, eservice_id, max_workers=max_workers):
+            for portfolio in portfolios:
+                yield portfolio
+
+    def _get_portfolios_page(self, ecollection_id, eservice_id, limit, offset):
+        status, response = self.get_portfolios_list(ecollection_id, eservice_id, limit=limit, offset=offset)
+        if status == 'Error':
+            raise Alma_Apis_Transport.AlmaApiError(status, "offset {} -- {}".format(offset, response), 'portfolios_list')
+        return response.get('total_record_count', 0), response.get('portfolio', [])
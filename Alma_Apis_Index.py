@@ -0,0 +1,345 @@
+import threading
+import time
+import json
+import logging
+import sqlite3
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+
+
+ns = {'sru': 'http://www.loc.gov/zing/srw/',
+        'marc': 'http://www.loc.gov/MARC21/slim' }
+
+
+class SqliteIndex(object):
+    """Base of the local persistent indexes: one SQLite file, one connection shared by threads.
+    """
+    SCHEMA = ()
+
+    def __init__(self, path, max_age=7 * 86400, service='AlmaPy'):
+        """
+        Arguments:
+            path {str} -- SQLite file (':memory:' for a process-wide index)
+
+        Keyword Arguments:
+            max_age {float} -- seconds after which an entry is not used anymore, None to keep entries forever (default: {7 days})
+            service {str} -- logger name (default: {'AlmaPy'})
+        """
+        self.path = path
+        self.max_age = max_age
+        self.logger = logging.getLogger(service)
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            if path != ':memory:':
+                self._db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+
+    def _oldest(self, max_age):
+        return time.time() - max_age if max_age is not None else float('-inf')
+
+    def _fetchone(self, query, parameters):
+        with self._lock:
+            return self._db.execute(query, parameters).fetchone()
+
+    def _found(self, found):
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def _execute(self, query, rows):
+        with self._lock, self._db:
+            self._db.executemany(query, rows)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SruIdentifierIndex(SqliteIndex):
+    """Local index of the SRU lookups: identifier (PPN, originating system id) -> mms id,
+    and mms id + library -> holdings ids.
+
+    AlmaSru fills it as a side effect of its lookups when built with index=, and only calls
+    SRU for the identifiers missing from the index or older than max_age. Identifiers
+    without exactly one record are kept too, with the number of records, for negative_max_age.
+    The records known to carry an identifier are kept apart, so that an identifier shared
+    by several indexed records is counted as such instead of pointing to the last one.
+    """
+    SCHEMA = ("""CREATE TABLE IF NOT EXISTS identifiers (
+                    identifier TEXT PRIMARY KEY,
+                    mms_id TEXT,
+                    records INTEGER,
+                    updated REAL)""",
+              """CREATE TABLE IF NOT EXISTS identifier_records (
+                    identifier TEXT,
+                    mms_id TEXT,
+                    updated REAL,
+                    PRIMARY KEY (identifier, mms_id))""",
+              """CREATE TABLE IF NOT EXISTS holdings (
+                    mms_id TEXT,
+                    library_id TEXT,
+                    holding_ids TEXT,
+                    updated REAL,
+                    PRIMARY KEY (mms_id, library_id))""")
+
+    def __init__(self, path, max_age=7 * 86400, negative_max_age=86400, service='AlmaPy'):
+        """
+        Arguments:
+            path {str} -- SQLite file
+
+        Keyword Arguments:
+            max_age {float} -- freshness of the resolved identifiers and holdings (default: {7 days})
+            negative_max_age {float} -- freshness of the identifiers without exactly one record (default: {1 day})
+            service {str} -- logger name (default: {'AlmaPy'})
+        """
+        super(SruIdentifierIndex, self).__init__(path, max_age=max_age, service=service)
+        self.negative_max_age = negative_max_age
+
+    def get_mms_id(self, identifier):
+        """Return the lookup of an identifier
+
+        Arguments:
+            identifier {str} -- (PPN)xxx or originating system id
+
+        Returns:
+            tuple -- (number of records, mms id or None), or None if unknown or too old
+        """
+        row = self._fetchone('SELECT records, mms_id, updated FROM identifiers WHERE identifier = ?', (identifier,))
+        if not self._found(row is not None
+                           and row[2] >= self._oldest(self.max_age if row[0] == 1 else self.negative_max_age)):
+            return None
+        return row[0], row[1]
+
+    def set_mms_id(self, identifier, records, mms_id=None):
+        """Store the lookup of an identifier
+
+        Arguments:
+            identifier {str} -- (PPN)xxx or originating system id
+            records {int} -- number of records found
+
+        Keyword Arguments:
+            mms_id {str} -- mms id if exactly one record was found (default: {None})
+        """
+        self.set_mms_ids([(identifier, records, mms_id)])
+
+    def set_mms_ids(self, lookups):
+        """Store many (identifier, number of records, mms id) lookups in one transaction
+
+        A lookup replaces what was known of the identifier.
+        """
+        now = time.time()
+        lookups = list(lookups)
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO identifiers VALUES (?, ?, ?, ?)',
+                                 ((identifier, mms_id if records == 1 else None, records, now)
+                                  for identifier, records, mms_id in lookups))
+            self._db.executemany('DELETE FROM identifier_records WHERE identifier = ?',
+                                 ((identifier,) for identifier, records, mms_id in lookups))
+            self._db.executemany('INSERT INTO identifier_records VALUES (?, ?, ?)',
+                                 ((identifier, mms_id, now) for identifier, records, mms_id in lookups if records == 1))
+
+    def add_identifiers(self, identifiers):
+        """Store many (identifier, mms id) found in records, in one transaction
+
+        The number of records of an identifier is counted over the records indexed with it,
+        and is never less than the number given by a lookup still fresh.
+        """
+        now = time.time()
+        identifiers = list(identifiers)
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO identifier_records VALUES (?, ?, ?)',
+                                 ((identifier, mms_id, now) for identifier, mms_id in identifiers))
+            lookups = []
+            for identifier in dict.fromkeys(identifier for identifier, mms_id in identifiers):
+                records, mms_id = self._db.execute('SELECT COUNT(*), MIN(mms_id) FROM identifier_records '
+                                                   'WHERE identifier = ? AND updated >= ?',
+                                                   (identifier, self._oldest(self.max_age))).fetchone()
+                row = self._db.execute('SELECT records, updated FROM identifiers WHERE identifier = ?',
+                                       (identifier,)).fetchone()
+                if row is not None and row[0] > 1 and row[1] >= self._oldest(self.negative_max_age):
+                    records = max(records, row[0])
+                lookups.append((identifier, mms_id if records == 1 else None, records, now))
+            self._db.executemany('INSERT OR REPLACE INTO identifiers VALUES (?, ?, ?, ?)', lookups)
+
+    def get_holdings(self, mms_id, library_id):
+        """Return the holdings ids of a library for a record, or None if unknown or too old"""
+        row = self._fetchone('SELECT holding_ids FROM holdings WHERE mms_id = ? AND library_id = ? AND updated >= ?',
+                             (mms_id, library_id, self._oldest(self.max_age)))
+        return json.loads(row[0]) if self._found(row is not None) else None
+
+    def set_holdings(self, mms_id, library_id, holding_ids):
+        """Store the holdings ids of a library for a record"""
+        self.set_holdings_list([(mms_id, library_id, holding_ids)])
+
+    def set_holdings_list(self, holdings):
+        """Store many (mms id, library id, holdings ids) in one transaction"""
+        now = time.time()
+        self._execute('INSERT OR REPLACE INTO holdings VALUES (?, ?, ?, ?)',
+                      ((mms_id, library_id, json.dumps(holding_ids), now) for mms_id, library_id, holding_ids in holdings))
+
+    def add_record(self, mms_id, record):
+        """Index a marc record: its 035 $a values and its AVA holdings by library
+
+        Arguments:
+            mms_id {str} -- mms id of the record
+            record {Element} -- marc:record
+        """
+        self.add_identifiers(self._record_identifiers(mms_id, record))
+        self.set_holdings_list(self._record_holdings(mms_id, record))
+
+    def warm_up(self, sru, query, complex_query=True, batch_size=500, **kwargs):
+        """Fill the index from a full SRU crawl
+
+        Arguments:
+            sru {AlmaSru} -- SRU client
+            query {str} -- CQL query of the records to index
+
+        Keyword Arguments:
+            complex_query {bool} -- query is a full CQL query (default: {True})
+            batch_size {int} -- records written per transaction (default: {500})
+            kwargs -- other arguments of AlmaSru.sru_search_iter
+
+        Returns:
+            int -- number of indexed records
+        """
+        identifiers, holdings, count = [], [], 0
+        for record in sru.sru_search_iter(query, complex_query=complex_query, **kwargs):
+            mms_id = record.find("sru:recordIdentifier",ns).text
+            marc = record.find("sru:recordData/marc:record",ns)
+            identifiers.extend(self._record_identifiers(mms_id, marc))
+            holdings.extend(self._record_holdings(mms_id, marc))
+            count += 1
+            if count % batch_size == 0:
+                self.add_identifiers(identifiers)
+                self.set_holdings_list(holdings)
+                identifiers, holdings = [], []
+                self.logger.debug("SruIdentifierIndex.warm_up :: {} notices".format(count))
+        self.add_identifiers(identifiers)
+        self.set_holdings_list(holdings)
+        return count
+
+    @staticmethod
+    def _record_identifiers(mms_id, record):
+        return [(subfield.text.strip(), mms_id)
+                for subfield in record.findall("marc:datafield[@tag='035']/marc:subfield[@code='a']",ns)
+                if subfield.text]
+
+    @staticmethod
+    def _record_holdings(mms_id, record):
+        libraries = defaultdict(list)
+        for holding in record.findall(".//marc:datafield[@tag='AVA']",ns):
+            library_id = holding.find("marc:subfield[@code='b']",ns)
+            holding_id = holding.find("marc:subfield[@code='8']",ns)
+            if library_id is not None and holding_id is not None:
+                libraries[library_id.text].append(holding_id.text)
+        return [(mms_id, library_id, holding_ids) for library_id, holding_ids in libraries.items()]
+
+    def purge(self):
+        """Remove the entries older than their max age"""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM identifiers WHERE (records = 1 AND updated < ?) OR (records != 1 AND updated < ?)',
+                             (self._oldest(self.max_age), self._oldest(self.negative_max_age)))
+            self._db.execute('DELETE FROM identifier_records WHERE updated < ?', (self._oldest(self.max_age),))
+            self._db.execute('DELETE FROM holdings WHERE updated < ?', (self._oldest(self.max_age),))
+
+
+class BarcodeIndex(SqliteIndex):
+    """Local index barcode -> (bib id, holding id, item id), the path of an item in the APIs.
+
+    AlmaRecords fills it whenever it reads or writes an item when built with barcode_index=.
+    Entries of an item are replaced when a write returns a new path and removed when a write fails.
+    """
+    SCHEMA = ("""CREATE TABLE IF NOT EXISTS items (
+                    barcode TEXT PRIMARY KEY,
+                    bib_id TEXT,
+                    holding_id TEXT,
+                    item_id TEXT,
+                    updated REAL)""",
+              """CREATE INDEX IF NOT EXISTS items_item_id ON items (item_id)""")
+
+    def __init__(self, path, max_age=None, service='AlmaPy'):
+        """
+        Arguments:
+            path {str} -- SQLite file
+
+        Keyword Arguments:
+            max_age {float} -- seconds after which an entry is not used anymore, None to keep entries forever (default: {None})
+            service {str} -- logger name (default: {'AlmaPy'})
+        """
+        super(BarcodeIndex, self).__init__(path, max_age=max_age, service=service)
+
+    def get(self, barcode):
+        """Return the path of an item
+
+        Arguments:
+            barcode {str} -- item barcode
+
+        Returns:
+            tuple -- (bib_id, holding_id, item_id), or None if unknown or too old
+        """
+        row = self._fetchone('SELECT bib_id, holding_id, item_id FROM items WHERE barcode = ? AND updated >= ?',
+                             (barcode, self._oldest(self.max_age)))
+        return tuple(row) if self._found(row is not None) else None
+
+    def set(self, barcode, bib_id, holding_id, item_id):
+        """Store the path of an item. Other barcodes of the same item are removed."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM items WHERE item_id = ? AND barcode != ?', (item_id, barcode))
+            self._db.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)',
+                             (barcode, bib_id, holding_id, item_id, time.time()))
+
+    def add_item(self, item):
+        """Index an item answered by the API
+
+        Arguments:
+            item {str or dict} -- item in xml or json
+
+        Returns:
+            tuple -- (barcode, bib_id, holding_id, item_id), or None if the item has no barcode
+        """
+        path = item_path(item)
+        if path is not None:
+            self.set(*path)
+        return path
+
+    def invalidate(self, barcode=None, item_id=None):
+        """Remove the path of an item, by barcode or by item id"""
+        with self._lock, self._db:
+            if barcode is not None:
+                self._db.execute('DELETE FROM items WHERE barcode = ?', (barcode,))
+            if item_id is not None:
+                self._db.execute('DELETE FROM items WHERE item_id = ?', (item_id,))
+
+    def purge(self):
+        """Remove the entries older than max_age"""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM items WHERE updated < ?', (self._oldest(self.max_age),))
+
+
+def item_path(item):
+    """Return (barcode, bib_id, holding_id, item_id) of an item in xml or json, or None"""
+    try:
+        if isinstance(item, dict):
+            path = (item['item_data']['barcode'], item['bib_data']['mms_id'],
+                    item['holding_data']['holding_id'], item['item_data']['pid'])
+        else:
+            root = ET.fromstring(item)
+            path = tuple(root.findtext(tag) for tag in ('item_data/barcode', 'bib_data/mms_id',
+                                                        'holding_data/holding_id', 'item_data/pid'))
+    except (KeyError, TypeError, ET.ParseError):
+        return None
+    return path if all(path) else None
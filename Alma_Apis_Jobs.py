@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import time
+import logging
+import threading
+# internal import
+try:
+    from . import Alma_Apis_Concurrent
+except ImportError:
+    import Alma_Apis_Concurrent
+
+
+#Statuts d'une instance de traitement pas encore terminée
+JOB_RUNNING_STATUSES = ('QUEUED', 'PENDING', 'INITIALIZING', 'RUNNING', 'FINALIZING')
+
+
+def job_instance_id(job):
+    """Instance id of a job run, from the link of the answer of post_job"""
+    return job['additional_info']['link'].rstrip('/').split('/')[-1]
+
+
+def job_status(instance):
+    return instance['status']['value']
+
+
+def is_running(instance):
+    return job_status(instance) in JOB_RUNNING_STATUSES
+
+
+def job_progress(instance):
+    """Progress of a job instance in percent, or None if not reported"""
+    try:
+        return float(instance['progress'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def job_outcome(instance):
+    """Status of a finished job instance
+
+    Arguments:
+        instance {dict} -- answer of get_job_instances
+
+    Returns:
+        tuple -- Success, Warning or Error, and the job counters and alerts as a message
+    """
+    status = job_status(instance)
+    counters = ['{}: {}'.format(counter['type'].get('desc') or counter['type']['value'], counter['value'])
+                for counter in instance.get('counter', [])]
+    alerts = [alert.get('desc') or alert.get('value', '') for alert in instance.get('alert', [])]
+    message = ' || '.join([status] + counters + alerts)
+    if status == 'COMPLETED_SUCCESS':
+        return 'Success', message
+    if status == 'COMPLETED_WARNING':
+        return 'Warning', message
+    return 'Error', message
+
+
+def poll_delay(elapsed, progress, polls, min_interval=2, max_interval=60):
+    """Seconds before the next read of a running job instance
+
+    While the job reports no progress the delay grows geometrically from min_interval.
+    Once it reports a progress, the remaining duration is estimated from the elapsed one
+    and the job is read again after half of it, so that short jobs are seen finished quickly
+    and long ones are not read every few seconds for hours.
+
+    Arguments:
+        elapsed {float} -- seconds since the job was watched
+        progress {float} -- progress in percent, or None
+        polls {int} -- number of reads already done
+
+    Keyword Arguments:
+        min_interval {float} -- shortest delay (default: {2})
+        max_interval {float} -- longest delay (default: {60})
+
+    Returns:
+        float -- delay in seconds
+    """
+    if progress is not None and 0 < progress < 100:
+        delay = elapsed * (100 - progress) / progress / 2
+    else:
+        delay = min_interval * 1.5 ** polls
+    return max(min_interval, min(delay, max_interval))
+
+
+def wait_for_job(alma, job_id, instance_id, timeout=6 * 3600, min_interval=2, max_interval=60):
+    """Wait for the end of a job instance with adaptive polling
+
+    Arguments:
+        alma {Alma} -- client of the jobs API
+        job_id {str} -- job id
+        instance_id {str} -- instance id
+
+    Keyword Arguments:
+        timeout {float} -- maximum wait in seconds, None to wait forever (default: {6 hours})
+        min_interval {float} -- shortest delay between two reads (default: {2})
+        max_interval {float} -- longest delay between two reads (default: {60})
+
+    Raises:
+        TimeoutError: the job is still running after timeout
+
+    Returns:
+        dict -- finished job instance
+    """
+    start = time.monotonic()
+    polls = 0
+    while True:
+        instance = alma.get_job_instances(job_id, instance_id)
+        polls += 1
+        if not is_running(instance):
+            return instance
+        elapsed = time.monotonic() - start
+        delay = poll_delay(elapsed, job_progress(instance), polls, min_interval, max_interval)
+        if timeout is not None:
+            if elapsed >= timeout:
+                raise TimeoutError("Traitement {} instance {} non terminé après {} s".format(job_id, instance_id, timeout))
+            delay = min(delay, timeout - elapsed)
+        time.sleep(delay)
+
+
+class JobMonitor(object):
+    """Follow many running job instances from one thread and call back on their changes.
+
+    Each instance is read on its own adaptive schedule (see poll_delay). The reads due at
+    the same time are made concurrently through the client, and so through the shared
+    transport and its pool of connections. Callbacks run in the monitor thread: a callback
+    can watch new instances, e.g. to chain a job as soon as the previous one is finished.
+    """
+
+    def __init__(self, alma, on_change=None, on_finish=None, min_interval=2, max_interval=60, max_workers=4):
+        """
+        Arguments:
+            alma {Alma} -- client of the jobs API
+
+        Keyword Arguments:
+            on_change {callable} -- on_change(job_id, instance_id, previous status, instance) on every status
+                or progress change (default: {None})
+            on_finish {callable} -- on_finish(job_id, instance_id, instance) once an instance is finished (default: {None})
+            min_interval {float} -- shortest delay between two reads of an instance (default: {2})
+            max_interval {float} -- longest delay between two reads of an instance (default: {60})
+            max_workers {int} -- maximum number of reads at once (default: {4})
+        """
+        self.alma = alma
+        self.on_change = on_change
+        self.on_finish = on_finish
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_workers = max_workers
+        self.logger = logging.getLogger(alma.service)
+        self.finished = {}
+        self._watched = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def watch(self, job_id, instance_id, on_finish=None):
+        """Follow a job instance
+
+        Arguments:
+            job_id {str} -- job id
+            instance_id {str} -- instance id
+
+        Keyword Arguments:
+            on_finish {callable} -- called like on_finish of the monitor for this instance only (default: {None})
+        """
+        with self._condition:
+            self._watched[(job_id, instance_id)] = {'start': time.monotonic(), 'next': time.monotonic(), 'polls': 0,
+                                                    'status': None, 'progress': None, 'on_finish': on_finish}
+            self._condition.notify()
+
+    def running(self):
+        """Number of instances not finished yet"""
+        with self._condition:
+            return len(self._watched)
+
+    def poll(self):
+        """Read the instances due now and call back on their changes
+
+        Returns:
+            float -- seconds until the next instance is due, None if no instance is watched
+        """
+        now = time.monotonic()
+        with self._condition:
+            due = [key for key, watched in self._watched.items() if watched['next'] <= now]
+        for key, instance in Alma_Apis_Concurrent.imap(self._read, due, max_workers=self.max_workers, ordered=False):
+            if instance is not None:
+                self._update(key, instance)
+            else:
+                with self._condition:
+                    watched = self._watched[key]
+                    watched['polls'] += 1
+                    watched['next'] = time.monotonic() + poll_delay(0, None, watched['polls'],
+                                                                    self.min_interval, self.max_interval)
+        with self._condition:
+            if not self._watched:
+                return None
+            return max(0, min(watched['next'] for watched in self._watched.values()) - time.monotonic())
+
+    def _read(self, key):
+        try:
+            return self.alma.get_job_instances(*key)
+        except Exception as error:
+            self.logger.error("JobMonitor :: {} instance {} :: {}".format(key[0], key[1], error))
+            return None
+
+    def _update(self, key, instance):
+        with self._condition:
+            watched = self._watched[key]
+            watched['polls'] += 1
+            previous, progress = watched['status'], job_progress(instance)
+            changed = (job_status(instance), progress) != (previous, watched['progress'])
+            watched['status'], watched['progress'] = job_status(instance), progress
+            finished = not is_running(instance)
+            if finished:
+                del self._watched[key]
+                self.finished[key] = instance
+            else:
+                elapsed = time.monotonic() - watched['start']
+                watched['next'] = time.monotonic() + poll_delay(elapsed, progress, watched['polls'],
+                                                                self.min_interval, self.max_interval)
+        if changed:
+            self.logger.debug("JobMonitor :: {} instance {} :: {} {}".format(key[0], key[1], job_status(instance), progress))
+            self._call(self.on_change, key[0], key[1], previous, instance)
+        if finished:
+            self.logger.info("JobMonitor :: {} instance {} terminé :: {}".format(key[0], key[1], job_status(instance)))
+            self._call(watched['on_finish'], key[0], key[1], instance)
+            self._call(self.on_finish, key[0], key[1], instance)
+
+    def _call(self, callback, *args):
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception as error:
+            self.logger.error("JobMonitor :: callback {} :: {}".format(callback, error))
+
+    def run(self, timeout=None):
+        """Follow the watched instances until they are all finished
+
+        Keyword Arguments:
+            timeout {float} -- maximum wait in seconds, None to wait forever (default: {None})
+
+        Returns:
+            bool -- True if every instance is finished
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not self._stopped:
+            delay = self.poll()
+            if delay is None:
+                return True
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    return False
+                delay = min(delay, deadline - time.monotonic())
+            with self._condition:
+                #watch() and stop() wake the monitor up
+                self._condition.wait(delay)
+        return not self._watched
+
+    def start(self):
+        """Follow the instances in a background thread, until stop()"""
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name='JobMonitor', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped:
+            delay = self.poll()
+            with self._condition:
+                if not self._stopped:
+                    self._condition.wait(self.max_interval if delay is None else delay)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import re
+import time
+import logging
+import threading
+from collections import defaultdict
+
+
+#Bornes supérieures en secondes des classes de l'histogramme des durées
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+#Code d'erreur Alma d'une réponse en xml ou en json
+ERROR_CODE = re.compile(r'<errorCode>\s*([^<\s]+)\s*</errorCode>|"errorCode"\s*:\s*"?([^",}\s]+)')
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets, as exported to Prometheus"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket of the q quantile (the largest value for the last bucket)"""
+        if not self.count:
+            return 0.0
+        rank, cumulated = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulated += count
+            if cumulated >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'buckets': dict(zip(self.buckets, self.counts)),
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+
+def error_code(response):
+    """Alma error code of an error answer (e.g. 401890), or None"""
+    match = ERROR_CODE.search(response.text[:4096]) if response.content else None
+    return (match.group(1) or match.group(2)) if match else None
+
+
+class Metrics(object):
+    """Counters of the calls made through a transport, by method and resource.
+
+    For every call: count, latency histogram, bytes sent and received, HTTP statuses and
+    Alma error codes. The GETs answered by the identical GET of another thread are only
+    counted as coalesced: they are neither calls nor in the latencies, and call no hook.
+    Other counters (retries, cache...) are added as sources, callables read at snapshot time.
+    Hooks are called before and after every call, to export the metrics to Prometheus, StatsD...:
+        pre(httpmethod, resource, url)
+        post(httpmethod, resource, url, status, latency, response or exception)
+    status is the HTTP status, or the exception class name if the call failed.
+    """
+
+    def __init__(self, service='AlmaPy'):
+        self.logger = logging.getLogger(service)
+        self.pre_hooks = []
+        self.post_hooks = []
+        self.sources = {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start = time.time()
+            self._calls = defaultdict(lambda: {'calls': 0,
+                                               'coalesced': 0,
+                                               'bytes_sent': 0,
+                                               'bytes_received': 0,
+                                               'statuses': defaultdict(int),
+                                               'error_codes': defaultdict(int),
+                                               'latency': Histogram()})
+
+    def add_hook(self, pre=None, post=None):
+        """Register callbacks called before and after every call"""
+        if pre is not None:
+            self.pre_hooks.append(pre)
+        if post is not None:
+            self.post_hooks.append(post)
+
+    def add_source(self, name, stats):
+        """Register a callable returning a dict of counters, added to the snapshots under name"""
+        self.sources[name] = stats
+
+    def before(self, httpmethod, resource, url):
+        self._call_hooks(self.pre_hooks, httpmethod, resource, url)
+        return time.monotonic()
+
+    def coalesced(self, httpmethod, resource):
+        """Record a call answered by the identical call of another thread, without network call"""
+        with self._lock:
+            self._calls['{} {}'.format(httpmethod.upper(), resource or 'other')]['coalesced'] += 1
+
+    def after(self, httpmethod, resource, url, start, data=None, response=None, error=None):
+        """Record a call
+
+        Arguments:
+            httpmethod {str} -- GET, POST, PUT, DELETE
+            resource {str} -- resource name, None for calls outside of the RESOURCES
+            url {str} -- url of the call
+            start {float} -- value returned by before
+
+        Keyword Arguments:
+            data {str or bytes} -- request body (default: {None})
+            response {requests.Response} -- answer (default: {None})
+            error {Exception} -- exception raised instead of an answer (default: {None})
+        """
+        latency = time.monotonic() - start
+        if response is not None:
+            status = response.status_code
+            if response._content is False:
+                #Streamed answer: body not read yet
+                received = int(response.headers.get('Content-Length') or 0)
+            else:
+                received = len(response.content or b'')
+            code = error_code(response) if status >= 400 else None
+        else:
+            status, received, code = type(error).__name__, 0, None
+        with self._lock:
+            calls = self._calls['{} {}'.format(httpmethod.upper(), resource or 'other')]
+            calls['calls'] += 1
+            calls['bytes_sent'] += len(data) if isinstance(data, (str, bytes)) else 0
+            calls['bytes_received'] += received
+            calls['statuses'][str(status)] += 1
+            if code is not None:
+                calls['error_codes'][code] += 1
+            calls['latency'].observe(latency)
+        self._call_hooks(self.post_hooks, httpmethod, resource, url, status, latency,
+                         response if response is not None else error)
+
+    def _call_hooks(self, hooks, *args):
+        for hook in hooks:
+            try:
+                hook(*args)
+            except Exception as error:
+                self.logger.error("Metrics :: hook {} :: {}".format(hook, error))
+
+    def snapshot(self):
+        """All the counters
+
+        Returns:
+            dict -- 'calls': method and resource -> calls, coalesced, bytes, statuses, error codes, latency;
+            the sources by name; and the duration covered
+        """
+        with self._lock:
+            calls = {key: dict(counters,
+                               statuses=dict(counters['statuses']),
+                               error_codes=dict(counters['error_codes']),
+                               latency=counters['latency'].snapshot())
+                     for key, counters in self._calls.items()}
+            start = self.start
+        snapshot = {'duration': time.time() - start, 'calls': calls}
+        for name, stats in self.sources.items():
+            snapshot[name] = stats()
+        return snapshot
+
+    def dump(self):
+        """Text table of the counters, for the logs of batch scripts"""
+        snapshot = self.snapshot()
+        duration = snapshot['duration']
+        lines = ['{:<36} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>12} {:>12}  {}'.format(
+            'call', 'count', 'per s', 'p50', 'p95', 'p99', 'max', 'bytes in', 'bytes out', 'statuses / error codes')]
+        for key, calls in sorted(snapshot['calls'].items()):
+            latency = calls['latency']
+            statuses = ' '.join('{}:{}'.format(status, count) for status, count in sorted(calls['statuses'].items()))
+            codes = ' '.join('{}:{}'.format(code, count) for code, count in sorted(calls['error_codes'].items()))
+            if calls['coalesced']:
+                codes = ' '.join(filter(None, [codes, 'coalesced:{}'.format(calls['coalesced'])]))
+            lines.append('{:<36} {:>8} {:>8.2f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>12} {:>12}  {}{}'.format(
+                key, calls['calls'], calls['calls'] / duration if duration else 0.0,
+                latency['p50'], latency['p95'], latency['p99'], latency['max'],
+                calls['bytes_received'], calls['bytes_sent'], statuses, ' / ' + codes if codes else ''))
+        for name in self.sources:
+            lines.append('{}: {}'.format(name, snapshot[name]))
+        return '\n'.join(lines)
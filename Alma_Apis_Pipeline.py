@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import re
+import queue
+import logging
+import threading
+# internal import
+try:
+    from . import Alma_Apis_Cache
+except ImportError:
+    import Alma_Apis_Cache
+
+
+#Marqueur de fin d'une file
+_DONE = object()
+
+
+class _Failed(object):
+    """End of a queue because the ids could not be read, raised again by run()"""
+
+    def __init__(self, error):
+        self.error = error
+
+ITEM_LINK = re.compile(r'bibs/(?P<bib_id>[^/]+)/holdings/(?P<holding_id>[^/]+)/items/(?P<item_id>[^/?]+)')
+
+
+class Pipeline(object):
+    """Read -> transform -> write records in three stages with their own pool of threads.
+
+    Stages are linked by bounded queues: when the writes are slower than the reads, the
+    readers wait instead of piling records up in memory. Network waits of the reads and
+    writes overlap with the transformations instead of alternating with them.
+
+    read(record_id) and write(record_id, data) have the signature of the clients methods and
+    return (status, content). transform(record_id, content) returns the data to write, or None
+    if there is nothing to change. Data identical to the read document is not written either.
+    """
+
+    def __init__(self, read, transform, write, read_workers=8, transform_workers=2, write_workers=8,
+                 queue_size=None, service='AlmaPy'):
+        """
+        Arguments:
+            read {callable} -- read(record_id) -> (status, content)
+            transform {callable} -- transform(record_id, content) -> data to write or None
+            write {callable} -- write(record_id, data) -> (status, content)
+
+        Keyword Arguments:
+            read_workers {int} -- maximum number of reads at once (default: {8})
+            transform_workers {int} -- maximum number of transformations at once (default: {2})
+            write_workers {int} -- maximum number of writes at once (default: {8})
+            queue_size {int} -- size of the queues between stages, defaults to 2 * the largest pool (default: {None})
+            service {str} -- logger name (default: {'AlmaPy'})
+        """
+        self.read = read
+        self.transform = transform
+        self.write = write
+        self.workers = {'read': read_workers, 'transform': transform_workers, 'write': write_workers}
+        self.queue_size = queue_size or 2 * max(self.workers.values())
+        self.logger = logging.getLogger(service)
+        self.counters = {}
+
+    def run(self, record_ids):
+        """Process records
+
+        Arguments:
+            record_ids {iterable} -- ids passed to read and write, read lazily
+
+        Raises:
+            Exception: the error raised by record_ids, once the records read before it are processed
+
+        Yields:
+            tuple -- record_id, status (Success, Unchanged or Error), write answer or error message.
+            Outcomes come in completion order.
+        """
+        self.counters = {}
+        stop = threading.Event()
+        to_read, to_transform, to_write, results = (queue.Queue(self.queue_size) for i in range(4))
+        stages = [('read', self._read, to_read, to_transform),
+                  ('transform', self._transform, to_transform, to_write),
+                  ('write', self._write, to_write, results)]
+        threads = [threading.Thread(target=self._feed, args=(record_ids, to_read, stop), daemon=True)]
+        for name, func, inbox, outbox in stages:
+            remaining = [self.workers[name]]
+            lock = threading.Lock()
+            threads.extend(threading.Thread(target=self._work, args=(func, inbox, outbox, remaining, lock, stop),
+                                            name='Pipeline-{}-{}'.format(name, i), daemon=True)
+                           for i in range(self.workers[name]))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                outcome = results.get()
+                if outcome is _DONE:
+                    break
+                if isinstance(outcome, _Failed):
+                    raise outcome.error
+                self.counters[outcome[1]] = self.counters.get(outcome[1], 0) + 1
+                yield outcome
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.logger.info("Pipeline :: fin || {}".format(self.counters))
+
+    @staticmethod
+    def _put(outbox, item, stop):
+        while not stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _get(inbox, stop):
+        while not stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _feed(self, record_ids, to_read, stop):
+        end = _DONE
+        try:
+            for record_id in record_ids:
+                if not self._put(to_read, (record_id, None, None), stop):
+                    return
+        except Exception as error:
+            self.logger.error("Pipeline :: lecture des identifiants :: {}".format(error))
+            #Transmis jusqu'à run() derrière les records déjà lus
+            end = _Failed(error)
+        finally:
+            self._put(to_read, end, stop)
+
+    def _work(self, func, inbox, outbox, remaining, lock, stop):
+        while True:
+            job = self._get(inbox, stop)
+            if job is _DONE or isinstance(job, _Failed):
+                #Le dernier worker de l'étape ferme la file suivante, les autres relaient la fin
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                self._put(outbox if last else inbox, job, stop)
+                return
+            record_id, status, content = job
+            #Record arrêté à une étape précédente (Unchanged ou Error) : transmis tel quel
+            if status is None:
+                try:
+                    status, content = func(record_id, content)
+                except Exception as error:
+                    self.logger.error("Pipeline :: {} :: {} :: {}".format(func.__name__, record_id, error))
+                    status, content = 'Error', "{} :: {}".format(func.__name__.strip('_'), error)
+            if not self._put(outbox, (record_id, status, content), stop):
+                return
+
+    def _read(self, record_id, content):
+        status, content = self.read(record_id)
+        if status != 'Success':
+            return 'Error', "read :: {}".format(content)
+        return None, content
+
+    def _transform(self, record_id, content):
+        data = self.transform(record_id, content)
+        if data is None or Alma_Apis_Cache.unchanged(content, data):
+            return 'Unchanged', None
+        return None, data
+
+    def _write(self, record_id, data):
+        status, content = self.write(record_id, data)
+        if status != 'Success':
+            return 'Error', "write :: {}".format(content)
+        return 'Success', content
+
+
+def holdings_pipeline(api, transform, **kwargs):
+    """Pipeline get_holding -> transform -> set_holding
+
+    Arguments:
+        api {AlmaRecords} -- records client
+        transform {callable} -- transform((bib_id, holding_id), holding xml) -> new holding xml or None
+
+    Keyword Arguments:
+        kwargs -- other arguments of Pipeline
+
+    Returns:
+        Pipeline -- run it on (bib_id, holding_id) tuples
+    """
+    return Pipeline(lambda ids: api.get_holding(*ids, accept='xml'),
+                    transform,
+                    lambda ids, data: api.set_holding(*ids, data),
+                    service=api.service, **kwargs)
+
+
+def items_pipeline(api, transform, **kwargs):
+    """Pipeline get_item_with_url -> transform -> set_item
+
+    Arguments:
+        api {AlmaRecords} -- records client
+        transform {callable} -- transform(item link, item xml) -> new item xml or None
+
+    Keyword Arguments:
+        kwargs -- other arguments of Pipeline
+
+    Returns:
+        Pipeline -- run it on item links, e.g. AlmaRecords.iter_set_members links
+    """
+    def set_item(link, data):
+        match = ITEM_LINK.search(link)
+        if match is None:
+            return 'Error', "Lien d'exemplaire invalide : {}".format(link)
+        return api.set_item(match.group('bib_id'), match.group('holding_id'), match.group('item_id'), data)
+
+    return Pipeline(lambda link: api.get_item_with_url(link, accept='xml'),
+                    transform,
+                    set_item,
+                    service=api.service, **kwargs)
@@ -0,0 +1,159 @@
+import threading
+import time
+import logging
+from email.utils import parsedate_to_datetime
+
+
+#Alma refuses more than 25 calls per second and per institution (PER_SECOND_THRESHOLD)
+DEFAULT_RATE = 25
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket: at most rate calls per second, bursts of burst calls.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=None, service='AlmaPy'):
+        """
+        Keyword Arguments:
+            rate {float} -- allowed calls per second (default: {DEFAULT_RATE})
+            burst {int} -- bucket size, defaults to one second of calls (default: {None})
+            service {str} -- logger name (default: {'AlmaPy'})
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.daily_remaining = None
+        self.waited = 0.0
+        self.throttled = 0
+        self.logger = logging.getLogger(service)
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Wait until a call is allowed
+
+        Returns:
+            float -- seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.waited += waited
+                    return waited
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Stop every caller for seconds, e.g. after a 429 answer"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def update(self, response):
+        """Adjust the bucket from the answer of Alma
+
+        Uses Retry-After on 429 answers, the X-RateLimit-Limit / X-RateLimit-Remaining /
+        X-RateLimit-Reset headers and the daily quota X-Exl-Api-Remaining when present.
+
+        Arguments:
+            response {requests.Response} -- API response
+        """
+        headers = response.headers
+        limit = _number(headers.get('X-RateLimit-Limit'))
+        if limit:
+            with self._lock:
+                self.rate = min(self.max_rate, limit)
+                self.capacity = min(self.capacity, max(1, int(self.rate)))
+        remaining = _number(headers.get('X-RateLimit-Remaining'))
+        if remaining is not None and remaining <= 0:
+            self.pause(_number(headers.get('X-RateLimit-Reset')) or 1)
+        daily_remaining = _number(headers.get('X-Exl-Api-Remaining'))
+        if daily_remaining is not None:
+            self.daily_remaining = daily_remaining
+            if daily_remaining <= 0:
+                self.logger.error("Alma_Apis :: Daily API quota exhausted")
+        if response.status_code == 429:
+            self.throttled += 1
+            delay = retry_after(response)
+            self.logger.warning("Alma_Apis :: Threshold reached, pause for {} s || URL: {}".format(delay, response.url))
+            self.pause(delay if delay is not None else 1)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(response):
+    """Delay asked by the Retry-After header, in seconds
+
+    Arguments:
+        response {requests.Response} -- API response
+
+    Returns:
+        float -- seconds, or None if the header is missing or invalid
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    delay = _number(value)
+    if delay is None:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return max(0.0, delay)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(apikey):
+    """Return the process-wide bucket of an API key, created on first use
+
+    Arguments:
+        apikey {str} -- Alma API key
+
+    Returns:
+        TokenBucket -- bucket shared by every client using this key
+    """
+    limiter = _limiters.get(apikey)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(apikey, TokenBucket())
+    return limiter
+
+
+def set_rate_limit(apikey, rate, burst=None):
+    """Set the allowed calls per second for an API key
+
+    Arguments:
+        apikey {str} -- Alma API key
+        rate {float} -- allowed calls per second
+
+    Keyword Arguments:
+        burst {int} -- bucket size (default: {None})
+
+    Returns:
+        TokenBucket -- new bucket of the key
+    """
+    with _limiters_lock:
+        limiter = _limiters[apikey] = TokenBucket(rate=rate, burst=burst)
+    return limiter
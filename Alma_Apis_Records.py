@@ -1,18 +1,19 @@
 import os
 # external imports
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import json
 import logging
 import xml.etree.ElementTree as ET
 import time
-import sys
 from math import *
 
 # internal import
 from mail import mail
 from logs import logs
+try:
+    from . import Alma_Apis_Transport, Alma_Apis_Concurrent, Alma_Apis_Index, Alma_Apis_Tracing
+except ImportError:
+    import Alma_Apis_Transport, Alma_Apis_Concurrent, Alma_Apis_Index, Alma_Apis_Tracing
 
 
 __version__ = '0.1.0'
@@ -38,9 +39,13 @@ RESOURCES = {
     'get_item' : 'bibs/{bib_id}/holdings/{holding_id}/items/{item_id}',
     'get_set' : 'conf/sets/{set_id}',
     'get_set_members' : 'conf/sets/{set_id}/members?limit={limit}&offset={offset}',
-    'get_record' : 'bibs/{mms_id}?view={view}&expand={expand}'
+    'get_record' : 'bibs/{mms_id}?view={view}&expand={expand}',
+    'get_records' : 'bibs?mms_id={mms_ids}&view={view}&expand={expand}'
 }
 
+#Maximum number of mms_id accepted by the bibs API in one call
+RECORDS_BATCH_SIZE = 100
+
 NS = {'sru': 'http://www.loc.gov/zing/srw/',
         'marc': 'http://www.loc.gov/MARC21/slim',
         'xmlb' : 'http://com/exlibris/urm/general/xmlbeans'
@@ -50,16 +55,33 @@ class AlmaRecords(object):
     """A set of function for interact with Alma Apis in area "Records & Inventory"
     """
 
-    def __init__(self, apikey=__apikey__, region=__region__,service='AlmaPy'):
+    def __init__(self, apikey=__apikey__, region=__region__,service='AlmaPy', transport=None, barcode_index=None, endpoint=None):
+        """
+        Keyword Arguments:
+            apikey {str} -- Alma API key (default: {__apikey__})
+            region {str} -- Alma region: US, EU or APAC (default: {__region__})
+            service {str} -- logger name (default: {'AlmaPy'})
+            transport {AlmaTransport} -- HTTP transport, the shared one by default (default: {None})
+            barcode_index {BarcodeIndex} -- local index barcode -> item path (default: {None})
+            endpoint {str} -- other server than the one of the region, e.g. a proxy or
+                Alma_Apis_Bench.FakeAlmaServer. region is then ignored (default: {None})
+        """
         if apikey is None:
             raise Exception("Please supply an API key")
-        if region not in ENDPOINTS:
+        if endpoint is None and region not in ENDPOINTS:
             msg = 'Invalid Region. Must be one of {}'.format(list(ENDPOINTS))
             raise Exception(msg)
         self.apikey = apikey
-        self.endpoint = ENDPOINTS[region]
+        self.endpoint = endpoint if endpoint is not None else ENDPOINTS[region]
         self.service = service
         self.logger = logging.getLogger(service)
+        self.transport = transport if transport is not None else Alma_Apis_Transport.get_transport()
+        self.barcode_index = barcode_index
+
+    @property
+    def metrics(self):
+        """Counters of the calls of the transport (Alma_Apis_Metrics.Metrics): snapshot(), dump(), add_hook()"""
+        return self.transport.metrics
 
     @property
     #Construit la requête et met en forme les réponses
@@ -71,6 +93,7 @@ class AlmaRecords(object):
         """
         return '{}/almaws/{}/'.format(self.endpoint, __api_version__)
 
+    @Alma_Apis_Tracing.traced('build_url')
     def fullurl(self, resource, ids={}):
         return self.baseurl + RESOURCES[resource].format(**ids)
 
@@ -83,6 +106,7 @@ class AlmaRecords(object):
         if content_type is not None:
             headers['Content-Type'] = FORMATS[content_type]
         return headers
+    @Alma_Apis_Tracing.traced('get_error_message')
     def get_error_message(self, response, accept):
         """Extract error code & error message of an API response
         
@@ -100,24 +124,21 @@ class AlmaRecords(object):
             error_code = root.find(".//xmlb:errorCode",NS).text if root.find(".//xmlb:errorCode",NS).text else '???'
         else :
             content = response.json()
-            error_message = content['errorList'][0]['errorMessage']
-            errorCode = content['errorList'][0]['errorCode']
+            error_message = content['errorList']['error'][0]['errorMessage']
+            error_code = content['errorList']['error'][0]['errorCode']
         return error_code, error_message
     
     def request(self, httpmethod, resource, ids, params={}, data=None,
-                accept='json', content_type=None, nb_tries=0, in_url=None):
-        #20190905 retry request 3 time s in case of requests.exceptions.ConnectionError
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        response = session.request(
-            method=httpmethod,
+                accept='json', content_type=None, nb_tries=0, in_url=None, original=None):
+        response = self.transport.request(
+            httpmethod,
             headers=self.headers(accept=accept, content_type=content_type),
             url= self.fullurl(resource, ids) if in_url is None else in_url,
             params=params,
-            data=data)
+            data=data,
+            apikey=self.apikey,
+            resource=resource,
+            original=original)
         try:
             response.raise_for_status()  
         except requests.exceptions.HTTPError:
@@ -137,6 +158,7 @@ class AlmaRecords(object):
             
 
     
+    @Alma_Apis_Tracing.traced('extract_content')
     def extract_content(self, response):
         ctype = response.headers['Content-Type']
         if 'json' in ctype:
@@ -165,10 +187,11 @@ class AlmaRecords(object):
         else:
             return status, self.extract_content(response)
     
-    def set_holding(self, bib_id, holding_id, data):
+    #original : holding lue avant modification, la mise à jour n'est pas envoyée si data est identique
+    def set_holding(self, bib_id, holding_id, data, original=None):
         status, response = self.request('PUT', 'get_holding', 
                                 {'bib_id': bib_id,'holding_id': holding_id},
-                                data=data, content_type='xml', accept='xml')
+                                data=data, content_type='xml', accept='xml', original=original)
         if status == 'Error':
             return status, response
         else:
@@ -181,7 +204,83 @@ class AlmaRecords(object):
         if status == 'Error':
             return status, response
         else:
-            return status, self.extract_content(response)
+            return status, self._index_item(self.extract_content(response))
+
+    def _index_item(self, item):
+        """Store the path of an item in the barcode index"""
+        if self.barcode_index is not None:
+            self.barcode_index.add_item(item)
+        return item
+
+    def resolve_barcode(self, barcode):
+        """Return the path of an item from the barcode index, reading the item only if the barcode is not indexed
+
+        Arguments:
+            barcode {str} -- item barcode
+
+        Returns:
+            status {str} -- Success or Error
+            response {tuple or str} -- (bib_id, holding_id, item_id) or error msg
+        """
+        if self.barcode_index is not None:
+            path = self.barcode_index.get(barcode)
+            if path is not None:
+                return 'Success', path
+        status, item = self.get_item_with_barcode(barcode, accept='json')
+        if status == 'Error':
+            return status, item
+        path = Alma_Apis_Index.item_path(item)
+        if path is None:
+            return 'Error', "Item sans identifiants pour le code-barres {}".format(barcode)
+        return status, path[1:]
+
+    def set_item_with_barcode(self, barcode, data):
+        """Update an item by barcode, with the path of the barcode index when the barcode is indexed
+
+        Arguments:
+            barcode {str} -- item barcode
+            data {str} -- item (xml)
+
+        Returns:
+            status {str} -- Success or Error
+            response {str} -- updated item or error msg
+        """
+        status, path = self.resolve_barcode(barcode)
+        if status == 'Error':
+            return status, path
+        status, response = self.set_item(*path, data)
+        if status == 'Error' and self.barcode_index is not None:
+            #The indexed path may be outdated (relocated item): read the item again and retry once
+            new_status, new_path = self.resolve_barcode(barcode)
+            if new_status == 'Success' and new_path != path:
+                return self.set_item(*new_path, data)
+        return status, response
+
+    def get_items_by_barcodes(self, barcodes, max_workers=8, ordered=True, accept='xml'):
+        """Return items for many barcodes, max_workers calls at once. Barcodes are read lazily
+        and de-duplicated, and an error on a barcode does not stop the others.
+
+        Args:
+            barcodes (iterable): items barcodes
+            max_workers (int, optional): number of calls at once. Defaults to 8.
+            ordered (bool, optional): yield in input order, else in completion order. Defaults to True.
+            accept (str, optional): xml or json. Defaults to 'xml'.
+
+        Yields:
+            tuple: barcode, status (Success or Error), item or error message
+        """
+        barcodes = Alma_Apis_Concurrent.unique(str(barcode).strip() for barcode in barcodes)
+        get_item = lambda barcode: self._get_item_by_barcode(barcode, accept)
+        for barcode, (status, item) in Alma_Apis_Concurrent.imap(get_item, barcodes, max_workers=max_workers, ordered=ordered):
+            yield barcode, status, item
+
+    def _get_item_by_barcode(self, barcode, accept):
+        #Toute erreur (réseau, réponse d'erreur illisible...) reste limitée à son code-barres
+        try:
+            return self.get_item_with_barcode(barcode, accept=accept)
+        except Exception as error:
+            self.logger.error("{} :: Alma_Apis :: {}".format(barcode, error))
+            return 'Error', str(error)
 
     def get_item_with_url(self,in_url, accept='xml'):
         status,response = self.request('GET', None,
@@ -191,43 +290,105 @@ class AlmaRecords(object):
         if status == 'Error':
             return status, response
         else:
-            return status, self.extract_content(response)
+            return status, self._index_item(self.extract_content(response))
 
 
-    def set_item(self, bib_id, holding_id, item_id, data):
+    def get_item(self, bib_id, holding_id, item_id, accept='xml'):
+        status, response = self.request('GET', 'get_item',
+                                {'bib_id': bib_id,
+                                'holding_id': holding_id,
+                                'item_id': item_id},
+                                accept=accept)
+        if status == 'Error':
+            return status, response
+        else:
+            return status, self._index_item(self.extract_content(response))
+
+    #original : exemplaire lu avant modification, la mise à jour n'est pas envoyée si data est identique
+    def set_item(self, bib_id, holding_id, item_id, data, original=None):
 
         status, response = self.request('PUT', 'get_item', 
                                 {'bib_id': bib_id,
                                 'holding_id': holding_id,
                                 'item_id': item_id},
-                                data=data, content_type='xml', accept='xml')
+                                data=data, content_type='xml', accept='xml', original=original)
         if status == 'Error':
+            #The indexed path is removed only if the item cannot be read there (relocated item), not for
+            #a rejected update (invalid data)
+            if self.barcode_index is not None and self.get_item(bib_id, holding_id, item_id)[0] == 'Error':
+                self.barcode_index.invalidate(item_id=item_id)
             return status, response
         else:
-            return status, self.extract_content(response)
+            return status, self._index_item(self.extract_content(response))
     
     def get_set_members_list(self,set_id):
-        members_list = []
-        status, members_number = self.get_set_member_number(set_id)
+        """Return the links of all the members of a set
+
+        Arguments:
+            set_id {str} -- Alma set id
+
+        Raises:
+            AlmaApiError: a page of the set could not be read
+
+        Returns:
+            list -- members links
+        """
+        return [member['link'] for member in self.iter_set_members(set_id)]
+
+    def iter_set_members(self, set_id, offset=0, prefetch=4, limit=100):
+        """Yield the members of a set as pages arrive. The next prefetch pages are read concurrently.
+
+        Arguments:
+            set_id {str} -- Alma set id
+
+        Keyword Arguments:
+            offset {int} -- offset to start (or resume) from (default: {0})
+            prefetch {int} -- number of pages read concurrently (default: {4})
+            limit {int} -- page size, 0-100 (default: {100})
+
+        Raises:
+            AlmaApiError: the set or one of its pages could not be read
+
+        Yields:
+            dict -- member (id, description, link)
+        """
+        status, response = self.request('GET', 'get_set', {'set_id': set_id}, accept='json')
+        if status == 'Error':
+            raise Alma_Apis_Transport.AlmaApiError(status, response, 'get_set')
+        members_number = self.extract_content(response)['number_of_members']['value']
         self.logger.debug(members_number)
-        request_number = ceil(members_number/100)
-        offset = 0
-        for x in range(request_number):
-            data = self.get_set_members(set_id, offset=offset)
-            for member in data['member']:
-                members_list.append(member['link'])
-            offset = offset + 100
+        offsets = range(offset, members_number, limit)
+        pages = Alma_Apis_Concurrent.imap(lambda page_offset: self._get_set_members_page(set_id, limit, page_offset),
+                                          offsets, max_workers=prefetch)
+        for page_offset, members in pages:
+            for member in members:
+                yield member
 
-        return members_list
+    def _get_set_members_page(self, set_id, limit, offset):
+        status,response = self.request('GET', 'get_set_members',
+                                {   'set_id' : set_id,
+                                    'limit'  : limit,
+                                    'offset' : offset,
+                                },
+                                accept='json')
+        if status == 'Error':
+            self.logger.error(response)
+            raise Alma_Apis_Transport.AlmaApiError(status, "offset {} -- {}".format(offset, response), 'get_set_members')
+        return self.extract_content(response).get('member', [])
 
         #Retourne le nombre de membres d'un jeu de résultat
     def get_set_member_number(self, set_id, accept='json'):
+        """Return the number of members of a set
+
+        Raises:
+            AlmaApiError: the set could not be read
+        """
         status, response = self.request('GET', 'get_set',
                                 {'set_id': set_id},
                                 accept=accept)
         if status == 'Error':
             self.logger.error(response)
-            sys.exit()
+            raise Alma_Apis_Transport.AlmaApiError(status, response, 'get_set')
         else:
             content = self.extract_content(response)
             members_num = content['number_of_members']['value']
@@ -235,6 +396,11 @@ class AlmaRecords(object):
 
 
     def get_set_members(self,set_id,limit=100,offset=0,accept='json'):
+        """Return a page of the members of a set
+
+        Raises:
+            AlmaApiError: the page could not be read
+        """
         status,response = self.request('GET', 'get_set_members',
                                 {   'set_id' : set_id,
                                     'limit'  : limit,
@@ -243,7 +409,7 @@ class AlmaRecords(object):
                                 accept=accept)
         if status == 'Error':
             self.logger.error(response)
-            sys.exit()
+            raise Alma_Apis_Transport.AlmaApiError(status, response, 'get_set_members')
         else:
             content = self.extract_content(response)
             return content
@@ -272,3 +438,50 @@ class AlmaRecords(object):
             return status, self.extract_content(response)
     
 
+    def get_records(self, mms_ids, view='full', expand='None', accept='xml', max_workers=1):
+        """Return bibliographic records, RECORDS_BATCH_SIZE mms_id per call
+
+        Args:
+            mms_ids (iterable): mms_id of the records
+            view (str, optional): full, brief or local_fields. Defaults to 'full'.
+            expand (str, optional): additional information, comma separated. Defaults to 'None'.
+            accept (str, optional): xml or json. Defaults to 'xml'.
+            max_workers (int, optional): number of batches read concurrently. Defaults to 1.
+
+        Returns:
+            dict: mms_id -> (status, record). record is an xml string or a json object. If status is Error, error msg.
+            list: mms_id not returned by Alma
+        """
+        results = {}
+        missing = []
+        batches = Alma_Apis_Concurrent.chunks(mms_ids, RECORDS_BATCH_SIZE)
+        get_batch = lambda batch: self._get_records_batch(batch, view, expand, accept)
+        for batch, (status, records) in Alma_Apis_Concurrent.imap(get_batch, batches, max_workers=max_workers):
+            for mms_id in batch:
+                mms_id = str(mms_id)
+                if status == 'Error':
+                    results[mms_id] = (status, records)
+                elif mms_id in records:
+                    results[mms_id] = (status, records[mms_id])
+                else:
+                    missing.append(mms_id)
+        return results, missing
+
+    def _get_records_batch(self, batch, view, expand, accept):
+        status,response = self.request('GET', 'get_records',
+                                {   'mms_ids' : ','.join(str(mms_id) for mms_id in batch),
+                                    'view'  : view,
+                                    'expand' : expand,
+                                },
+                                accept=accept)
+        if status == 'Error':
+            return status, response
+        records = {}
+        content = self.extract_content(response)
+        if accept == 'xml':
+            for bib in ET.fromstring(content).findall('bib'):
+                records[bib.findtext('mms_id')] = ET.tostring(bib, encoding='unicode')
+        else:
+            for bib in content.get('bib', []):
+                records[bib['mms_id']] = bib
+        return status, records
@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+import logging
+from collections import Counter
+# internal import
+try:
+    from . import Alma_Apis_RateLimit
+except ImportError:
+    import Alma_Apis_RateLimit
+
+
+#Throttled (PER_SECOND_THRESHOLD) and transient gateway errors
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class RetryPolicy(object):
+    """Retry policy of the shared request path: exponential backoff with full jitter,
+    Retry-After, a time budget per call and retry counters.
+    """
+
+    def __init__(self, statuses=RETRY_STATUSES, methods=IDEMPOTENT_METHODS, max_retries=5,
+                 backoff_factor=0.5, backoff_max=30, budget=120, retry_errors=True, service='AlmaPy'):
+        """
+        Keyword Arguments:
+            statuses {tuple} -- HTTP status to retry (default: {RETRY_STATUSES})
+            methods {tuple} -- HTTP methods allowed to be retried (default: {IDEMPOTENT_METHODS})
+            max_retries {int} -- maximum number of retries of a call (default: {5})
+            backoff_factor {float} -- first backoff, doubled on each retry (default: {0.5})
+            backoff_max {float} -- maximum backoff (default: {30})
+            budget {float} -- seconds after which a call is not retried anymore (default: {120})
+            retry_errors {bool} -- also retry connection errors and timeouts (default: {True})
+            service {str} -- logger name (default: {'AlmaPy'})
+        """
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(method.upper() for method in methods)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.budget = budget
+        self.retry_errors = retry_errors
+        self.logger = logging.getLogger(service)
+        self.retries = 0
+        self.retries_by_reason = Counter()
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt):
+        """Full jitter backoff of the retry number attempt (0 for the first retry)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+
+    def delay(self, httpmethod, attempt, deadline, response=None, error=None):
+        """Return the delay before the next try, or None if the call must not be retried
+
+        Arguments:
+            httpmethod {str} -- HTTP method of the call
+            attempt {int} -- number of retries already done
+            deadline {float} -- time.monotonic() value after which nothing is retried
+
+        Keyword Arguments:
+            response {requests.Response} -- answer of the last try (default: {None})
+            error {Exception} -- connection error of the last try (default: {None})
+
+        Returns:
+            float -- seconds to wait, or None
+        """
+        if error is not None:
+            if not self.retry_errors:
+                return None
+            reason = type(error).__name__
+        elif response is not None and response.status_code in self.statuses:
+            reason = response.status_code
+        else:
+            return None
+        if httpmethod.upper() not in self.methods:
+            return None
+        delay = None
+        if response is not None:
+            delay = Alma_Apis_RateLimit.retry_after(response)
+        if delay is None:
+            delay = self.backoff(attempt)
+        if attempt >= self.max_retries or time.monotonic() + delay > deadline:
+            with self._lock:
+                self.exhausted += 1
+            self.logger.error("Alma_Apis :: Retries exhausted after {} tries || Reason: {}".format(attempt + 1, reason))
+            return None
+        with self._lock:
+            self.retries += 1
+            self.retries_by_reason[reason] += 1
+        self.logger.warning("Alma_Apis :: Retry {} in {:.2f} s || Reason: {}".format(attempt + 1, delay, reason))
+        return delay
+
+    def stats(self):
+        """Retry counters
+
+        Returns:
+            dict -- retries, retries per status or error, calls given up
+        """
+        with self._lock:
+            return {'retries': self.retries,
+                    'retries_by_reason': dict(self.retries_by_reason),
+                    'exhausted': self.exhausted}
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import logging
+import functools
+import threading
+import contextlib
+# external imports
+from requests.adapters import HTTPAdapter
+
+
+class Tracer(object):
+    """Write timed spans to a trace file.
+
+    Chrome trace format (open it in chrome://tracing or https://ui.perfetto.dev) or JSON
+    lines, one span per line, chosen from the file extension. Spans of a thread nest, so the
+    trace shows for each call the time spent building the url, waiting for a connection,
+    waiting for the first byte, downloading the body and decoding it.
+    """
+
+    def __init__(self, path, format=None):
+        """
+        Arguments:
+            path {str} -- trace file, overwritten
+
+        Keyword Arguments:
+            format {str} -- 'chrome' or 'jsonl', from the extension of path by default (default: {None})
+        """
+        self.path = path
+        self.format = format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'chrome')
+        self.pid = os.getpid()
+        self.spans = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', encoding='utf-8')
+        if self.format == 'chrome':
+            self._file.write('[\n')
+
+    def span(self, name, **args):
+        return _Span(self, name, args)
+
+    def write(self, name, start, duration, args):
+        event = {'name': name,
+                 'cat': 'alma',
+                 'ph': 'X',
+                 'ts': start * 1e6,
+                 'dur': duration * 1e6,
+                 'pid': self.pid,
+                 'tid': threading.get_ident(),
+                 'args': args}
+        line = json.dumps(event, default=str)
+        with self._lock:
+            if self._file.closed:
+                return
+            if self.format == 'chrome':
+                line = (',\n' if self.spans else '') + line
+            else:
+                line += '\n'
+            self._file.write(line)
+            self.spans += 1
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            if self.format == 'chrome':
+                self._file.write('\n]\n')
+            self._file.close()
+
+
+class _Span(object):
+
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.write(self.name, self.start, time.perf_counter() - self.start, self.args)
+
+
+_tracer = None
+_NO_SPAN = contextlib.nullcontext()
+
+
+def enable(path, format=None):
+    """Write the spans of every client to path, until disable()
+
+    Returns:
+        Tracer -- the tracer
+    """
+    global _tracer
+    disable()
+    _tracer = Tracer(path, format)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name, **args):
+    """Context manager timing a block in the trace file, doing nothing when tracing is off"""
+    tracer = _tracer
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(name, **args)
+
+
+def traced(name):
+    """Decorator timing every call of a method in the trace file"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedAdapter(HTTPAdapter):
+    """HTTPAdapter timing the wait for a pooled connection when tracing is on"""
+
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        return self._traced_pool(super(TracedAdapter, self).get_connection_with_tls_context(*args, **kwargs))
+
+    def get_connection(self, *args, **kwargs):
+        return self._traced_pool(super(TracedAdapter, self).get_connection(*args, **kwargs))
+
+    @staticmethod
+    def _traced_pool(pool):
+        if not getattr(pool, '_alma_traced', False):
+            get_conn = pool._get_conn
+
+            def traced_get_conn(*args, **kwargs):
+                with span('connection', pool=pool.host, idle=pool.pool.qsize() if pool.pool is not None else 0):
+                    return get_conn(*args, **kwargs)
+            pool._get_conn = traced_get_conn
+            pool._alma_traced = True
+        return pool
+
+
+@contextlib.contextmanager
+def profile(path=None, sort='cumulative', limit=30, service='AlmaPy'):
+    """Run a block of calls under cProfile
+
+    The limit most expensive functions are logged at the end of the block, and the whole
+    profile is saved to path for snakeviz, pstats...
+
+    Keyword Arguments:
+        path {str} -- .prof file (default: {None})
+        sort {str} -- pstats sort key (default: {'cumulative'})
+        limit {int} -- number of functions logged (default: {30})
+        service {str} -- logger name (default: {'AlmaPy'})
+
+    Yields:
+        cProfile.Profile -- the profiler
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            profiler.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
+        logging.getLogger(service).info("Profil ::\n{}".format(output.getvalue()))
@@ -0,0 +1,362 @@
+import threading
+import time
+import weakref
+import logging
+# external imports
+import requests
+from requests.packages.urllib3.util.retry import Retry
+# internal import
+try:
+    from . import Alma_Apis_RateLimit, Alma_Apis_Retry, Alma_Apis_Cache, Alma_Apis_Metrics, Alma_Apis_Tracing
+except ImportError:
+    import Alma_Apis_RateLimit, Alma_Apis_Retry, Alma_Apis_Cache, Alma_Apis_Metrics, Alma_Apis_Tracing
+
+
+class AlmaTransport(object):
+    """Keep-alive HTTP transport shared by the Alma clients.
+
+    A single HTTPAdapter (and so a single urllib3 pool manager) is shared by every
+    thread. Each thread gets its own requests.Session mounted on that adapter, so
+    connections are reused across calls without sharing session state between threads.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False,
+                 connect_retries=3, backoff_factor=0.5, timeout=None, rate_limit=True,
+                 retry=True, cache=None, skip_unchanged=True, coalesce=True, metrics=None, service='AlmaPy'):
+        """Build the connection pool
+
+        Keyword Arguments:
+            pool_connections {int} -- number of per-host pools kept alive (default: {10})
+            pool_maxsize {int} -- maximum number of kept-alive connections per host (default: {10})
+            pool_block {bool} -- if True, never open more than pool_maxsize connections per host
+                and wait for a free one instead (default: {False})
+            connect_retries {int} -- retries on connection errors (default: {3})
+            backoff_factor {float} -- backoff between connection retries (default: {0.5})
+            timeout {float or tuple} -- default requests timeout (default: {None})
+            rate_limit {bool} -- throttle calls with the token bucket of their API key (default: {True})
+            retry {RetryPolicy or bool} -- retry policy of 429/5xx answers, True for the default
+                policy, False to disable it (default: {True})
+            cache {ResponseCache or SqliteResponseCache} -- cache of the GET answers, None to disable
+                it (default: {None})
+            skip_unchanged {bool} -- do not send the PUT of a document identical to the original one
+                (default: {True})
+            coalesce {bool} -- identical GETs sent at the same time by several threads share one
+                call (default: {True})
+            metrics {Metrics} -- counters of the calls, a new one by default (default: {None})
+            service {str} -- logger name (default: {'AlmaPy'})
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        if retry is True:
+            retry = Alma_Apis_Retry.RetryPolicy(service=service)
+        self.retry = retry or None
+        self.cache = cache
+        self.skip_unchanged = skip_unchanged
+        self.writes_skipped = 0
+        self.coalesce = coalesce
+        self.coalesced = 0
+        self._in_flight = {}
+        self.metrics = metrics if metrics is not None else Alma_Apis_Metrics.Metrics(service)
+        self.metrics.add_source('transport', self.stats)
+        if self.retry is not None:
+            self.metrics.add_source('retry', self.retry.stats)
+        if self.cache is not None:
+            self.metrics.add_source('cache', self.cache.stats)
+        self.logger = logging.getLogger(service)
+        #20190905 retry request 3 time s in case of requests.exceptions.ConnectionError
+        #429/5xx answers are left to the retry policy
+        retry = Retry(connect=connect_retries, backoff_factor=backoff_factor, respect_retry_after_header=False)
+        self.adapter = Alma_Apis_Tracing.TracedAdapter(pool_connections=pool_connections,
+                                                       pool_maxsize=pool_maxsize,
+                                                       max_retries=retry,
+                                                       pool_block=pool_block)
+        self._local = threading.local()
+        #Sessions are only referenced by their thread: the session of a thread that ended (e.g. a
+        #worker of a finished pool) is freed with it. Closing it would close the shared adapter.
+        self._sessions = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """requests.Session of the current thread, mounted on the shared adapter"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+            with self._lock:
+                self._sessions.add(session)
+        return session
+
+    def request(self, httpmethod, url, headers=None, params=None, data=None, apikey=None,
+                resource=None, original=None, **kwargs):
+        """Send a request through the connection pool
+
+        Arguments:
+            httpmethod {str} -- GET, POST, PUT, DELETE
+            url {str} -- full url
+
+        Keyword Arguments:
+            headers {dict} -- request headers (default: {None})
+            params {dict} -- query string parameters (default: {None})
+            data {str} -- request body (default: {None})
+            apikey {str} -- API key of the call, selects the rate limiter (default: {None})
+            resource {str} -- resource name of the call, selects the cache time to live (default: {None})
+            original {str or dict} -- document read before a PUT: the PUT is not sent if data is the
+                same document (default: {None})
+
+        Returns:
+            requests.Response -- API response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        flight = key = None
+        if self.coalesce and httpmethod.upper() == 'GET' and not kwargs.get('stream'):
+            key = Alma_Apis_Cache.cache_key(url, params, headers, apikey)
+            flight, leader = self._join_flight(key)
+            if not leader:
+                #The answer of another thread is not a call: counted apart, out of the latencies
+                self.metrics.coalesced(httpmethod, resource)
+                return flight.wait()
+        start = self.metrics.before(httpmethod, resource, url)
+        try:
+            with Alma_Apis_Tracing.span('request', method=httpmethod, resource=resource, url=url):
+                if flight is None:
+                    response = self._request(httpmethod, url, headers, params, data, apikey, resource,
+                                             original, **kwargs)
+                else:
+                    response = self._lead_flight(key, flight, httpmethod, url, headers, params, data, apikey,
+                                                 resource, **kwargs)
+        except Exception as error:
+            self.metrics.after(httpmethod, resource, url, start, data=data, error=error)
+            raise
+        self.metrics.after(httpmethod, resource, url, start, data=data, response=response)
+        return response
+
+    def stats(self):
+        """Calls saved by the transport
+
+        Returns:
+            dict -- PUTs not sent because unchanged, GETs shared with an identical one in flight
+        """
+        with self._lock:
+            return {'writes_skipped': self.writes_skipped, 'coalesced': self.coalesced}
+
+    def coalesced_request(self, httpmethod, url, headers=None, params=None, data=None, apikey=None,
+                          resource=None, **kwargs):
+        """Send a GET, or wait for the answer of the identical GET (same url, Accept and API key)
+        already sent by another thread. Same arguments as request.
+
+        Returns:
+            requests.Response -- API response, shared by every caller
+        """
+        key = Alma_Apis_Cache.cache_key(url, params, headers, apikey)
+        flight, leader = self._join_flight(key)
+        if not leader:
+            return flight.wait()
+        return self._lead_flight(key, flight, httpmethod, url, headers, params, data, apikey, resource, **kwargs)
+
+    def _join_flight(self, key):
+        """Return the GET in flight for key, and True if the caller sends it, False if it waits for it"""
+        with self._lock:
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self._in_flight[key] = _Flight()
+            return flight, True
+
+    def _lead_flight(self, key, flight, *args, **kwargs):
+        """Send the GET of a flight and share its answer with the threads waiting for it"""
+        try:
+            flight.response = self._request(*args, **kwargs)
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            flight.done.set()
+        return flight.response
+
+    def _request(self, httpmethod, url, headers=None, params=None, data=None, apikey=None,
+                 resource=None, original=None, **kwargs):
+        if self.skip_unchanged and httpmethod.upper() == 'PUT':
+            response = self.unchanged_write(url, headers, params, data, apikey, resource, original)
+            if response is not None:
+                return response
+        if self.cache is None:
+            return self.send(httpmethod, url, headers, params, data, apikey, **kwargs)
+        if httpmethod.upper() != 'GET':
+            #Writes invalidate the cached answers of the resource, its parents and its children
+            self.cache.invalidate(url)
+            response = self.send(httpmethod, url, headers, params, data, apikey, **kwargs)
+            self.cache.invalidate(url)
+            return response
+        if not self.cache.cacheable(resource):
+            return self.send(httpmethod, url, headers, params, data, apikey, **kwargs)
+        key = Alma_Apis_Cache.cache_key(url, params, headers, apikey)
+        response = self.cache.get(key, resource)
+        if response is not None:
+            return response
+        stale = self.cache.stale(key)
+        if stale is not None:
+            headers = dict(headers or {}, **Alma_Apis_Cache.conditional_headers(stale))
+        response = self.send(httpmethod, url, headers, params, data, apikey, **kwargs)
+        if response.status_code == 304 and stale is not None:
+            return self.cache.revalidated(key, resource, stale)
+        if response.ok:
+            self.cache.set(key, resource, response)
+        return response
+
+    def unchanged_write(self, url, headers=None, params=None, data=None, apikey=None, resource=None,
+                        original=None):
+        """Answer of a PUT whose data is the same document as the original one, without calling Alma
+
+        Without original, the fresh cached GET answer of url is used if there is one.
+
+        Returns:
+            requests.Response -- answer of the previous GET or data itself, None if the PUT must be sent
+        """
+        headers = headers or {}
+        if original is None:
+            if self.cache is None or not self.cache.cacheable(resource):
+                return None
+            cached = self.cache.peek(Alma_Apis_Cache.cache_key(url, params, headers, apikey))
+            if cached is None or not Alma_Apis_Cache.unchanged(cached.content, data):
+                return None
+            response = cached
+        else:
+            #The answer is data itself: only when it is in the format asked by Accept
+            if (not isinstance(data, (str, bytes)) or headers.get('Accept') != headers.get('Content-Type')
+                    or not Alma_Apis_Cache.unchanged(original, data)):
+                return None
+            body = data.encode('utf-8') if isinstance(data, str) else data
+            response = Alma_Apis_Cache.build_response(200, {'Content-Type': headers['Content-Type']}, body, url)
+        with self._lock:
+            self.writes_skipped += 1
+        self.logger.debug("AlmaTransport :: PUT sans modification non envoyé || URL: {}".format(url))
+        return response
+
+    def send(self, httpmethod, url, headers=None, params=None, data=None, apikey=None, **kwargs):
+        """Send a request on the network, with rate limiting and retries
+
+        Same arguments as request.
+
+        Returns:
+            requests.Response -- API response
+        """
+        limiter = None
+        if self.rate_limit and apikey is not None:
+            limiter = Alma_Apis_RateLimit.get_rate_limiter(apikey)
+        if self.retry is not None:
+            deadline = time.monotonic() + self.retry.budget
+        #Traced calls are streamed to time the first byte and the body download apart
+        traced = Alma_Apis_Tracing.get_tracer() is not None and not kwargs.get('stream')
+        if traced:
+            kwargs = dict(kwargs, stream=True)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                with Alma_Apis_Tracing.span('rate_limit'):
+                    limiter.acquire()
+            try:
+                with Alma_Apis_Tracing.span('first_byte', attempt=attempt):
+                    response = self.session.request(method=httpmethod,
+                                                    url=url,
+                                                    headers=headers,
+                                                    params=params,
+                                                    data=data,
+                                                    **kwargs)
+                if traced:
+                    with Alma_Apis_Tracing.span('download', status=response.status_code):
+                        response.content
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                delay = None
+                if self.retry is not None:
+                    delay = self.retry.delay(httpmethod, attempt, deadline, error=error)
+                if delay is None:
+                    raise
+            else:
+                if limiter is not None:
+                    limiter.update(response)
+                delay = None
+                if self.retry is not None:
+                    delay = self.retry.delay(httpmethod, attempt, deadline, response=response)
+                if delay is None:
+                    return response
+                response.close()
+            with Alma_Apis_Tracing.span('backoff', attempt=attempt):
+                time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        """Close every pooled connection"""
+        with self._lock:
+            for session in list(self._sessions):
+                session.close()
+            self._sessions = weakref.WeakSet()
+        self._local = threading.local()
+        self.adapter.close()
+
+
+class _Flight(object):
+    """GET in flight, waited for by the threads sending the same GET"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """Return the process-wide transport, created on first use
+
+    Returns:
+        AlmaTransport -- shared transport
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = AlmaTransport()
+    return _transport
+
+
+def set_transport(transport):
+    """Replace the process-wide transport, e.g. to use a bigger pool for a batch
+
+    Arguments:
+        transport {AlmaTransport} -- new shared transport
+
+    Returns:
+        AlmaTransport -- previous shared transport (or None)
+    """
+    global _transport
+    with _transport_lock:
+        previous, _transport = _transport, transport
+    return previous
+
+
+class AlmaApiError(Exception):
+    """Error raised by the iterators and bulk helpers instead of returning an ('Error', msg) tuple
+    """
+
+    def __init__(self, status, message, resource=None):
+        super(AlmaApiError, self).__init__("{} :: {}".format(resource, message) if resource else message)
+        self.status = status
+        self.message = message
+        self.resource = resource
@@ -2,15 +2,18 @@ import os
 import re
 # external imports
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import json
 import logging
 import xml.etree.ElementTree as ET
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 # internal import
 from mail import mail
 from logs import logs
+try:
+    from . import Alma_Apis_Transport, Alma_Apis_Concurrent, Alma_Apis_Tracing
+except ImportError:
+    import Alma_Apis_Transport, Alma_Apis_Concurrent, Alma_Apis_Tracing
 
 
 __version__ = '0.1.0'
@@ -36,11 +39,14 @@ RESOURCES = {
     'delete_user' : 'users/{user_id}',
     'update_user' : 'users/{user_id}?user_id_type=all_unique&override={param_override}',
     'get_user_requests' : 'users/{user_id}/requests?request_type={request_type}&user_id_type={user_id_type}&limit={limit}&offset={offset}&status={status}',
-    'delete_user_requests' : 'users/{user_id}/requests/{request_id}?reason{reason}&notify_user={notify_user}',
+    'delete_user_requests' : 'users/{user_id}/requests/{request_id}?reason={reason}&notify_user={notify_user}',
     'update_user_request' : 'users/{user_id}/requests/{request_id}',
 
 }
 
+#Maximum page size of the user requests API
+USER_REQUESTS_LIMIT = 100
+
 NS = {'sru': 'http://www.loc.gov/zing/srw/',
         'marc': 'http://www.loc.gov/MARC21/slim',
         'xmlb' : 'http://com/exlibris/urm/general/xmlbeans'
@@ -50,16 +56,31 @@ class AlmaUsers(object):
     """A set of function for interact with Alma Apis in area "User & Fullfilment"
     """
 
-    def __init__(self, apikey=__apikey__, region=__region__,service='AlmaPy'):
+    def __init__(self, apikey=__apikey__, region=__region__,service='AlmaPy', transport=None, endpoint=None):
+        """
+        Keyword Arguments:
+            apikey {str} -- Alma API key (default: {__apikey__})
+            region {str} -- Alma region: US, EU or APAC (default: {__region__})
+            service {str} -- logger name (default: {'AlmaPy'})
+            transport {AlmaTransport} -- HTTP transport, the shared one by default (default: {None})
+            endpoint {str} -- other server than the one of the region, e.g. a proxy or
+                Alma_Apis_Bench.FakeAlmaServer. region is then ignored (default: {None})
+        """
         if apikey is None:
             raise Exception("Please supply an API key")
-        if region not in ENDPOINTS:
+        if endpoint is None and region not in ENDPOINTS:
             msg = 'Invalid Region. Must be one of {}'.format(list(ENDPOINTS))
             raise Exception(msg)
         self.apikey = apikey
-        self.endpoint = ENDPOINTS[region]
+        self.endpoint = endpoint if endpoint is not None else ENDPOINTS[region]
         self.service = service
         self.logger = logging.getLogger(service)
+        self.transport = transport if transport is not None else Alma_Apis_Transport.get_transport()
+
+    @property
+    def metrics(self):
+        """Counters of the calls of the transport (Alma_Apis_Metrics.Metrics): snapshot(), dump(), add_hook()"""
+        return self.transport.metrics
 
     @property
     #Construit la requête et met en forme les réponses
@@ -71,11 +92,11 @@ class AlmaUsers(object):
         """
         return '{}/almaws/{}/'.format(self.endpoint, __api_version__)
 
+    @Alma_Apis_Tracing.traced('build_url')
     def fullurl(self, resource, ids={}):
         return self.baseurl + RESOURCES[resource].format(**ids)
 
     def headers(self, accept='json', content_type=None):
-        print(content_type)
         headers = {
             "User-Agent": "pyalma/{}".format(__version__),
             "Authorization": "apikey {}".format(self.apikey),
@@ -83,8 +104,8 @@ class AlmaUsers(object):
         }
         if content_type is not None:
             headers['Content-Type'] = FORMATS[content_type]
-        print(headers)
         return headers
+    @Alma_Apis_Tracing.traced('get_error_message')
     def get_error_message(self, response, accept):
         """Extract error code & error message of an API response
         
@@ -115,25 +136,21 @@ class AlmaUsers(object):
             return 666, 'Format de réponse invalide'
     
     def request(self, httpmethod, resource, ids, params={}, data=None,
-                accept='json', content_type=None, nb_tries=0):
-        print(content_type)
-        #20190905 retry request 3 time s in case of requests.exceptions.ConnectionError
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        response = session.request(
-            method=httpmethod,
+                accept='json', content_type=None, nb_tries=0, original=None):
+        response = self.transport.request(
+            httpmethod,
             headers=self.headers(accept=accept, content_type=content_type),
             url=self.fullurl(resource, ids),
             params=params,
-            data=data)
-        print(response.url)
+            data=data,
+            apikey=self.apikey,
+            resource=resource,
+            original=original)
+        self.logger.debug("Alma_Apis_Users :: {} {} || Content-Type: {} || HTTP Status: {}".format(
+            httpmethod, response.url, content_type, response.status_code))
         try:
             response.raise_for_status()  
         except requests.exceptions.HTTPError:
-            print (response.text)
             error_code, error_message= self.get_error_message(response,accept)
             self.logger.error("Alma_Apis :: HTTP Status: {} || Method: {} || URL: {} || Response: {}".format(response.status_code,response.request.method, response.url, response.text))
             if error_code in ['401890','401861'] :
@@ -153,6 +170,7 @@ class AlmaUsers(object):
             
 
     
+    @Alma_Apis_Tracing.traced('extract_content')
     def extract_content(self, response):
         ctype = response.headers['Content-Type']
         if 'json' in ctype:
@@ -173,7 +191,7 @@ class AlmaUsers(object):
         status,response = self.request('GET', 'retrieve_user_by_id',
                                 {'user_id' : user_id},
                                 accept=accept)
-        if status == 'Error':
+        if status != 'Success':
             return status, response
         else:
             return status, self.extract_content(response)
@@ -228,7 +246,7 @@ class AlmaUsers(object):
         else:
             return status, response.status_code
 
-    def update_user(self, user_id, override, data ,accept='xml',content_type='xml'):
+    def update_user(self, user_id, override, data ,accept='xml',content_type='xml', original=None):
         """Mets à jour lesinformations utilistaeurs
         
         Arguments:
@@ -239,6 +257,7 @@ class AlmaUsers(object):
         
         Keyword Arguments:
             accept {str} -- xml ou json (default: {'xml'})
+            original {json ou xml} -- lecteur lu avant modification, la mise à jour n'est pas envoyée si data est identique (default: {None})
         
         Returns:
             status {str} -- Success or Error
@@ -250,7 +269,8 @@ class AlmaUsers(object):
                                 'param_override' : override },
                                 data=data,
                                 accept=accept,
-                                content_type=content_type)
+                                content_type=content_type,
+                                original=original)
         if status == 'Error':
             return status, response
         else:
@@ -283,6 +303,55 @@ class AlmaUsers(object):
         else:
             return status, response
 
+    def iter_user_requests(self, user_id, request_types=('HOLD',), user_id_type='all_unique', status='active', max_workers=4):
+        """Yield all the requests of a user. The first page of each request type gives total_record_count,
+        the other pages are read concurrently. Several request types are swept in parallel.
+
+        Arguments:
+            user_id {str} -- A unique identifier for the user
+
+        Keyword Arguments:
+            request_types {tuple} -- request types among HOLD, DIGITIZATION, BOOKING (default: {('HOLD',)})
+            user_id_type {str} -- The type of identifier that is being searched (default: {'all_unique'})
+            status {str} -- active or history (default: {'active'})
+            max_workers {int} -- number of pages read concurrently (default: {4})
+
+        Raises:
+            AlmaApiError: a page could not be read
+
+        Yields:
+            dict -- user request (json)
+        """
+        if isinstance(request_types, str):
+            request_types = (request_types,)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        submit = lambda request_type, offset: executor.submit(self._get_user_requests_page, user_id, request_type,
+                                                              user_id_type, offset, status)
+        pending = {submit(request_type, 0) for request_type in request_types}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    request_type, offset, content = future.result()
+                    if offset == 0:
+                        pending.update(submit(request_type, next_offset)
+                                       for next_offset in range(USER_REQUESTS_LIMIT, content['total_record_count'], USER_REQUESTS_LIMIT))
+                    for user_request in content.get('user_request', []):
+                        yield user_request
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _get_user_requests_page(self, user_id, request_type, user_id_type, offset, status):
+        request_status, response = self.get_user_requests(user_id, request_type, user_id_type=user_id_type,
+                                                          limit=USER_REQUESTS_LIMIT, offset=offset, status=status,
+                                                          accept='json')
+        if request_status != 'Success':
+            raise Alma_Apis_Transport.AlmaApiError(request_status, "{} offset {} -- {}".format(request_type, offset, response),
+                                                   'get_user_requests')
+        return request_type, offset, response
+
     def delete_user_request(self,user_id,request_id, reason = 'CancelledAtPatronRequest',notify_user = 'false', accept ='xml'):
         """Delete a user request
 
@@ -331,4 +400,79 @@ class AlmaUsers(object):
         if status == 'Error':
             return status, response
         else:
-            return status,  self.extract_content(response)
\ No newline at end of file
+            return status,  self.extract_content(response)
+
+
+class AlmaNetworkUsers(object):
+    """Look a user up in several institutions at once. One AlmaUsers client by institution,
+    all on the same transport.
+    """
+
+    def __init__(self, apikeys, region=__region__, service='AlmaPy', transport=None, max_workers=None, endpoint=None):
+        """
+        Arguments:
+            apikeys {dict} -- institution -> API key, e.g. {'NETWORK': ..., 'UB': ..., 'BXSA': ...}
+
+        Keyword Arguments:
+            region {str} -- Alma region (default: {__region__})
+            service {str} -- logger name (default: {'AlmaPy'})
+            transport {AlmaTransport} -- HTTP transport, the shared one by default (default: {None})
+            max_workers {int} -- institutions called concurrently, all of them by default (default: {None})
+            endpoint {str} -- other server than the one of the region (default: {None})
+        """
+        self.clients = {institution : AlmaUsers(apikey=apikey, region=region, service=service, transport=transport,
+                                                endpoint=endpoint)
+                        for institution, apikey in apikeys.items()}
+        self.service = service
+        self.logger = logging.getLogger(service)
+        self.max_workers = max_workers or max(1, len(self.clients))
+
+    def get_user_institutions(self, user_id, user_id_type='PRIMARYIDENTIFIER', user_expand='loans,requests',
+                              user_view='brief', accept='json'):
+        """Retourne la liste des institutions où le compte du lecteur est présent, avec le compte du lecteur.
+        Les institutions sont interrogées en parallèle.
+
+        Arguments:
+            user_id {str} -- identifiant du lecteur
+
+        Keyword Arguments:
+            user_id_type {str} -- BARCODE ou PRIMARYIDENTIFIER (default: {'PRIMARYIDENTIFIER'})
+            user_expand {str} -- informations supllémentaires (default: {'loans,requests'})
+            user_view {str} -- full ou brief (default: {'brief'})
+            accept {str} -- format du lecteur xml ou json (default: {'json'})
+
+        Returns:
+            users_list {list} -- [{'institution': institution, 'data': lecteur}] for each institution where the user exists
+            report {dict} -- institution -> {'status': Success, No record found or Error, 'latency': seconds, 'error': message or None}
+        """
+        lookup = lambda institution: self._get_user(institution, user_id, user_id_type, user_expand, user_view, accept)
+        users_list = []
+        report = {}
+        for institution, (status, user, latency, error) in Alma_Apis_Concurrent.imap(lookup, self.clients,
+                                                                                     max_workers=self.max_workers,
+                                                                                     ordered=False):
+            report[institution] = {'status': status, 'latency': latency, 'error': error}
+            if status == 'Success':
+                users_list.append({'institution': institution, 'data': user})
+        order = list(self.clients)
+        users_list.sort(key=lambda user_data: order.index(user_data['institution']))
+        return users_list, report
+
+    def _get_user(self, institution, user_id, user_id_type, user_expand, user_view, accept):
+        api = self.clients[institution]
+        start = time.monotonic()
+        try:
+            status, response = api.retrieve_user_by_id(user_id, accept='json')
+            if status == 'Success':
+                if response['total_record_count'] == 1:
+                    status, response = api.get_user(user_id, user_id_type=user_id_type, user_expand=user_expand,
+                                                    user_view=user_view, accept=accept)
+                else:
+                    status, response = 'No record found', "{} lecteurs".format(response['total_record_count'])
+        except requests.exceptions.RequestException as error:
+            status, response = 'Error', str(error)
+        latency = time.monotonic() - start
+        self.logger.debug("{} :: AlmaNetworkUsers :: {} :: {} en {:.3f} s".format(user_id, institution, status, latency))
+        if status == 'Success':
+            return status, response, latency, None
+        return status, None, latency, response
@@ -1,4 +1,5 @@
 import os
+import copy
 # external imports
 import requests
 import xml.etree.ElementTree as ET
@@ -7,6 +8,10 @@ import urllib.parse
 # internal import
 from mail import mail
 from logs import logs
+try:
+    from . import Alma_Apis_Transport, Alma_Apis_Concurrent, Alma_Apis_Tracing
+except ImportError:
+    import Alma_Apis_Transport, Alma_Apis_Concurrent, Alma_Apis_Tracing
 
 
 
@@ -14,25 +19,53 @@ from logs import logs
 ns = {'sru': 'http://www.loc.gov/zing/srw/',
         'marc': 'http://www.loc.gov/MARC21/slim' }
 
+#Maximum number of records returned by an Alma SRU page
+SRU_MAXIMUM_RECORDS = 50
+
 
 class AlmaSru(object):
 
-    def __init__(self, institution ='network',service='AlmaSru',instance='Prod'):
+    def __init__(self, institution ='network',service='AlmaSru',instance='Prod', transport=None, index=None, endpoint=None):
+        """
+        Keyword Arguments:
+            institution {str} -- institution code (default: {'network'})
+            service {str} -- logger name (default: {'AlmaSru'})
+            instance {str} -- Prod or Test (default: {'Prod'})
+            transport {AlmaTransport} -- HTTP transport, the shared one by default (default: {None})
+            index {SruIdentifierIndex} -- local index of the lookups, SRU is only called for its misses (default: {None})
+            endpoint {str} -- other server than the institution one, e.g. http://127.0.0.1:8080 (default: {None})
+        """
         self.logger = logging.getLogger(service)
         self.institution = institution
         self.service = service
         self.instance = instance
+        self.index = index
+        self.endpoint = endpoint
+        self.transport = transport if transport is not None else Alma_Apis_Transport.get_transport()
+
+    @property
+    def metrics(self):
+        """Counters of the calls of the transport (Alma_Apis_Metrics.Metrics): snapshot(), dump(), add_hook()"""
+        return self.transport.metrics
 
     @property
 
     def baseurl(self):
+        if self.endpoint is not None:
+            return "{}/view/sru/{}?version=1.2&operation=searchRetrieve".format(self.endpoint, "33PUDB_"+self.institution.upper())
         if self.instance == 'Test' :
             return "https://pudb-{}-psb.alma.exlibrisgroup.com/view/sru/{}?version=1.2&operation=searchRetrieve".format(self.institution.lower(),"33PUDB_"+self.institution.upper())
         else :
             return "https://pudb-{}.alma.exlibrisgroup.com/view/sru/{}?version=1.2&operation=searchRetrieve".format(self.institution.lower(),"33PUDB_"+self.institution.upper())
 
-    def fullurl(self, query, reponseFormat,index,noticesSuppr,complex_query):
-        return self.baseurl + '&format=' + reponseFormat + '&query=' + self.searchQuery(query, index, noticesSuppr, complex_query)
+    @Alma_Apis_Tracing.traced('build_url')
+    def fullurl(self, query, reponseFormat,index,noticesSuppr,complex_query, start_record=None, maximum_records=None):
+        url = self.baseurl + '&format=' + reponseFormat + '&query=' + self.searchQuery(query, index, noticesSuppr, complex_query)
+        if start_record is not None:
+            url += '&startRecord={}'.format(start_record)
+        if maximum_records is not None:
+            url += '&maximumRecords={}'.format(maximum_records)
+        return url
 
     def searchQuery(self, query, index, noticesSuprr, complex_query):
         if complex_query :
@@ -45,18 +78,69 @@ class AlmaSru(object):
             searchQuery += ' and alma.mms_tagSuppressed=false'
         return urllib.parse.quote(searchQuery)
 
-    def sru_request(self, query ,reponseFormat='marcxml', index='alma.all_for_ui',noticesSuppr=False, complex_query=False):
-        url=self.fullurl(query,reponseFormat, index,noticesSuppr,complex_query)
+    def sru_request(self, query ,reponseFormat='marcxml', index='alma.all_for_ui',noticesSuppr=False, complex_query=False,
+                    start_record=None, maximum_records=None):
+        url=self.fullurl(query,reponseFormat, index,noticesSuppr,complex_query, start_record, maximum_records)
         self.logger.debug("{} :: alma_sru :: {}".format(query,url))
-        r = requests.get(url)
+        r = self.transport.request('GET', url)
         try:
             r.raise_for_status()  
         except requests.exceptions.HTTPError:
             raise HTTPError(r,self.service)
-        reponse = r.content.decode('utf-8')
-        reponsexml = ET.fromstring(reponse)
+        with Alma_Apis_Tracing.span('parse_sru'):
+            reponse = r.content.decode('utf-8')
+            reponsexml = ET.fromstring(reponse)
         return reponsexml
 
+    def sru_search_iter(self, query ,reponseFormat='marcxml', index='alma.all_for_ui',noticesSuppr=False, complex_query=False,
+                        start_record=1, maximum_records=SRU_MAXIMUM_RECORDS):
+        """
+        Yield every record of a search, page after page. Answers are read as a byte stream and parsed
+        incrementally: each sru:record is cleared once yielded, so memory stays flat whatever the number of results.
+        Copy a record (copy.deepcopy) to keep it after the next iteration.
+
+        Arguments:
+            query {string} -- search value, or CQL query if complex_query
+
+        Keyword Arguments:
+            reponseFormat {string} -- record format (default: {'marcxml'})
+            index {string} -- search index (default: {'alma.all_for_ui'})
+            noticesSuppr {bool} -- include suppressed records (default: {False})
+            complex_query {bool} -- query is a full CQL query (default: {False})
+            start_record {int} -- position of the first record, to resume a crawl (default: {1})
+            maximum_records {int} -- page size (default: {SRU_MAXIMUM_RECORDS})
+
+        Yields:
+            Element -- sru:record
+        """
+        records_tag = '{{{}}}records'.format(ns['sru'])
+        record_tag = '{{{}}}record'.format(ns['sru'])
+        next_tag = '{{{}}}nextRecordPosition'.format(ns['sru'])
+        while start_record:
+            url=self.fullurl(query,reponseFormat, index,noticesSuppr,complex_query, start_record, maximum_records)
+            self.logger.debug("{} :: alma_sru :: {}".format(query,url))
+            r = self.transport.request('GET', url, stream=True)
+            try:
+                try:
+                    r.raise_for_status()
+                except requests.exceptions.HTTPError:
+                    raise HTTPError(r,self.service)
+                r.raw.decode_content = True
+                records, next_record = None, None
+                for event, elem in ET.iterparse(r.raw, events=('start', 'end')):
+                    if event == 'start':
+                        if elem.tag == records_tag:
+                            records = elem
+                    elif elem.tag == record_tag and records is not None and len(records) and records[0] is elem:
+                        yield elem
+                        records.remove(elem)
+                        elem.clear()
+                    elif elem.tag == next_tag:
+                        next_record = elem.text
+            finally:
+                r.close()
+            start_record = int(next_record) if next_record else None
+
     def get_nombre_resultats(self,reponsexml):
         
         if reponsexml.find("sru:numberOfRecords",ns).text:
@@ -75,7 +159,12 @@ class AlmaSru(object):
         return holdingList
 
     def ppnToMmsid(self, query ):
+        if self.index is not None:
+            cached = self.index.get_mms_id(query)
+            if cached is not None:
+                return cached[1] if cached[0] == 1 else 'Ko'
         reponse = self.sru_request(query=query ,reponseFormat='marcxml', index='alma.other_system_number')
+        self._index_reponse(query, reponse)
         if  self.get_nombre_resultats(reponse) == '1' :
             mmsId = self.get_mmsId(reponse.find("sru:records/sru:record",ns))
             return mmsId
@@ -83,8 +172,13 @@ class AlmaSru(object):
             return 'Ko'
     
     def originatingSystemIdToMmsid(self, origanitingSystemId ):
+        if self.index is not None:
+            cached = self.index.get_mms_id(origanitingSystemId)
+            if cached is not None:
+                return cached[1] if cached[0] == 1 else 'Ko'
         query = "alma.mms_originatingSystemId={0} or alma.other_system_number={0}".format(origanitingSystemId)
         reponse = self.sru_request(query=query ,reponseFormat='marcxml', index='None', complex_query = True)
+        self._index_reponse(origanitingSystemId, reponse)
         if  self.get_nombre_resultats(reponse) == '1' :
             mmsId = self.get_mmsId(reponse.find("sru:records/sru:record",ns))
             return mmsId
@@ -104,15 +198,27 @@ class AlmaSru(object):
             string -- mms id of Alma record
             list -- list of holding id
         """
-        reponse = self.sru_request(query=ppn ,reponseFormat='marcxml', index='alma.other_system_number')
-        nb_result = self.get_nombre_resultats(reponse)
+        cached = self.index.get_mms_id(ppn) if self.index is not None else None
+        if cached is not None and cached[0] == 1:
+            mms_id = cached[1]
+            holdingIdList = self.index.get_holdings(mms_id, library_id)
+            nb_result = '1'
+        if cached is None or (cached[0] == 1 and holdingIdList is None):
+            reponse = self.sru_request(query=ppn ,reponseFormat='marcxml', index='alma.other_system_number')
+            self._index_reponse(ppn, reponse)
+            nb_result = self.get_nombre_resultats(reponse)
+            if nb_result == '1':
+                mms_id = self.get_mmsId(reponse.find("sru:records/sru:record",ns))
+                holdingIdList = self.get_holdingId(reponse.find("sru:records/sru:record/sru:recordData/marc:record",ns),library_id)
+                if self.index is not None:
+                    self.index.set_holdings(mms_id, library_id, holdingIdList)
+        else:
+            nb_result = str(cached[0])
         if  nb_result != '1' :
             self.logger.error("{} :: AlmaSru.ppn_to_holding_id :: {} notices dans Alma".format(ppn, nb_result))
             error_msg = "{} notices dans Alma pour le ppn {}".format(nb_result, ppn)
             return 'Ko', error_msg, 0, 0
         else :
-            mms_id = self.get_mmsId(reponse.find("sru:records/sru:record",ns))
-            holdingIdList = self.get_holdingId(reponse.find("sru:records/sru:record/sru:recordData/marc:record",ns),library_id)
             self.logger.debug("{} :: AlmaSru.ppn_to_holding_id :: {} holdings dans Alma pour le mms id {}".format(ppn, len(holdingIdList), mms_id))
             if len(holdingIdList) == 0:
                 self.logger.error("{} :: AlmaSru.ppn_to_holding_id :: Aucune holding dans Alma pour le mms id {}".format(ppn, mms_id))
@@ -120,7 +226,105 @@ class AlmaSru(object):
                 return 'Ko', error_msg, 0, 0
             else:
                 return 'Ok', nb_result, mms_id, holdingIdList
+
+    def _index_reponse(self, identifier, reponse):
+        """Store the result of a lookup in the identifier index"""
+        if self.index is None:
+            return
+        nb_result = int(self.get_nombre_resultats(reponse))
+        if nb_result == 1:
+            record = reponse.find("sru:records/sru:record",ns)
+            mms_id = self.get_mmsId(record)
+            self.index.add_record(mms_id, record.find("sru:recordData/marc:record",ns))
+            self.index.set_mms_id(identifier, 1, mms_id)
+        else:
+            self.index.set_mms_id(identifier, nb_result)
             
+    def get_other_system_numbers(self,record):
+        """Return the 035 $a values of a marc record"""
+        return [subfield.text.strip() for subfield in record.findall("marc:datafield[@tag='035']/marc:subfield[@code='a']",ns)
+                if subfield.text]
+
+    def ppns_to_mmsids(self, ppns, library_id=None, max_url_length=2000, max_workers=1):
+        """
+        Resolve many PPN with few SRU calls. PPN are packed in OR-combined queries as long as
+        the url stays under max_url_length, and every page of the results is read. Each record
+        is mapped back to the PPN it matched with its 035 fields.
+
+        Arguments:
+            ppns {iterable} -- ppn des notices. Préfixés par (PPN)
+
+        Keyword Arguments:
+            library_id {string} -- Alma library id. If given, holdings ids of the library are returned (default: {None})
+            max_url_length {int} -- maximum length of a SRU url (default: {2000})
+            max_workers {int} -- number of queries run concurrently (default: {1})
+
+        Returns:
+            dict -- ppn -> (status, mms_id, holding ids).
+                status is Ok (one record), Ko (no record) or Ambiguous (several records, mms_id is then the list of mms id).
+                holding ids is None if library_id is not given.
+        """
+        ppns = list(dict.fromkeys(ppn.strip() for ppn in ppns))
+        results = {}
+        unresolved = []
+        for ppn in ppns:
+            cached = self.index.get_mms_id(ppn) if self.index is not None else None
+            if cached is not None and cached[0] == 0:
+                results[ppn] = ('Ko', None, None)
+            elif cached is not None and cached[0] == 1:
+                holdings = self.index.get_holdings(cached[1], library_id) if library_id is not None else None
+                if library_id is None or holdings is not None:
+                    results[ppn] = ('Ok', cached[1], holdings)
+                else:
+                    unresolved.append(ppn)
+            else:
+                unresolved.append(ppn)
+        matches = {}
+        for batch, records in Alma_Apis_Concurrent.imap(self._search_ppns, self._ppn_queries(unresolved, max_url_length),
+                                                         max_workers=max_workers):
+            for mms_id, record in records:
+                for ppn in set(batch).intersection(self.get_other_system_numbers(record)):
+                    matches.setdefault(ppn, []).append((mms_id, record))
+        for ppn in unresolved:
+            found = matches.get(ppn, [])
+            if len(found) == 0:
+                self.logger.error("{} :: AlmaSru.ppns_to_mmsids :: 0 notices dans Alma".format(ppn))
+                results[ppn] = ('Ko', None, None)
+            elif len(found) > 1:
+                self.logger.error("{} :: AlmaSru.ppns_to_mmsids :: {} notices dans Alma".format(ppn, len(found)))
+                results[ppn] = ('Ambiguous', [mms_id for mms_id, record in found], None)
+            else:
+                mms_id, record = found[0]
+                holdings = self.get_holdingId(record, library_id) if library_id is not None else None
+                results[ppn] = ('Ok', mms_id, holdings)
+                if self.index is not None:
+                    self.index.add_record(mms_id, record)
+                    if library_id is not None:
+                        self.index.set_holdings(mms_id, library_id, holdings)
+            if self.index is not None:
+                self.index.set_mms_id(ppn, len(found), found[0][0] if len(found) == 1 else None)
+        return {ppn: results[ppn] for ppn in ppns}
+
+    def _ppn_queries(self, ppns, max_url_length):
+        """Yield batches of ppn whose OR-combined query fits in max_url_length"""
+        batch = []
+        for ppn in ppns:
+            if batch and len(self.fullurl(self._ppn_query(batch + [ppn]), 'marcxml', None, False, True,
+                                          1, SRU_MAXIMUM_RECORDS)) > max_url_length:
+                yield batch
+                batch = []
+            batch.append(ppn)
+        if batch:
+            yield batch
+
+    def _ppn_query(self, ppns):
+        return '(' + ' or '.join('alma.other_system_number="{}"'.format(ppn) for ppn in ppns) + ')'
+
+    def _search_ppns(self, ppns):
+        """Return (mms_id, marc record) of every record of every page of the query of a batch of ppn"""
+        return [(self.get_mmsId(record), copy.deepcopy(record.find("sru:recordData/marc:record",ns)))
+                for record in self.sru_search_iter(self._ppn_query(ppns), index=None, complex_query=True)]
+
 #Gestion des erreurs
 class HTTPError(Exception):
 
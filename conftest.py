@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import sys
+import types
+import inspect
+
+import pytest
+
+#Scripts de test manuels, lancés sur les instances Alma de production
+collect_ignore = ['test_alma_sru.py', 'test_alma_user_api.py']
+
+
+class Mail(object):
+    """Stand-in of mail.Mail: messages are kept instead of being sent"""
+    sent = []
+
+    def envoie(self, *args, **kwargs):
+        Mail.sent.append(args)
+
+
+#Les clients importent les modules internes mail et logs : modules factices s'ils ne sont pas installés
+for name, attributes in (('mail', {'Mail': Mail}), ('logs', {})):
+    try:
+        __import__(name)
+    except ImportError:
+        package, module = types.ModuleType(name), types.ModuleType(name + '.' + name)
+        module.__dict__.update(attributes)
+        setattr(package, name, module)
+        sys.modules[name] = package
+        sys.modules[name + '.' + name] = module
+
+import Alma_Apis_Bench
+import Alma_Apis_Transport
+
+#Clé d'API des clients du serveur factice, qui ne la vérifie pas
+APIKEY = 'test'
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'fake_alma(**kwargs): arguments of the FakeAlmaServer of the server fixture')
+
+
+@pytest.fixture
+def server(request):
+    """FakeAlmaServer started for the test, with the arguments of the fake_alma mark of the test, class or module"""
+    marker = request.node.get_closest_marker('fake_alma')
+    with Alma_Apis_Bench.FakeAlmaServer(**(marker.kwargs if marker is not None else {})) as server:
+        yield server
+
+
+@pytest.fixture
+def transport():
+    """Transport without rate limit: the fake server answers as fast as it can"""
+    return Alma_Apis_Transport.AlmaTransport(rate_limit=False)
+
+
+@pytest.fixture
+def client(server, transport):
+    """Factory of the clients of the fake server, e.g. client(Alma_Apis_Records.AlmaRecords, barcode_index=index).
+
+    The transport fixture and the endpoint of the server are given to the client, and a test API key
+    to the clients taking one. Other keyword arguments are passed to the client.
+    """
+    def client(client_class, **kwargs):
+        #Les clients asyncio prennent les arguments de leur client synchrone
+        if 'apikey' in inspect.signature(getattr(client_class, 'CLIENT', None) or client_class).parameters:
+            kwargs.setdefault('apikey', APIKEY)
+        kwargs.setdefault('transport', transport)
+        return client_class(endpoint=server.url, **kwargs)
+    return client
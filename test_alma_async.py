@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import asyncio
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import Alma_Apis_Async
+import Alma_Apis_Transport
+
+pytestmark = pytest.mark.fake_alma(latency=0.01)
+
+
+def test_concurrency_defaults_to_the_pool():
+    transport = Alma_Apis_Transport.AlmaTransport(pool_maxsize=12)
+    api = Alma_Apis_Async.AsyncAlmaRecords(apikey='test', region='EU', transport=transport)
+    assert api.concurrency == 12
+    assert api.executor._max_workers == 12
+    api.close()
+
+
+def test_pool_is_sized_with_the_concurrency():
+    # without transport, one pooled connection by call in flight
+    api = Alma_Apis_Async.AsyncAlmaRecords(apikey='test', region='EU', concurrency=40)
+    assert api.transport is not Alma_Apis_Transport.get_transport()
+    assert api.transport.pool_maxsize == 40 and api.executor._max_workers == 40
+    api.close()
+    # a given transport is not resized
+    with pytest.raises(ValueError):
+        Alma_Apis_Async.AsyncAlmaRecords(apikey='test', region='EU', concurrency=40,
+                                         transport=Alma_Apis_Transport.AlmaTransport(pool_maxsize=10))
+
+
+def test_coroutines(server, client):
+    async def main():
+        async with client(Alma_Apis_Async.AsyncAlmaRecords) as api:
+            return await asyncio.gather(*(api.get_holding('99{}'.format(n), '22{}'.format(n)) for n in range(20)))
+
+    results = asyncio.run(main())
+    assert [ET.fromstring(holding).findtext('holding_id') for status, holding in results] == \
+        ['22{}'.format(n) for n in range(20)]
+    assert server.counts['holding'] == 20
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_get_items_by_barcodes(server, client, ordered):
+    barcodes = ['B{}'.format(n) for n in range(30)] + ['B3', ' B4 ']
+
+    async def main():
+        async with client(Alma_Apis_Async.AsyncAlmaRecords, concurrency=4) as api:
+            return [result async for result in api.get_items_by_barcodes(barcodes, ordered=ordered)]
+
+    results = asyncio.run(main())
+    assert len(results) == 30
+    if ordered:
+        assert [barcode for barcode, status, item in results] == barcodes[:30]
+    assert all(status == 'Success' and ET.fromstring(item).findtext('item_data/barcode') == barcode
+               for barcode, status, item in results)
+    # one redirected call per distinct barcode
+    assert server.counts['item_by_barcode'] == 30
+
+
+def test_errors_are_returned(server, client):
+    server.error_rate, server.error_status = 1.0, 400
+
+    async def main():
+        async with client(Alma_Apis_Async.AsyncAlmaRecords) as api:
+            return await api.get_holding('991', '221')
+
+    status, message = asyncio.run(main())
+    assert status == 'Error' and 'GENERAL_ERROR' in message
+
+
+def test_set_errors_are_raised(server, client):
+    server.failures = [r'/conf/sets/']
+
+    async def main():
+        async with client(Alma_Apis_Async.AsyncAlmaRecords) as api:
+            return await api.get_set_member_number('9001')
+
+    with pytest.raises(Alma_Apis_Transport.AlmaApiError):
+        asyncio.run(main())
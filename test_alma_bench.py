@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import xml.etree.ElementTree as ET
+
+import pytest
+import requests
+
+import Alma_Apis_Bench
+import Alma_Apis_Transport
+
+
+@pytest.fixture
+def server():
+    with Alma_Apis_Bench.FakeAlmaServer(set_size=250, sru_records=25, job_duration=0.2) as server:
+        yield server
+
+
+def test_routes(server):
+    session = requests.Session()
+    r = session.get(server.url + '/almaws/v1/items', params={'item_barcode': 'B12'})
+    assert r.status_code == 200
+    assert r.url.endswith('/bibs/9912/holdings/2212/items/2312')
+    assert ET.fromstring(r.content).findtext('item_data/barcode') == 'B12'
+    r = session.get(server.url + '/almaws/v1/bibs', params={'mms_id': '991,992'}, headers={'Accept': 'application/json'})
+    assert [bib['mms_id'] for bib in r.json()['bib']] == ['991', '992']
+    page = session.get(server.url + '/almaws/v1/conf/sets/9001/members', params={'offset': 200, 'limit': 100},
+                       headers={'Accept': 'application/json'}).json()
+    assert page['total_record_count'] == 250 and len(page['member']) == 50
+    r = session.put(server.url + '/almaws/v1/bibs/991/holdings/221', data='<holding/>')
+    assert r.text == '<holding/>'
+    assert server.counts == {'item_by_barcode': 1, 'item': 1, 'bibs': 1, 'set_members': 1, 'holding': 1}
+
+
+def test_unknown_route(server):
+    r = requests.get(server.url + '/almaws/v1/acq/vendors', headers={'Accept': 'application/json'})
+    assert r.status_code == 400
+    assert r.json()['errorList']['error'][0]['errorCode'] == '402204'
+
+
+def test_sru_paging(server):
+    r = requests.get(server.url + '/view/sru/33PUDB_NETWORK',
+                     params={'query': 'alma.all_for_ui=x', 'startRecord': 21, 'maximumRecords': 10})
+    root = ET.fromstring(r.content)
+    ns = {'sru': Alma_Apis_Bench.SRU_NS}
+    assert root.findtext('sru:numberOfRecords', namespaces=ns) == '25'
+    assert len(root.findall('sru:records/sru:record', ns)) == 5
+    assert root.find('sru:nextRecordPosition', ns) is None
+    r = requests.get(server.url + '/view/sru/33PUDB_NETWORK', params={'query': 'alma.other_system_number=(PPN)123'})
+    assert ET.fromstring(r.content).findtext('sru:records/sru:record/sru:recordIdentifier', namespaces=ns) == '99123'
+
+
+def test_job_instance(server):
+    job = requests.post(server.url + '/almaws/v1/conf/jobs/M38', params={'op': 'run'}, json={}).json()
+    instance = requests.get(job['additional_info']['link']).json()
+    assert instance['status']['value'] in ('QUEUED', 'RUNNING')
+
+
+def test_injected_errors():
+    with Alma_Apis_Bench.FakeAlmaServer(throttle_rate=1.0) as server:
+        r = requests.get(server.url + '/almaws/v1/users/U1', headers={'Accept': 'application/json'})
+        assert r.status_code == 429 and r.headers['Retry-After'] == '0'
+        assert r.json()['errorList']['error'][0]['errorCode'] == 'PER_SECOND_THRESHOLD'
+    with Alma_Apis_Bench.FakeAlmaServer(error_rate=0.5, seed=1) as server:
+        transport = Alma_Apis_Transport.AlmaTransport(rate_limit=False, retry=False)
+        statuses = [transport.request('GET', server.url + '/almaws/v1/users/U1').status_code for n in range(40)]
+        assert set(statuses) == {200, 500}
+
+
+def test_percentile():
+    values = [float(n) for n in range(1, 101)]
+    assert Alma_Apis_Bench.percentile(values, 0.5) == 50.0
+    assert Alma_Apis_Bench.percentile(values, 0.99) == 99.0
+    assert Alma_Apis_Bench.percentile([], 0.5) == 0.0
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import csv
+
+import pytest
+
+import Alma_Apis_Bulk
+
+ROWS = [{'user_id': 'u{}'.format(x), 'request_id': str(x), 'reason': ''} for x in range(20)]
+
+
+def test_bulk_runner_resumes(tmp_path):
+    results_path = str(tmp_path / 'results.csv')
+    calls = []
+
+    def cancel(row):
+        calls.append(row['request_id'])
+        if int(row['request_id']) % 5 == 0 and len(calls) <= 20:
+            return 'Error', 'boom'
+        return 'Success', 204
+
+    runner = Alma_Apis_Bulk.BulkRunner(cancel, Alma_Apis_Bulk.CANCEL_FIELDS, key_fields=['user_id', 'request_id'],
+                                       max_workers=4, results_path=results_path)
+    counters = runner.run(ROWS)
+    assert counters['Success'] == 16 and counters['Error'] == 4 and counters['skipped'] == 0
+    counters = runner.run(ROWS)
+    assert counters['Success'] == 4 and counters['skipped'] == 16
+    assert len(calls) == 24
+    with open(results_path, newline='') as results_file:
+        rows = list(csv.DictReader(results_file))
+    assert len(rows) == 24
+    assert rows[0].keys() == set(Alma_Apis_Bulk.CANCEL_FIELDS + Alma_Apis_Bulk.BulkRunner.RESULT_FIELDS)
+
+
+def test_bulk_runner_dry_run_and_errors():
+    def fail(row):
+        raise ValueError(row['request_id'])
+
+    assert Alma_Apis_Bulk.BulkRunner(fail, Alma_Apis_Bulk.CANCEL_FIELDS, dry_run=True).run(ROWS)['DryRun'] == 20
+    assert Alma_Apis_Bulk.BulkRunner(fail, Alma_Apis_Bulk.CANCEL_FIELDS).run(ROWS)['Error'] == 20
+
+
+class FakeAlma(object):
+    service = 'AlmaPy'
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.members = []
+        self.deleted = []
+
+    def create_set(self, name, content_type):
+        return {'id': '9001', 'name': name}
+
+    def add_set_members(self, set_id, member_ids):
+        self.members = [member_id for member_id in member_ids if member_id != 'bad']
+        return len(self.members)
+
+    def get_set_member_ids(self, set_id):
+        return self.members
+
+    def post_job(self, job_id, data):
+        self.job_data = data
+        return {'additional_info': {'link': 'https://api/almaws/v1/conf/jobs/{}/instances/42'.format(job_id)}}
+
+    def get_job_instances(self, job_id, instance_id):
+        return {'status': {'value': self.statuses.pop(0)},
+                'counter': [{'type': {'value': 'c.updated', 'desc': 'Updated'}, 'value': '2'}]}
+
+    def delete_set(self, set_id):
+        self.deleted.append(set_id)
+
+
+def test_bulk_update_with_a_job():
+    alma = FakeAlma(['QUEUED', 'RUNNING', 'COMPLETED_SUCCESS'])
+    update = Alma_Apis_Bulk.BulkUpdate(alma, 'M38', 'ITEM', threshold=2, min_interval=0,
+                                       job_parameters=[('PHYSICAL_ITEM_INFO_TYPE', 'BOOK')])
+    results, report = update.run(['1', 'bad', '2', '1'])
+    assert results['1'] == ('Success', 'COMPLETED_SUCCESS || Updated: 2')
+    assert results['bad'][0] == 'Error'
+    assert report['instance_id'] == '42' and report['rejected'] == 1
+    assert '"PHYSICAL_ITEM_INFO_TYPE"' in alma.job_data and '"9001"' in alma.job_data
+    assert alma.deleted == ['9001']
+
+
+def test_bulk_update_keeps_the_set_of_a_running_job():
+    alma = FakeAlma(['RUNNING'] * 100)
+    update = Alma_Apis_Bulk.BulkUpdate(alma, 'M38', 'ITEM', threshold=None, timeout=0.05, min_interval=0.01)
+    with pytest.raises(Alma_Apis_Bulk.BulkJobTimeoutError) as error:
+        update.run(['1', '2'])
+    assert isinstance(error.value, TimeoutError)
+    assert (error.value.job_id, error.value.set_id, error.value.instance_id) == ('M38', '9001', '42')
+    assert alma.deleted == []
+    # launched, but the instance is unknown
+    alma = FakeAlma([])
+    alma.post_job = lambda job_id, data: {}
+    with pytest.raises(Alma_Apis_Bulk.BulkJobError) as error:
+        Alma_Apis_Bulk.BulkUpdate(alma, 'M38', 'ITEM', threshold=None).run(['1'])
+    assert error.value.set_id == '9001' and error.value.instance_id is None
+    assert alma.deleted == []
+
+
+def test_bulk_update_deletes_the_set_of_a_job_not_launched():
+    def post_job(job_id, data):
+        raise ConnectionError('boom')
+
+    alma = FakeAlma([])
+    alma.post_job = post_job
+    with pytest.raises(ConnectionError):
+        Alma_Apis_Bulk.BulkUpdate(alma, 'M38', 'ITEM', threshold=None).run(['1'])
+    assert alma.deleted == ['9001']
+    alma = FakeAlma([])
+    alma.post_job = post_job
+    with pytest.raises(ConnectionError):
+        Alma_Apis_Bulk.BulkUpdate(alma, 'M38', 'ITEM', threshold=None, keep_set=True).run(['1'])
+    assert alma.deleted == []
+    # a failed job is finished
+    alma = FakeAlma(['COMPLETED_FAILED'])
+    results, report = Alma_Apis_Bulk.BulkUpdate(alma, 'M38', 'ITEM', threshold=None).run(['1'])
+    assert results['1'][0] == 'Error' and report['status'] == 'COMPLETED_FAILED'
+    assert alma.deleted == ['9001']
+
+
+def test_bulk_update_below_threshold():
+    alma = FakeAlma([])
+    update = Alma_Apis_Bulk.BulkUpdate(alma, 'M38', 'ITEM', put=lambda record_id: ('Success', record_id), threshold=10)
+    results, report = update.run(['1', '2'])
+    assert results == {'1': ('Success', '1'), '2': ('Success', '2')}
+    assert report['mode'] == 'put'
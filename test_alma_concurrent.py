@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import random
+import time
+
+import pytest
+
+import Alma_Apis_Concurrent
+
+
+def slow_square(x):
+    time.sleep(random.uniform(0, 0.01))
+    return x * x
+
+
+def test_imap_ordered():
+    assert list(Alma_Apis_Concurrent.imap(slow_square, range(50), max_workers=8)) == [(x, x * x) for x in range(50)]
+
+
+def test_imap_completion_order():
+    results = list(Alma_Apis_Concurrent.imap(slow_square, range(50), max_workers=8, ordered=False))
+    assert sorted(results) == [(x, x * x) for x in range(50)]
+
+
+def test_imap_reads_input_lazily():
+    consumed = []
+
+    def items():
+        for x in range(1000):
+            consumed.append(x)
+            yield x
+
+    results = Alma_Apis_Concurrent.imap(slow_square, items(), max_workers=4, window=8)
+    assert next(results) == (0, 0)
+    assert len(consumed) <= 9
+    results.close()
+
+
+def test_imap_raises_errors():
+    def fail(x):
+        if x == 3:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        list(Alma_Apis_Concurrent.imap(fail, range(10), max_workers=2))
+
+
+def test_chunks():
+    assert list(Alma_Apis_Concurrent.chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(Alma_Apis_Concurrent.chunks([], 3)) == []
+
+
+def test_unique():
+    assert list(Alma_Apis_Concurrent.unique(['b', 'a', 'b', 'c', 'a'])) == ['b', 'a', 'c']
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import Alma_Apis_Crawler
+import Alma_Apis_Ecollections
+
+pytestmark = pytest.mark.fake_alma(portfolios={'61': 250, '62': 30})
+
+
+def test_portfolio_pages(server, client):
+    api = client(Alma_Apis_Ecollections.AlmaERecords)
+    pages = list(api.iter_portfolio_pages('600', '61', max_workers=2))
+    assert sorted(offset for offset, total, portfolios in pages) == [0, 100, 200]
+    assert all(total == 250 for offset, total, portfolios in pages)
+    assert sum(len(portfolios) for offset, total, portfolios in pages) == 250
+    # the first page is read for the total even when it is skipped
+    pages = list(api.iter_portfolio_pages('600', '61', skip_offsets=[0, 100]))
+    assert [(offset, total, len(portfolios)) for offset, total, portfolios in pages] == [(200, 250, 50)]
+    assert server.counts['portfolios'] == 5
+
+
+def test_crawler_resumes(server, client, tmp_path):
+    output_path = str(tmp_path / 'portfolios.jsonl')
+    api = client(Alma_Apis_Ecollections.AlmaERecords)
+    server.failures = [r'e-services/61/portfolios\?(.*&)?offset=200(&|$)']
+    # one page at a time: the page 100 is read before the page 200 fails
+    counters = Alma_Apis_Crawler.PortfolioCrawler(api, output_path, max_workers=1).run('600')
+    assert counters['errors'] == 1 and counters['portfolios'] == 230
+    server.failures = []
+    server.counts = {}
+    counters = Alma_Apis_Crawler.PortfolioCrawler(api, output_path).run('600')
+    assert counters['errors'] == 0 and counters['portfolios'] == 50
+    # first page for the total, then the missing page only
+    assert server.counts == {'eservices': 1, 'portfolios': 2}
+    with open(output_path, encoding='utf-8') as output_file:
+        lines = [json.loads(line) for line in output_file]
+    assert len(lines) == 280
+    assert len({line['portfolio']['id'] for line in lines}) == 280
+    assert lines[0]['ecollection_id'] == '600' and lines[0]['eservice_id'] == '61'
+    assert lines[0]['portfolio']['id'] == '61-0'
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import time
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import Alma_Apis_Index
+import Alma_Apis_Bench
+import Alma_Sru
+
+RECORD = """<record xmlns="http://www.loc.gov/MARC21/slim">
+    <datafield tag="035"><subfield code="a">(PPN)039550117</subfield></datafield>
+    <datafield tag="035"><subfield code="a">(OCoLC)12345</subfield></datafield>
+    <datafield tag="AVA"><subfield code="b">1103300000</subfield><subfield code="8">221</subfield></datafield>
+    <datafield tag="AVA"><subfield code="b">1103300000</subfield><subfield code="8">222</subfield></datafield>
+    <datafield tag="AVA"><subfield code="b">1103400000</subfield><subfield code="8">223</subfield></datafield>
+</record>"""
+
+
+def test_sru_index_record(tmp_path):
+    index = Alma_Apis_Index.SruIdentifierIndex(str(tmp_path / 'index.sqlite'))
+    index.add_record('991', ET.fromstring(RECORD))
+    assert index.get_mms_id('(PPN)039550117') == (1, '991')
+    assert index.get_mms_id('(OCoLC)12345') == (1, '991')
+    assert index.get_mms_id('(PPN)000000000') is None
+    assert index.get_holdings('991', '1103300000') == ['221', '222']
+    assert index.get_holdings('991', '1103400000') == ['223']
+    assert index.stats()['misses'] == 1
+    index.close()
+    index = Alma_Apis_Index.SruIdentifierIndex(str(tmp_path / 'index.sqlite'))
+    assert index.get_mms_id('(PPN)039550117') == (1, '991')
+
+
+def test_sru_index_freshness():
+    index = Alma_Apis_Index.SruIdentifierIndex(':memory:', max_age=60, negative_max_age=0.05)
+    index.set_mms_id('(PPN)1', 1, '991')
+    index.set_mms_id('(PPN)2', 0)
+    index.set_mms_id('(PPN)3', 2)
+    assert index.get_mms_id('(PPN)2') == (0, None)
+    assert index.get_mms_id('(PPN)3') == (2, None)
+    time.sleep(0.1)
+    assert index.get_mms_id('(PPN)1') == (1, '991')
+    assert index.get_mms_id('(PPN)2') is None
+    index.purge()
+    assert index.get_mms_id('(PPN)3') is None
+    assert index.get_mms_id('(PPN)1') == (1, '991')
+
+
+def test_sru_index_shared_identifiers():
+    index = Alma_Apis_Index.SruIdentifierIndex(':memory:')
+    index.add_record('991', ET.fromstring(RECORD))
+    index.add_record('992', ET.fromstring(RECORD.replace('(OCoLC)12345', '(OCoLC)67890')))
+    index.add_record('992', ET.fromstring(RECORD.replace('(OCoLC)12345', '(OCoLC)67890')))
+    assert index.get_mms_id('(PPN)039550117') == (2, None)
+    assert index.get_mms_id('(OCoLC)12345') == (1, '991')
+    assert index.get_mms_id('(OCoLC)67890') == (1, '992')
+    # a lookup replaces what the records told
+    index.set_mms_id('(PPN)039550117', 1, '992')
+    assert index.get_mms_id('(PPN)039550117') == (1, '992')
+    index.add_record('991', ET.fromstring(RECORD))
+    assert index.get_mms_id('(PPN)039550117') == (2, None)
+    # a record is not less ambiguous than a fresh lookup
+    index.set_mms_id('(OCoLC)1', 3)
+    index.add_record('993', ET.fromstring(RECORD.replace('(OCoLC)12345', '(OCoLC)1')))
+    assert index.get_mms_id('(OCoLC)1') == (3, None)
+    index.set_mms_id('(OCoLC)2', 0)
+    index.add_record('994', ET.fromstring(RECORD.replace('(OCoLC)12345', '(OCoLC)2')))
+    assert index.get_mms_id('(OCoLC)2') == (1, '994')
+
+
+@pytest.mark.fake_alma(catalog={'991': ['(PPN)1'], '992': ['(PPN)2'], '993': ['(PPN)3', '(PPN)1']})
+def test_sru_index_warm_up(client):
+    index = Alma_Apis_Index.SruIdentifierIndex(':memory:')
+    # one record by page and by transaction: (PPN)1 is shared across batches
+    count = index.warm_up(client(Alma_Sru.AlmaSru), 'alma.other_system_number="(PPN)1" or alma.other_system_number="(PPN)2"',
+                          batch_size=1, maximum_records=1)
+    assert count == 3
+    assert index.get_mms_id('(PPN)1') == (2, None)
+    assert index.get_mms_id('(PPN)2') == (1, '992')
+    assert index.get_mms_id('(PPN)3') == (1, '993')
+    assert index.get_holdings('993', Alma_Apis_Bench.LIBRARY_ID) == ['223']
+
+
+ITEM = """<item>
+    <bib_data><mms_id>991</mms_id></bib_data>
+    <holding_data><holding_id>221</holding_id></holding_data>
+    <item_data><pid>231</pid><barcode>B001</barcode></item_data>
+</item>"""
+
+
+def test_item_path():
+    assert Alma_Apis_Index.item_path(ITEM) == ('B001', '991', '221', '231')
+    item = {'bib_data': {'mms_id': '991'}, 'holding_data': {'holding_id': '221'},
+            'item_data': {'pid': '231', 'barcode': 'B001'}}
+    assert Alma_Apis_Index.item_path(item) == ('B001', '991', '221', '231')
+    assert Alma_Apis_Index.item_path('<item/>') is None
+    assert Alma_Apis_Index.item_path('not xml') is None
+
+
+def test_barcode_index():
+    index = Alma_Apis_Index.BarcodeIndex(':memory:')
+    index.add_item(ITEM)
+    assert index.get('B001') == ('991', '221', '231')
+    # relocated item with a new barcode
+    index.set('B002', '991', '222', '231')
+    assert index.get('B001') is None
+    assert index.get('B002') == ('991', '222', '231')
+    index.invalidate(item_id='231')
+    assert index.get('B002') is None
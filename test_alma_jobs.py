@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+import pytest
+
+import Alma_Apis_Jobs
+
+
+class FakeAlma(object):
+    service = 'AlmaPy'
+
+    def __init__(self, runs):
+        # instance id -> list of (status, progress) returned by the successive reads
+        self.runs = runs
+        self.reads = 0
+        self.lock = threading.Lock()
+
+    def get_job_instances(self, job_id, instance_id):
+        with self.lock:
+            self.reads += 1
+            run = self.runs[instance_id]
+            status, progress = run.pop(0) if len(run) > 1 else run[0]
+        return {'status': {'value': status}, 'progress': progress}
+
+
+def test_poll_delay():
+    assert Alma_Apis_Jobs.poll_delay(0, None, 0) == 2
+    assert Alma_Apis_Jobs.poll_delay(10, None, 3) == 2 * 1.5 ** 3
+    # 20 % in 40 s: about 160 s left, read again in 60 s at most
+    assert Alma_Apis_Jobs.poll_delay(40, 20, 5) == 60
+    assert Alma_Apis_Jobs.poll_delay(9, 90, 5) == 2
+    assert Alma_Apis_Jobs.poll_delay(30, 60, 5) == 10
+
+
+def test_wait_for_job():
+    alma = FakeAlma({'1': [('QUEUED', 0), ('RUNNING', 50), ('COMPLETED_SUCCESS', 100)]})
+    instance = Alma_Apis_Jobs.wait_for_job(alma, 'M1', '1', min_interval=0.01, max_interval=0.01)
+    assert Alma_Apis_Jobs.job_outcome(instance) == ('Success', 'COMPLETED_SUCCESS')
+    assert alma.reads == 3
+    alma = FakeAlma({'2': [('RUNNING', 10)]})
+    with pytest.raises(TimeoutError):
+        Alma_Apis_Jobs.wait_for_job(alma, 'M1', '2', timeout=0.05, min_interval=0.01, max_interval=0.01)
+
+
+def test_job_monitor_chains_jobs():
+    alma = FakeAlma({'1': [('RUNNING', 10), ('COMPLETED_SUCCESS', 100)],
+                     '2': [('QUEUED', None), ('COMPLETED_FAILED', 100)],
+                     '3': [('COMPLETED_SUCCESS', 100)]})
+    changes = []
+    monitor = Alma_Apis_Jobs.JobMonitor(alma, on_change=lambda job_id, instance_id, previous, instance:
+                                        changes.append((instance_id, previous, instance['status']['value'])),
+                                        min_interval=0.01, max_interval=0.02)
+    monitor.watch('M1', '1', on_finish=lambda job_id, instance_id, instance: monitor.watch('M2', '3'))
+    monitor.watch('M1', '2')
+    assert monitor.run(timeout=5)
+    assert set(monitor.finished) == {('M1', '1'), ('M1', '2'), ('M2', '3')}
+    assert ('1', 'RUNNING', 'COMPLETED_SUCCESS') in changes
+    assert Alma_Apis_Jobs.job_outcome(monitor.finished[('M1', '2')])[0] == 'Error'
+
+
+def test_job_monitor_in_background():
+    alma = FakeAlma({'1': [('RUNNING', 10), ('RUNNING', 60), ('COMPLETED_SUCCESS', 100)]})
+    finished = threading.Event()
+    monitor = Alma_Apis_Jobs.JobMonitor(alma, on_finish=lambda *args: finished.set(), min_interval=0.01, max_interval=0.02)
+    monitor.start()
+    time.sleep(0.05)
+    monitor.watch('M1', '1')
+    assert finished.wait(5)
+    monitor.stop()
+    assert monitor.running() == 0
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import time
+import threading
+
+import pytest
+
+import Alma_Apis_Pipeline
+
+
+def test_pipeline_outcomes():
+    written = {}
+
+    def read(record_id):
+        time.sleep(0.01)
+        if record_id == 3:
+            return 'Error', 'No record'
+        return 'Success', '<record id="{}"/>'.format(record_id)
+
+    def transform(record_id, content):
+        if record_id == 4:
+            return None
+        if record_id == 6:
+            return '<record  id="6"></record>'
+        if record_id == 5:
+            raise ValueError('bad record')
+        return content.upper()
+
+    def write(record_id, data):
+        time.sleep(0.01)
+        written[record_id] = data
+        return 'Success', data
+
+    pipeline = Alma_Apis_Pipeline.Pipeline(read, transform, write, read_workers=4, write_workers=4)
+    outcomes = {record_id: (status, content) for record_id, status, content in pipeline.run(range(20))}
+    assert len(outcomes) == 20
+    assert outcomes[0] == ('Success', '<RECORD ID="0"/>')
+    assert outcomes[3] == ('Error', 'read :: No record')
+    assert outcomes[4] == ('Unchanged', None)
+    assert outcomes[5][0] == 'Error' and 'bad record' in outcomes[5][1]
+    assert pipeline.counters == {'Success': 16, 'Error': 2, 'Unchanged': 2}
+    assert len(written) == 16
+
+
+def test_pipeline_backpressure_and_early_stop():
+    read_count = [0]
+    lock = threading.Lock()
+
+    def read(record_id):
+        with lock:
+            read_count[0] += 1
+        return 'Success', record_id
+
+    def write(record_id, data):
+        time.sleep(0.05)
+        return 'Success', data
+
+    pipeline = Alma_Apis_Pipeline.Pipeline(read, lambda record_id, content: content, write,
+                                           read_workers=2, transform_workers=1, write_workers=1, queue_size=2)
+    outcomes = pipeline.run(range(10000))
+    next(outcomes)
+    outcomes.close()
+    # reads are held back by the bounded queues
+    assert read_count[0] < 20
+
+
+def test_pipeline_raises_the_error_of_the_ids():
+    def record_ids():
+        yield 1
+        yield 2
+        raise RuntimeError('set page 2 failed')
+
+    pipeline = Alma_Apis_Pipeline.Pipeline(lambda record_id: ('Success', '<r>{}</r>'.format(record_id)),
+                                           lambda record_id, content: content.replace('r>', 's>'),
+                                           lambda record_id, data: ('Success', data), read_workers=3, write_workers=2)
+    outcomes = []
+    with pytest.raises(RuntimeError, match='set page 2 failed'):
+        for outcome in pipeline.run(record_ids()):
+            outcomes.append(outcome)
+    # the records read before the error are processed first
+    assert sorted(outcomes) == [(1, 'Success', '<s>1</s>'), (2, 'Success', '<s>2</s>')]
+
+
+def test_item_link():
+    match = Alma_Apis_Pipeline.ITEM_LINK.search(
+        'https://api-eu.hosted.exlibrisgroup.com/almaws/v1/bibs/991/holdings/221/items/231?view=brief')
+    assert match.group('bib_id', 'holding_id', 'item_id') == ('991', '221', '231')
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import Alma_Apis_Records
+import Alma_Apis_Index
+import Alma_Apis_Bench
+import Alma_Apis_Transport
+
+
+@pytest.mark.fake_alma(missing_records=['99120'])
+@pytest.mark.parametrize('accept', ['xml', 'json'])
+def test_get_records(server, client, accept):
+    mms_ids = ['99{}'.format(n) for n in range(250)]
+    results, missing = client(Alma_Apis_Records.AlmaRecords).get_records(mms_ids, accept=accept, max_workers=2)
+    assert server.counts['bibs'] == 3
+    assert missing == ['99120']
+    assert sorted(results) == sorted(set(mms_ids) - {'99120'})
+    status, record = results['9942']
+    assert status == 'Success'
+    if accept == 'xml':
+        assert ET.fromstring(record).findtext('mms_id') == '9942'
+    else:
+        assert record['mms_id'] == '9942'
+
+
+@pytest.mark.fake_alma(set_size=250)
+def test_iter_set_members(server, client):
+    api = client(Alma_Apis_Records.AlmaRecords)
+    members = list(api.iter_set_members('9001', prefetch=3))
+    assert [member['id'] for member in members] == ['23{}'.format(n) for n in range(250)]
+    assert server.counts == {'set': 1, 'set_members': 3}
+    # resumed from an offset
+    members = list(api.iter_set_members('9001', offset=200, limit=25))
+    assert [member['id'] for member in members] == ['23{}'.format(n) for n in range(200, 250)]
+
+
+@pytest.mark.fake_alma(set_size=250, failures=[r'members\?(.*&)?offset=100(&|$)'])
+def test_set_errors_are_raised(server, client):
+    api = client(Alma_Apis_Records.AlmaRecords)
+    members = api.iter_set_members('9001', prefetch=1)
+    assert len([next(members) for n in range(100)]) == 100
+    with pytest.raises(Alma_Apis_Transport.AlmaApiError) as error:
+        next(members)
+    assert error.value.resource == 'get_set_members'
+    with pytest.raises(Alma_Apis_Transport.AlmaApiError):
+        api.get_set_members('9001', offset=100)
+    server.failures = [r'/conf/sets/9001(\?|$)']
+    with pytest.raises(Alma_Apis_Transport.AlmaApiError):
+        api.get_set_member_number('9001')
+    with pytest.raises(Alma_Apis_Transport.AlmaApiError):
+        list(api.iter_set_members('9001'))
+
+
+@pytest.mark.fake_alma(latency=0.01, error_status=502, gateway_failures=[r'item_barcode=B7(&|$)'])
+@pytest.mark.parametrize('ordered', [True, False])
+def test_get_items_by_barcodes(server, client, ordered):
+    api = client(Alma_Apis_Records.AlmaRecords, transport=Alma_Apis_Transport.AlmaTransport(rate_limit=False, retry=False))
+    barcodes = ['B{}'.format(n) for n in range(20)] + ['B3', ' B4 ']
+    results = list(api.get_items_by_barcodes(barcodes, max_workers=4, ordered=ordered))
+    if ordered:
+        assert [barcode for barcode, status, item in results] == barcodes[:20]
+    else:
+        assert sorted(barcode for barcode, status, item in results) == sorted(barcodes[:20])
+    # the HTML page of the gateway only fails its barcode
+    errors = {barcode: item for barcode, status, item in results if status == 'Error'}
+    assert list(errors) == ['B7']
+    assert all(ET.fromstring(item).findtext('item_data/barcode') == barcode
+               for barcode, status, item in results if status == 'Success')
+    # one redirected call per distinct barcode, the failed one is not routed
+    assert server.counts['item_by_barcode'] == 19
+
+
+@pytest.fixture
+def indexed(client):
+    """AlmaRecords client with a barcode index"""
+    return client(Alma_Apis_Records.AlmaRecords, barcode_index=Alma_Apis_Index.BarcodeIndex(':memory:'))
+
+
+def test_barcode_index_is_filled(server, indexed):
+    status, item = indexed.get_item_with_barcode('B5')
+    assert status == 'Success'
+    assert indexed.barcode_index.get('B5') == ('995', '225', '235')
+    # resolved from the index without call
+    server.counts = {}
+    assert indexed.resolve_barcode('B5') == ('Success', ('995', '225', '235'))
+    assert server.counts == {}
+    # an unknown barcode is read and indexed
+    assert indexed.resolve_barcode('B6') == ('Success', ('996', '226', '236'))
+    assert server.counts == {'item_by_barcode': 1, 'item': 1}
+    assert indexed.barcode_index.get('B6') == ('996', '226', '236')
+
+
+def test_set_item_with_barcode_recovers_from_a_stale_path(server, indexed):
+    # relocated item: the indexed holding is the old one
+    indexed.barcode_index.set('B5', '995', '229', '235')
+    data = Alma_Apis_Bench.item(server.url, '995', '225', '235', 'xml')
+    status, item = indexed.set_item_with_barcode('B5', data)
+    assert status == 'Success' and ET.fromstring(item).findtext('holding_data/holding_id') == '225'
+    assert indexed.barcode_index.get('B5') == ('995', '225', '235')
+    # failed PUT, read of the stale path, read by barcode, PUT at the new path
+    assert server.counts == {'item': 4, 'item_by_barcode': 1}
+
+
+def test_rejected_update_keeps_the_indexed_path(server, indexed):
+    indexed.get_item_with_barcode('B5')
+    status, message = indexed.set_item_with_barcode('B5', 'not an item')
+    assert status == 'Error' and 'Invalid item' in message
+    assert indexed.barcode_index.get('B5') == ('995', '225', '235')
+    # the item is not read again by barcode
+    assert server.counts['item_by_barcode'] == 1
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import pytest
+
+import Alma_Sru
+import Alma_Apis_Bench
+
+#mms_id -> 035 of the records of the fake catalog
+CATALOG = {'99{}'.format(n): ['(PPN){:09d}'.format(n)] for n in range(1, 41)}
+#One record with two ppn (merged records), one ppn in two records
+CATALOG['9950'] = ['(PPN)000000050', '(PPN)000000051', '(OCoLC)50']
+CATALOG['9960'] = ['(PPN)000000060']
+CATALOG['9961'] = ['(PPN)000000060']
+
+pytestmark = pytest.mark.fake_alma(catalog=CATALOG, sru_records=120)
+
+
+def test_ppns_are_searched_in_batches(server, client):
+    api = client(Alma_Sru.AlmaSru)
+    ppns = ['(PPN){:09d}'.format(n) for n in range(1, 41)]
+    batches = list(api._ppn_queries(ppns, max_url_length=600))
+    assert len(batches) > 2
+    assert [ppn for batch in batches for ppn in batch] == ppns
+    assert all(len(api.fullurl(api._ppn_query(batch), 'marcxml', None, False, True, 1, Alma_Sru.SRU_MAXIMUM_RECORDS)) <= 600
+               for batch in batches)
+    results = api.ppns_to_mmsids(ppns + [' (PPN)000000001 '], max_url_length=600, max_workers=2)
+    assert list(results) == ppns
+    assert all(results[ppn] == ('Ok', '99{}'.format(n), None) for n, ppn in enumerate(ppns, 1))
+    assert server.counts['sru'] == len(batches)
+
+
+def test_ppns_statuses(server, client):
+    api = client(Alma_Sru.AlmaSru)
+    results = api.ppns_to_mmsids(['(PPN)000000050', '(PPN)000000051', '(PPN)000000060', '(PPN)000000099'])
+    # the record is mapped back to both of its ppn
+    assert results['(PPN)000000050'] == ('Ok', '9950', None)
+    assert results['(PPN)000000051'] == ('Ok', '9950', None)
+    status, mms_ids, holdings = results['(PPN)000000060']
+    assert status == 'Ambiguous' and sorted(mms_ids) == ['9960', '9961']
+    assert results['(PPN)000000099'] == ('Ko', None, None)
+    assert server.counts['sru'] == 1
+
+
+def test_ppns_holdings(server, client):
+    api = client(Alma_Sru.AlmaSru)
+    results = api.ppns_to_mmsids(['(PPN)000000007', '(PPN)000000099'], library_id=Alma_Apis_Bench.LIBRARY_ID)
+    assert results == {'(PPN)000000007': ('Ok', '997', ['227']), '(PPN)000000099': ('Ko', None, None)}
+    results = api.ppns_to_mmsids(['(PPN)000000007'], library_id='1100000099')
+    assert results == {'(PPN)000000007': ('Ok', '997', [])}
+
+
+def test_search_iter_follows_the_pages(server, client):
+    api = client(Alma_Sru.AlmaSru)
+    records, previous = [], None
+    for record in api.sru_search_iter('bench', maximum_records=50):
+        if previous is not None:
+            # the previous record is cleared once the next one is read
+            assert len(previous) == 0
+        records.append(api.get_mmsId(record))
+        previous = record
+    assert records == ['99{}'.format(n) for n in range(1, 121)]
+    assert server.counts['sru'] == 3
+
+
+def test_search_iter_resumes(server, client):
+    api = client(Alma_Sru.AlmaSru)
+    records = [api.get_mmsId(record) for record in api.sru_search_iter('bench', start_record=101, maximum_records=50)]
+    assert records == ['99{}'.format(n) for n in range(101, 121)]
+    assert server.counts['sru'] == 1
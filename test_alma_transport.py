@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import gc
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import Alma_Apis_Transport
+import Alma_Apis_RateLimit
+import Alma_Apis_Retry
+import Alma_Apis_Cache
+import Alma_Apis_Metrics
+import Alma_Apis_Tracing
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.ports.add(self.client_address[1])
+        self.server.calls += 1
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if 'slow' in self.path:
+            time.sleep(0.2)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = b'{"ok": true}'
+        if 'error' in self.path:
+            status, body = 400, b'{"errorsExist": true, "errorList": {"error": [{"errorCode": "401890"}]}}'
+        if 'etag' in self.path and self.headers.get('If-None-Match') == '"v1"':
+            status, body = 304, b''
+        self.send_response(status)
+        if 'etag' in self.path:
+            self.send_header('ETag', '"v1"')
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_PUT = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.ports = set()
+    httpd.calls = 0
+    httpd.statuses = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, path='/'):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+
+def test_connection_is_reused(server):
+    transport = Alma_Apis_Transport.AlmaTransport()
+    for x in range(20):
+        assert transport.request('GET', url(server)).json() == {'ok': True}
+    assert len(server.ports) == 1
+    transport.close()
+
+
+def test_pool_is_shared_between_threads(server):
+    transport = Alma_Apis_Transport.AlmaTransport(pool_maxsize=4, pool_block=True)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        statuses = list(executor.map(lambda x: transport.request('GET', url(server)).status_code, range(100)))
+    assert statuses == [200] * 100
+    assert len(server.ports) <= 4
+    transport.close()
+
+
+def test_sessions_of_finished_threads_are_freed(server):
+    transport = Alma_Apis_Transport.AlmaTransport()
+    for x in range(50):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda x: transport.request('GET', url(server)).status_code, range(8)))
+    gc.collect()
+    assert len(transport._sessions) <= 4
+    transport.close()
+
+
+def test_shared_transport():
+    transport = Alma_Apis_Transport.get_transport()
+    assert Alma_Apis_Transport.get_transport() is transport
+    other = Alma_Apis_Transport.AlmaTransport()
+    assert Alma_Apis_Transport.set_transport(other) is transport
+    assert Alma_Apis_Transport.get_transport() is other
+    Alma_Apis_Transport.set_transport(transport)
+
+
+def test_token_bucket_limits_rate():
+    bucket = Alma_Apis_RateLimit.TokenBucket(rate=50, burst=5)
+    start = time.monotonic()
+    for x in range(30):
+        bucket.acquire()
+    # 5 calls of burst, then 25 calls at 50 per second
+    assert time.monotonic() - start >= 0.45
+
+
+def test_token_bucket_pauses_on_429():
+    bucket = Alma_Apis_RateLimit.TokenBucket(rate=100)
+    response = requests.Response()
+    response.status_code = 429
+    response.headers['Retry-After'] = '0.3'
+    bucket.update(response)
+    assert bucket.throttled == 1
+    assert bucket.acquire() >= 0.25
+
+
+def test_rate_limiter_is_shared_per_key():
+    assert Alma_Apis_RateLimit.get_rate_limiter('key-a') is Alma_Apis_RateLimit.get_rate_limiter('key-a')
+    assert Alma_Apis_RateLimit.get_rate_limiter('key-a') is not Alma_Apis_RateLimit.get_rate_limiter('key-b')
+    limiter = Alma_Apis_RateLimit.set_rate_limit('key-a', 5)
+    assert Alma_Apis_RateLimit.get_rate_limiter('key-a') is limiter
+    assert limiter.rate == 5
+
+
+def test_retry_on_transient_errors(server):
+    server.statuses = [503, 429, 502]
+    policy = Alma_Apis_Retry.RetryPolicy(backoff_factor=0.01)
+    transport = Alma_Apis_Transport.AlmaTransport(retry=policy)
+    assert transport.request('GET', url(server)).status_code == 200
+    assert server.calls == 4
+    assert policy.stats() == {'retries': 3, 'retries_by_reason': {503: 1, 429: 1, 502: 1}, 'exhausted': 0}
+    transport.close()
+
+
+def test_no_retry_for_post(server):
+    server.statuses = [503]
+    transport = Alma_Apis_Transport.AlmaTransport()
+    assert transport.request('POST', url(server)).status_code == 503
+    assert server.calls == 1
+    transport.close()
+
+
+def test_retry_budget(server):
+    server.statuses = [503] * 10
+    policy = Alma_Apis_Retry.RetryPolicy(backoff_factor=0.01, max_retries=2)
+    transport = Alma_Apis_Transport.AlmaTransport(retry=policy)
+    assert transport.request('GET', url(server)).status_code == 503
+    assert server.calls == 3
+    assert policy.stats()['exhausted'] == 1
+    transport.close()
+
+
+def test_cache_get_and_invalidate(server):
+    cache = Alma_Apis_Cache.ResponseCache(ttls={'get_holding': 60})
+    transport = Alma_Apis_Transport.AlmaTransport(cache=cache)
+    holding = url(server, '/almaws/v1/bibs/1/holdings/2')
+    headers = {'Accept': 'application/json'}
+    for x in range(3):
+        transport.request('GET', holding, headers=headers, apikey='k', resource='get_holding')
+    transport.request('GET', holding, headers={'Accept': 'application/xml'}, apikey='k', resource='get_holding')
+    assert server.calls == 2
+    transport.request('PUT', url(server, '/almaws/v1/bibs/1/holdings/2'), headers=headers, apikey='k')
+    transport.request('GET', holding, headers=headers, apikey='k', resource='get_holding')
+    assert server.calls == 4
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['invalidations'] == 2
+    transport.close()
+
+
+def test_cache_lru_and_ttl():
+    cache = Alma_Apis_Cache.ResponseCache(maxsize=2, ttls={'a': 60, 'b': 0.05})
+    answers = [Alma_Apis_Cache.build_response(200, {}, b'', 'u{}'.format(x)) for x in range(6)]
+    cache.set(('u1', None, None), 'a', answers[1])
+    cache.set(('u2', None, None), 'a', answers[2])
+    assert cache.get(('u1', None, None), 'a') is answers[1]
+    cache.set(('u3', None, None), 'a', answers[3])
+    assert cache.get(('u2', None, None), 'a') is None
+    assert cache.stats()['evictions'] == 1
+    cache.set(('u4', None, None), 'b', answers[4])
+    time.sleep(0.1)
+    assert cache.get(('u4', None, None), 'b') is None
+    cache.set(('u5', None, None), 'unknown', answers[5])
+    assert cache.get(('u5', None, None), 'unknown') is None
+
+
+@pytest.mark.parametrize('cache_class', [Alma_Apis_Cache.ResponseCache, Alma_Apis_Cache.SqliteResponseCache])
+def test_cache_control(cache_class, tmp_path):
+    if cache_class is Alma_Apis_Cache.SqliteResponseCache:
+        cache = cache_class(str(tmp_path / 'cache.sqlite'), ttls={'a': 3600})
+    else:
+        cache = cache_class(ttls={'a': 3600})
+    for n, cache_control in enumerate(['max-age=0', 'no-store', 'private, no-cache', 'max-age=3600']):
+        key = ('u{}'.format(n), None, None)
+        cache.set(key, 'a', Alma_Apis_Cache.build_response(200, {'Cache-Control': cache_control}, b'{}', key[0]))
+        # only the last answer may be stored
+        assert (cache.get(key, 'a') is not None) == (cache_control == 'max-age=3600')
+    # the max-age of the answer wins over the time to live of the resource
+    key = ('u5', None, None)
+    cache.set(key, 'a', Alma_Apis_Cache.build_response(200, {'Cache-Control': 'max-age=1'}, b'{}', key[0]))
+    time.sleep(1.1)
+    assert cache.get(key, 'a') is None
+
+
+def test_cache_invalidation_scope():
+    assert Alma_Apis_Cache.is_related('/almaws/v1/bibs/1', '/almaws/v1/bibs/1/holdings/2')
+    assert Alma_Apis_Cache.is_related('/almaws/v1/bibs/1/holdings/2/items', '/almaws/v1/bibs/1/holdings/2')
+    assert not Alma_Apis_Cache.is_related('/almaws/v1/bibs/12', '/almaws/v1/bibs/1/holdings/2')
+    assert not Alma_Apis_Cache.is_related('/almaws/v1/conf/libraries/A/locations', '/almaws/v1/bibs/1')
+
+
+def test_sqlite_cache_persists_and_revalidates(server, tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    ttls = {'get_record': 60, 'get_holding': 0}
+    cache = Alma_Apis_Cache.SqliteResponseCache(path, ttls=ttls)
+    transport = Alma_Apis_Transport.AlmaTransport(cache=cache)
+    record = url(server, '/almaws/v1/bibs/1')
+    holding = url(server, '/almaws/v1/bibs/1/holdings/2/etag')
+    transport.request('GET', record, apikey='k', resource='get_record')
+    transport.request('GET', holding, apikey='k', resource='get_holding')
+    transport.close()
+    cache.close()
+    assert server.calls == 2
+
+    cache = Alma_Apis_Cache.SqliteResponseCache(path, ttls=ttls)
+    transport = Alma_Apis_Transport.AlmaTransport(cache=cache)
+    assert transport.request('GET', record, apikey='k', resource='get_record').json() == {'ok': True}
+    assert server.calls == 2
+    # expired holding: conditional call answered by 304, stored answer returned
+    response = transport.request('GET', holding, apikey='k', resource='get_holding')
+    assert server.calls == 3
+    assert response.status_code == 200 and response.json() == {'ok': True}
+    assert cache.stats()['revalidations'] == 1
+    transport.request('PUT', record, apikey='k')
+    assert cache.stats()['entries'] == 0
+    transport.close()
+    cache.close()
+
+
+def test_canonical_documents():
+    assert Alma_Apis_Cache.unchanged('<a x="1"  y="2">\n  <b>t</b>\n</a>',
+                                     b'<?xml version="1.0" encoding="UTF-8"?><a y="2" x="1"><b>t</b></a>')
+    assert not Alma_Apis_Cache.unchanged('<a><b>t</b></a>', '<a><b>u</b></a>')
+    assert not Alma_Apis_Cache.unchanged('<a><b>vol. 1 </b></a>', '<a><b>vol. 1</b></a>')
+    assert Alma_Apis_Cache.unchanged({'b': 1, 'a': [1, 2]}, '{"a": [1, 2], "b": 1}')
+    assert not Alma_Apis_Cache.unchanged('not a document', 'not a document')
+
+
+def test_unchanged_writes_are_skipped(server):
+    cache = Alma_Apis_Cache.ResponseCache(ttls={'get_holding': 60})
+    transport = Alma_Apis_Transport.AlmaTransport(cache=cache)
+    holding = url(server, '/almaws/v1/bibs/1/holdings/2')
+    headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+    # with the original document
+    response = transport.request('PUT', holding, headers=headers, data='{ "ok" : true }',
+                                 apikey='k', original={'ok': True})
+    assert response.json() == {'ok': True}
+    transport.request('PUT', holding, headers=headers, data='{"ok": false}', apikey='k', original={'ok': True})
+    assert server.calls == 1
+    # with the cached answer of the GET
+    transport.request('GET', holding, headers=headers, apikey='k', resource='get_holding')
+    response = transport.request('PUT', holding, headers=headers, data='{"ok": true}', apikey='k', resource='get_holding')
+    assert response.json() == {'ok': True}
+    assert server.calls == 2
+    assert transport.writes_skipped == 2
+    # a change of the spaces of a value is sent
+    transport.request('PUT', holding, data='<holding><note>vol. 1</note></holding>', apikey='k',
+                      original='<holding>\n  <note>vol. 1 </note>\n</holding>')
+    assert server.calls == 3
+    assert transport.writes_skipped == 2
+    transport.close()
+
+
+def test_identical_gets_are_coalesced(server):
+    transport = Alma_Apis_Transport.AlmaTransport(pool_maxsize=8)
+    holding = url(server, '/almaws/v1/bibs/1/holdings/2/slow')
+    barrier = threading.Barrier(8)
+
+    def get(accept):
+        barrier.wait()
+        return transport.request('GET', holding, headers={'Accept': accept}, apikey='k', resource='get_holding').json()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        answers = list(executor.map(get, ['application/json'] * 6 + ['application/xml'] * 2))
+    assert answers == [{'ok': True}] * 8
+    assert server.calls == 2
+    assert transport.coalesced == 6
+    # the waiters are counted apart from the network calls and their latencies
+    holdings = transport.metrics.snapshot()['calls']['GET get_holding']
+    assert holdings['calls'] == 2 and holdings['latency']['count'] == 2 and holdings['statuses'] == {'200': 2}
+    assert holdings['coalesced'] == 6
+    assert 'coalesced:6' in transport.metrics.dump()
+    transport.request('GET', holding, apikey='k')
+    assert server.calls == 3
+    transport.close()
+
+
+def test_metrics(server):
+    cache = Alma_Apis_Cache.ResponseCache(ttls={'get_holding': 60})
+    transport = Alma_Apis_Transport.AlmaTransport(cache=cache)
+    calls = []
+    transport.metrics.add_hook(pre=lambda *args: calls.append('pre'),
+                               post=lambda method, resource, url, status, latency, answer: calls.append(status))
+    holding = url(server, '/almaws/v1/bibs/1/holdings/2')
+    for x in range(3):
+        transport.request('GET', holding, apikey='k', resource='get_holding')
+    transport.request('PUT', holding, data='<holding/>', apikey='k', resource='get_holding')
+    transport.request('GET', url(server, '/almaws/v1/items/error'), apikey='k', resource='get_item_with_barcode')
+    snapshot = transport.metrics.snapshot()
+    holdings = snapshot['calls']['GET get_holding']
+    assert holdings['calls'] == 3 and holdings['statuses'] == {'200': 3}
+    assert holdings['bytes_received'] == 3 * len(b'{"ok": true}')
+    assert holdings['latency']['count'] == 3
+    assert snapshot['calls']['PUT get_holding']['bytes_sent'] == len('<holding/>')
+    assert snapshot['calls']['GET get_item_with_barcode']['error_codes'] == {'401890': 1}
+    assert snapshot['cache']['hits'] == 2
+    assert snapshot['retry']['retries'] == 0
+    assert snapshot['transport'] == {'writes_skipped': 0, 'coalesced': 0}
+    assert calls == ['pre', 200] * 4 + ['pre', 400]
+    dump = transport.metrics.dump()
+    assert 'GET get_item_with_barcode' in dump and '400:1 / 401890:1' in dump
+    transport.close()
+
+
+def test_histogram_quantiles():
+    histogram = Alma_Apis_Metrics.Histogram()
+    for value in [0.01] * 90 + [0.3] * 9 + [12]:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 0.05
+    assert histogram.quantile(0.95) == 0.5
+    assert histogram.quantile(1) == 12
+
+
+def test_tracing_spans(server, tmp_path):
+    transport = Alma_Apis_Transport.AlmaTransport()
+    holding = url(server, '/almaws/v1/bibs/1/holdings/2')
+    transport.request('GET', holding, apikey='k', resource='get_holding')
+    Alma_Apis_Tracing.enable(str(tmp_path / 'trace.jsonl'))
+    try:
+        assert transport.request('GET', holding, apikey='k', resource='get_holding').json() == {'ok': True}
+        with Alma_Apis_Tracing.span('extract_content'):
+            pass
+    finally:
+        Alma_Apis_Tracing.disable()
+    transport.request('GET', holding, apikey='k', resource='get_holding')
+    with open(str(tmp_path / 'trace.jsonl')) as trace_file:
+        spans = [json.loads(line) for line in trace_file]
+    names = [span['name'] for span in spans]
+    assert names == ['rate_limit', 'connection', 'first_byte', 'download', 'request', 'extract_content']
+    request = spans[4]
+    assert request['args']['resource'] == 'get_holding' and request['ph'] == 'X'
+    assert request['ts'] <= spans[0]['ts'] and spans[3]['ts'] + spans[3]['dur'] <= request['ts'] + request['dur']
+    transport.close()
+
+
+def test_chrome_trace_and_profile(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    tracer = Alma_Apis_Tracing.Tracer(path)
+    for x in range(3):
+        with tracer.span('build_url', n=x):
+            pass
+    tracer.close()
+    with open(path) as trace_file:
+        assert [span['args']['n'] for span in json.load(trace_file)] == [0, 1, 2]
+    with Alma_Apis_Tracing.profile(str(tmp_path / 'calls.prof')) as profiler:
+        sorted(range(1000), key=str)
+    assert (tmp_path / 'calls.prof').exists()
@@ -16,20 +16,10 @@ def get_user_institution(user_id):
     """
     # institutions_list = ['NETWORK','UB','UBM','IEP','INP','BXSA']
     institutions_list = ['NETWORK','UB','BXSA']
-    users_list = []
-    for institution in institutions_list :
-        api_key = os.getenv("TEST_{}_API".format(institution))
-        api = Alma_Apis_Users.AlmaUsers(apikey=api_key, region='EU', service='test')
-        status, response = api.retrieve_user_by_id(user_id, accept='json')
-        # print("{} --> {} : {}".format(institution,status,response))
-        if status == "Success":
-            total_record_count = response['total_record_count']
-            if total_record_count == 1 :
-                user_data = {}
-                status,user = api.get_user(user_id,accept='json')
-                user_data["institution"] = institution
-                user_data["data"] = user
-                users_list.append(user_data)
+    api = Alma_Apis_Users.AlmaNetworkUsers({institution : os.getenv("TEST_{}_API".format(institution)) for institution in institutions_list},
+                                           region='EU', service='test')
+    users_list, report = api.get_user_institutions(user_id, accept='json')
+    # print(report)
     return users_list
 
         
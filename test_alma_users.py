@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import pytest
+
+import Alma_Apis_Users
+
+INSTITUTIONS = {'key-network': ['U1'], 'key-ub': ['U1', 'U2'], 'key-iep': [], 'key-bxsa': 500, 'key-inp': ['U1']}
+
+
+@pytest.mark.parametrize('total', [0, 1, 100, 250])
+def test_iter_user_requests_pages(server, client, total):
+    server.user_requests = total
+    request_ids = [user_request['request_id'] for user_request in client(Alma_Apis_Users.AlmaUsers).iter_user_requests('U1')]
+    assert sorted(request_ids) == sorted('HOLD-{}'.format(n) for n in range(total))
+    # one call by page of USER_REQUESTS_LIMIT, the first one even without request
+    assert server.counts['user_requests'] == max(1, -(-total // Alma_Apis_Users.USER_REQUESTS_LIMIT))
+
+
+@pytest.mark.fake_alma(user_requests={'HOLD': 150, 'DIGITIZATION': 0, 'BOOKING': 3})
+def test_iter_user_requests_types(server, client):
+    user_requests = list(client(Alma_Apis_Users.AlmaUsers).iter_user_requests(
+        'U1', request_types=('HOLD', 'DIGITIZATION', 'BOOKING'), max_workers=2))
+    by_type = {}
+    for user_request in user_requests:
+        by_type[user_request['request_type']] = by_type.get(user_request['request_type'], 0) + 1
+    assert by_type == {'HOLD': 150, 'BOOKING': 3}
+    assert len({user_request['request_id'] for user_request in user_requests}) == 153
+    assert server.counts['user_requests'] == 4
+
+
+@pytest.mark.fake_alma(institutions=INSTITUTIONS, jitter=0.05, seed=3)
+def test_get_user_institutions(client):
+    api = client(Alma_Apis_Users.AlmaNetworkUsers, apikeys={'NETWORK': 'key-network', 'UB': 'key-ub', 'IEP': 'key-iep',
+                                                            'BXSA': 'key-bxsa', 'INP': 'key-inp'})
+    users_list, report = api.get_user_institutions('U1')
+    # in the order of the institutions, whatever the order of the answers
+    assert [user['institution'] for user in users_list] == ['NETWORK', 'UB', 'INP']
+    assert all(user['data']['primary_id'] == 'U1' for user in users_list)
+    assert {institution: entry['status'] for institution, entry in report.items()} == {
+        'NETWORK': 'Success', 'UB': 'Success', 'IEP': 'No record found', 'BXSA': 'Error', 'INP': 'Success'}
+    assert 'GENERAL_ERROR' in report['BXSA']['error']
+    assert report['IEP']['error'] == '0 lecteurs'
+    assert report['NETWORK']['error'] is None and report['NETWORK']['latency'] >= 0